@@ -40,13 +40,20 @@ from .platform.btrfs import find_new, get_root_generation
 from .platform.ioprio import set_idle_priority
 from .platform.syncfs import syncfs
 
-from .dedup import dedup_same, FilesInUseError
+from .dedup import dedup_same, FilesInUseError, ENGINES
+from .digestcache import DigestCache
 from .filesystem import show_vols, WholeFS, NotAVolume
+from .hashing import PARTIAL_BLOCK_SIZE
 from .migrations import upgrade_schema
+from .profiles import parse_profile, phase_profile
 from .termupdates import TermTemplate
 from .tracking import (
     track_updated_files, dedup_tracked, reset_vol, fake_updates,
-    annotated_inodes_by_size)
+    annotated_inodes_by_size, DedupOptions, PIPELINE_STAGES)
+
+
+# Scanning, then each stage of deduplication
+PROFILE_PHASES = ('scan', ) + PIPELINE_STAGES
 
 
 APP_NAME = 'bedup'
@@ -54,7 +61,8 @@ APP_NAME = 'bedup'
 
 def cmd_dedup_files(args):
     try:
-        return dedup_same(args.source, args.dests, args.defrag)
+        return dedup_same(
+            args.source, args.dests, args.defrag, args.engine)
     except FilesInUseError as exn:
         exn.describe(sys.stderr)
         return 1
@@ -177,31 +185,71 @@ def vol_cmd(args):
 
         if args.command in ('scan', 'dedup'):
             set_idle_priority()
-            for vol in vols:
-                if args.flush:
-                    tt.format('{elapsed} Flushing %s' % (vol,))
-                    syncfs(vol.fd)
-                    tt.format(None)
-                track_updated_files(sess, vol, tt)
-                vols_by_fs[vol.fs].append(vol)
+            profiles = dict(args.profiles)
+            with phase_profile(profiles.get('scan')):
+                for vol in vols:
+                    if args.flush:
+                        tt.format('{elapsed} Flushing %s' % (vol,))
+                        syncfs(vol.fd)
+                        tt.format(None)
+                    track_updated_files(sess, vol, tt)
+                    vols_by_fs[vol.fs].append(vol)
 
         if args.command == 'dedup':
+            opts = dedup_options(args)
             if args.groupby == 'vol':
                 for vol in vols:
                     tt.notify('Deduplicating volume %s' % vol)
-                    dedup_tracked(sess, [vol], tt, defrag=args.defrag)
+                    dedup_tracked(sess, [vol], tt, opts)
             elif args.groupby == 'mpoint':
                 for fs, volset in vols_by_fs.items():
                     tt.notify('Deduplicating filesystem %s' % fs)
-                    dedup_tracked(sess, volset, tt, defrag=args.defrag)
+                    dedup_tracked(sess, volset, tt, opts)
             else:
                 assert False, args.groupby
+            if opts.digest_cache is not None:
+                opts.digest_cache.save(args.digest_cache)
 
         # For safety only.
         # The methods we call from the tracking module are expected to commit.
         sess.commit()
 
 
+def dedup_options(args):
+    return DedupOptions(
+        defrag=args.defrag,
+        hash_workers=args.hash_workers,
+        concurrency=dict(args.concurrency),
+        prefetch=args.prefetch,
+        drop_cache=args.drop_cache,
+        direct_io=args.direct_io,
+        punch_zeros=args.punch_zeros,
+        digest_cache=load_digest_cache(args),
+        elevator=args.elevator,
+        device_concurrency=args.device_concurrency,
+        checkpoint_above=args.checkpoint_above,
+        max_read_rate=args.max_read_rate,
+        max_iops=args.max_iops,
+        pressure_slow=args.pressure_slow,
+        pressure_pause=args.pressure_pause,
+        pressure_cgroup=args.pressure_cgroup,
+        profiles=dict(args.profiles),
+        autotune=args.autotune,
+        engine=args.engine,
+        clone_chunk=args.clone_chunk,
+        partial_block=args.partial_block,
+        common_prefix=args.common_prefix,
+        min_gain=args.min_gain)
+
+
+def load_digest_cache(args):
+    if args.digest_cache is None:
+        return
+    digest_cache = DigestCache()
+    digest_cache.load(args.digest_cache)
+    return digest_cache
+
+
 def cmd_generation(args):
     volume_fd = os.open(args.volume, os.O_DIRECTORY)
     if args.flush:
@@ -322,6 +370,184 @@ def scan_flags(parser):
     parser.add_argument(
         '--flush', action='store_true', dest='flush',
         help='Flush outstanding data using syncfs before scanning volumes')
+    parser.add_argument(
+        '--profile', type=phase_profile_arg, action='append',
+        default=[], dest='profiles',
+        metavar='PHASE=CLASS[,level=N][,nice=N][,cgroup=DIR]',
+        help='Schedule a phase (%s) with an IO class (be, idle), '
+        'a best-effort level, a CPU niceness and a threaded cgroup v2 '
+        'directory to put its threads in; can be repeated. '
+        'Phases without a profile run in the idle IO class. '
+        '--pressure-slow overrides IO classes while it backs off.'
+        % ', '.join(PROFILE_PHASES))
+
+
+def phase_profile_arg(arg):
+    phase, sep, spec = arg.partition('=')
+    if not sep or phase not in PROFILE_PHASES:
+        raise argparse.ArgumentTypeError(
+            'Expected PHASE=PROFILE, with PHASE one of %s' % ', '.join(
+                PROFILE_PHASES))
+    try:
+        return phase, parse_profile(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('%s: %r' % (e, arg))
+
+
+def partial_block_arg(arg):
+    block = int(arg)
+    if block <= 0 or block % 4096:
+        raise argparse.ArgumentTypeError(
+            'Expected a multiple of 4096: %r' % arg)
+    return block
+
+
+def stage_concurrency(arg):
+    stage, sep, count = arg.partition('=')
+    if not sep or stage not in PIPELINE_STAGES:
+        raise argparse.ArgumentTypeError(
+            'Expected STAGE=N, with STAGE one of %s' % ', '.join(
+                PIPELINE_STAGES))
+    try:
+        count = int(count)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(
+            'Stage concurrency must be a positive integer: %r' % arg)
+    return stage, count
+
+
+def dedup_flags(parser):
+    # Shared with the deprecated dedup-vol alias
+    parser.add_argument(
+        '--hash-workers', type=int, default=0, dest='hash_workers',
+        metavar='N',
+        help='Compute full hashes in N worker processes. '
+        'Useful when hashing is CPU-bound (cached data or fast storage).')
+    parser.add_argument(
+        '--concurrency', type=stage_concurrency, action='append',
+        default=[], dest='concurrency', metavar='STAGE=N',
+        help='Run N workers for a deduplication stage '
+        '(%s); can be repeated. '
+        'Stages work on different size groups at the same time. '
+        'The default is one worker per stage.' % ', '.join(PIPELINE_STAGES))
+    parser.add_argument(
+        '--prefetch', type=int, default=0, dest='prefetch', metavar='BYTES',
+        help='Ask the kernel to start reading the samples of files in '
+        'upcoming size groups, and the start of files that pass '
+        'sampling, keeping at most BYTES prefetched ahead. '
+        'Hides seek latency on rotational disks.')
+    parser.add_argument(
+        '--drop-cache', action='store_true', dest='drop_cache',
+        help='Evict the file data bedup reads from the page cache '
+        'once it is done with it, unless it was cached already. '
+        'Keeps a large pass from displacing the working set '
+        'of other programs.')
+    parser.add_argument(
+        '--direct-io', action='store_true', dest='direct_io',
+        help='Hash and compare files with direct IO, bypassing the '
+        'page cache. Falls back to regular reads where the kernel '
+        'refuses direct IO.')
+    parser.add_argument(
+        '--punch-zeros', action='store_true', dest='punch_zeros',
+        help='Turn runs of zeroes (at least 128KiB) found while hashing '
+        'into holes. This frees space even for files that have '
+        'no duplicate.')
+    parser.add_argument(
+        '--digest-cache', dest='digest_cache', metavar='FILE',
+        help='Remember the digests of file chunks by the extents '
+        'they are made of, and keep them in FILE between runs. '
+        'Files that share extents with files hashed before '
+        '(snapshots, reflinked copies) are verified without reading them.')
+    parser.add_argument(
+        '--elevator', action='store_true', dest='elevator',
+        help='Sample and hash files in the order of their position '
+        'on disk rather than by size, sweeping back and forth. '
+        'Cuts down on seeks on rotational disks.')
+    parser.add_argument(
+        '--device-concurrency', type=int, default=0,
+        dest='device_concurrency', metavar='N',
+        help='Keep at most N reads in flight on each device of the '
+        'filesystem, and by default run enough sample and verify '
+        'workers to keep all devices busy. '
+        'For filesystems that span several disks.')
+    parser.add_argument(
+        '--checkpoint-above', type=int, dest='checkpoint_above',
+        metavar='BYTES',
+        help='Save progress while hashing files of at least BYTES, '
+        'so that the next run picks up where an interrupted one '
+        'stopped, as long as the file is unchanged. '
+        'These files are hashed outside of the --hash-workers pool.')
+    parser.add_argument(
+        '--max-read-rate', type=int, dest='max_read_rate',
+        metavar='BYTES',
+        help='Read at most BYTES per second, across all workers. '
+        'Unlike the idle IO priority, this works with any IO scheduler.')
+    parser.add_argument(
+        '--max-iops', type=int, dest='max_iops', metavar='N',
+        help='Issue at most N read requests per second, '
+        'counting FIEMAP calls, across all workers.')
+    parser.add_argument(
+        '--pressure-slow', type=float, dest='pressure_slow', metavar='PCT',
+        help='Watch IO and memory pressure (PSI). When tasks are stalled '
+        'more than PCT%% of the time, slow down reads and clones and '
+        'drop to the idle IO class; below, go at full speed '
+        'with the usual IO priorities. Ignored without PSI.')
+    parser.add_argument(
+        '--pressure-pause', type=float, dest='pressure_pause',
+        metavar='PCT',
+        help='With --pressure-slow, pause until pressure goes back '
+        'under the --pressure-slow threshold once tasks are stalled '
+        'more than PCT%% of the time.')
+    parser.add_argument(
+        '--pressure-cgroup', dest='pressure_cgroup', metavar='DIR',
+        help='Watch the pressure of a cgroup (v2) directory rather than '
+        'the whole system.')
+    engine_flag(parser)
+    parser.add_argument(
+        '--clone-chunk', type=int, dest='clone_chunk', metavar='BYTES',
+        help='Clone or dedupe files a range of about BYTES at a time, '
+        'cut where extents end, rather than in one call. Ranges that '
+        'already share extents are skipped. Cuts down on how long '
+        'writers to the filesystem can be held up by large files, '
+        'and lets throttling apply between ranges.')
+    parser.add_argument(
+        '--partial', type=partial_block_arg, nargs='?',
+        const=PARTIAL_BLOCK_SIZE,
+        dest='partial_block', metavar='BLOCK',
+        help='Also deduplicate the blocks that large files (16MiB and up) '
+        'of the same size have in common, when they aren\'t identical. '
+        'Files are compared by blocks of BLOCK bytes '
+        '(128KiB by default, a multiple of 4KiB); runs of identical '
+        'blocks get shared. This reads every such file again.')
+    parser.add_argument(
+        '--common-prefix', action='store_true', dest='common_prefix',
+        help='Also look for files (1MiB and up) of different sizes '
+        'that start the same, like logs and backups that were appended '
+        'to, and deduplicate the start they have in common.')
+    parser.add_argument(
+        '--min-gain', type=int, dest='min_gain', metavar='BYTES',
+        help='Leave a file alone when sharing it would free less than '
+        'BYTES, going by how much of it is in extents that aren\'t '
+        'shared already. Files whose extents are kept by snapshots '
+        'free nothing, and sharing them only makes for metadata writes '
+        'and transaction commits.')
+    parser.add_argument(
+        '--autotune', action='store_true', dest='autotune',
+        help='Tune sampling and the size of query windows from what '
+        'earlier runs read and freed, by file size. Sizes that never '
+        'had duplicates stop being hashed. '
+        'Reads and space freed by size are reported at the end either way.')
+
+
+def engine_flag(parser):
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='clone',
+        help='How files get deduplicated. clone (the default) freezes '
+        'files and compares them before cloning; dedupe has the kernel '
+        'compare and share them (Linux 4.5), without freezing files '
+        'or reading them again.')
 
 
 def is_in_path(cmd):
@@ -357,6 +583,7 @@ Scans volumes to keep track of potentially duplicated files.""")
 Runs scan, then deduplicates identical files.""")
     sp_dedup_vol.set_defaults(action=vol_cmd)
     scan_flags(sp_dedup_vol)
+    dedup_flags(sp_dedup_vol)
     sp_dedup_vol.add_argument(
         '--defrag', action='store_true',
         help='Defragment files that are going to be deduplicated')
@@ -368,6 +595,7 @@ Runs scan, then deduplicates identical files.""")
 A deprecated alias for the 'dedup' command.""")
     sp_dedup_vol_compat.set_defaults(action=vol_cmd)
     scan_flags(sp_dedup_vol_compat)
+    dedup_flags(sp_dedup_vol_compat)
 
     sp_reset_vol = commands.add_parser(
         'reset', help='Reset tracking metadata', description="""
@@ -426,6 +654,7 @@ which displays the extent map of files.
     sp_dedup_files.add_argument(
         '--defrag', action='store_true',
         help='Defragment the source file first')
+    engine_flag(sp_dedup_files)
 
     sp_generation = commands.add_parser(
         'generation', help='Display volume generation', description="""
@@ -0,0 +1,12 @@
+import shutil
+import tempfile
+
+import pytest
+
+
+@pytest.fixture
+def tdir(request):
+    # A scratch directory, removed after the test
+    tdir = tempfile.mkdtemp(prefix='dedup-tests-')
+    request.addfinalizer(lambda: shutil.rmtree(tdir))
+    return tdir
@@ -20,17 +20,33 @@
 
 import collections
 import errno
-import glob
 import os
 import re
 import stat
+import threading
 
-from .platform.btrfs import clone_data, defragment as btrfs_defragment
+from concurrent.futures import ThreadPoolExecutor
+
+from .platform.btrfs import (
+    clone_data, clone_range, defragment as btrfs_defragment,
+    lib as btrfs_lib)
 from .platform.chattr import editflags, FS_IMMUTABLE_FL
+from .platform.dedupe import (
+    dedupe_files, dedupe_range, CHUNK_SIZE as DEDUPE_CHUNK_SIZE, SAME)
+from .platform.fiemap import extents_in_range, fiemap
 from .platform.futimens import fstat_ns, futimens
 
 
 BUFSIZE = 8192
+# Clone ranges get cut at a block boundary
+BLOCK_SIZE = 4096
+# What a seek costs, counted as bytes read
+SEEK_COST = 1024 ** 2
+
+# How files get to share their data.
+# clone freezes the files and compares them in userspace first,
+# dedupe has the kernel compare them while they are locked.
+ENGINES = ('clone', 'dedupe')
 
 
 class FilesDifferError(ValueError):
@@ -82,7 +98,7 @@ def cmp_files(fi1, fi2):
             return True
 
 
-def dedup_same(source, dests, defragment=False):
+def dedup_same(source, dests, defragment=False, engine='clone'):
     if defragment:
         source_fd = os.open(source, os.O_RDWR)
     else:
@@ -91,6 +107,22 @@ def dedup_same(source, dests, defragment=False):
     fds = [source_fd] + dest_fds
     fd_names = dict(zip(fds, [source] + dests))
 
+    if engine == 'dedupe':
+        if defragment:
+            btrfs_defragment(source_fd)
+        size = os.fstat(source_fd).st_size
+        for fd in dest_fds:
+            if os.fstat(fd).st_size != size:
+                raise FilesDifferError(fd_names[source_fd], fd_names[fd])
+        results = dedupe_files(source_fd, dest_fds, size)
+        for fd in dest_fds:
+            status, deduped = results[fd]
+            if status < 0:
+                raise OSError(-status, os.strerror(-status))
+            if status != SAME:
+                raise FilesDifferError(fd_names[source_fd], fd_names[fd])
+        return
+
     with ImmutableFDs(fds) as immutability:
         if immutability.fds_in_write_use:
             raise FilesInUseError(
@@ -108,16 +140,184 @@ def dedup_same(source, dests, defragment=False):
             clone_data(dest=fd, src=source_fd, check_first=not defragment)
 
 
+def source_cost(extents, shared):
+    """
+    Rates a file as a clone source, the lowest is the best.
+
+    extents are the platform.btrfs.FileExtents of the file, in order,
+    shared the bytes it already shares with other files.
+    The cost is what reading the file takes: the bytes stored, which
+    compression brings down, and the seeks between extents that aren't
+    contiguous on disk.  Sharing bytes that are already shared frees
+    them in the other files, so shared bytes count against the cost.
+    Returns a sort key; between equal costs, the one whose extents are
+    closest together on disk wins.
+    """
+
+    stored = seeks = distance = 0
+    prev_end = None
+    for extent in extents:
+        if extent.type == btrfs_lib.BTRFS_FILE_EXTENT_INLINE:
+            stored += extent.num_bytes
+            continue
+        if not extent.disk_bytenr:
+            # A hole
+            continue
+        if extent.compression:
+            # Compressed extents are read whole
+            start = extent.disk_bytenr
+            length = extent.disk_num_bytes
+        else:
+            start = extent.disk_bytenr + extent.extent_offset
+            length = extent.num_bytes
+        if prev_end is not None and start != prev_end:
+            seeks += 1
+            distance += abs(start - prev_end)
+        stored += length
+        prev_end = start + length
+    return stored + seeks * SEEK_COST - shared, distance
+
+
+def clone_ranges(extents, start, end, chunk_size):
+    """
+    Cuts the range of a file from start to end into ranges of about
+    chunk_size, ending where its extents end, going by its FIEMAP
+    extents in order.  Extents larger than chunk_size get split at
+    a block boundary.  The last range ends at end.
+    """
+
+    chunk_size = max(BLOCK_SIZE, chunk_size // BLOCK_SIZE * BLOCK_SIZE)
+    for extent in extents:
+        ext_end = extent.logical + extent.length
+        while ext_end - start > chunk_size and start + chunk_size < end:
+            if extent.logical - start >= BLOCK_SIZE:
+                # Extents so far make a range; FIEMAP only lists
+                # block-aligned extents on btrfs, save for inline data.
+                range_end = min(extent.logical, end)
+            else:
+                range_end = start + chunk_size
+            yield start, range_end
+            start = range_end
+    if start < end:
+        yield start, end
+
+
+def clone_chunked(
+    dest, src, size, chunk_size, check_first, progress=None, start=0,
+    extents=None,
+):
+    """
+    Clones src into dest like clone_data, a range at a time.
+
+    Locks are only held and transactions only built for a range,
+    which leaves room for foreground writers on large files.
+    With start, only the part from start to size is cloned.
+    With check_first, ranges that already share extents are skipped.
+    extents, if given, are the FIEMAP extents of src and dest,
+    to save looking them up again.
+    progress, if given, is called after each range with its length;
+    it can sleep to slow things down.
+    Returns the number of bytes that were cloned.
+    """
+
+    if extents is not None:
+        src_extents, dest_extents = extents
+    else:
+        src_extents = list(fiemap(src))
+        if check_first:
+            dest_extents = list(fiemap(dest))
+    cloned = 0
+    for (start, end) in clone_ranges(src_extents, start, size, chunk_size):
+        if check_first and extents_in_range(
+            src_extents, start, end
+        ) == extents_in_range(dest_extents, start, end):
+            continue
+        clone_range(
+            dest=dest, src=src, src_offset=start, length=end - start,
+            dest_offset=start)
+        cloned += end - start
+        if progress is not None:
+            progress(end - start)
+    return cloned
+
+
+def dedupe_same_range(
+    dest, src, start, end, chunk_size=DEDUPE_CHUNK_SIZE, progress=None,
+):
+    """
+    Shares a range of src with the same range of dest,
+    as far as the kernel finds their contents are the same.
+
+    Goes chunk_size at a time, at most DEDUPE_CHUNK_SIZE.
+    progress, if given, is called with the bytes shared after each call;
+    it can sleep to slow things down.
+    Returns the number of bytes that were shared.
+    """
+
+    chunk_size = min(chunk_size, DEDUPE_CHUNK_SIZE)
+    shared = 0
+    for pos in range(start, end, chunk_size):
+        length = min(chunk_size, end - pos)
+        (status, deduped), = dedupe_range(src, pos, length, [(dest, pos)])
+        if status < 0:
+            raise OSError(-status, os.strerror(-status))
+        if status == SAME:
+            shared += deduped
+            if progress is not None and deduped:
+                progress(deduped)
+    return shared
+
+
+def punch_zeroes(fd, dir_fd, ranges, verify=False):
+    """
+    Turns ranges of a file into holes.  The ranges must hold zeroes.
+
+    fallocate won't punch holes in immutable inodes but cloning works,
+    the holes are cloned from an empty file created in dir_fd.
+    With verify, the kernel checks that the ranges still hold zeroes,
+    for files that aren't frozen; ranges that don't are left alone.
+    Offsets and lengths must be block-aligned.
+    Returns the number of bytes that were turned into holes; the space
+    that frees depends on what else references the extents.
+    """
+
+    scratch = os.open(
+        '/proc/self/fd/%d' % dir_fd, os.O_TMPFILE | os.O_RDWR, 0o600)
+    try:
+        os.ftruncate(scratch, max(end - start for (start, end) in ranges))
+        punched = 0
+        for (start, end) in ranges:
+            if not verify:
+                clone_range(
+                    dest=fd, src=scratch, src_offset=0, length=end - start,
+                    dest_offset=start)
+                punched += end - start
+                continue
+            for pos in range(start, end, DEDUPE_CHUNK_SIZE):
+                length = min(DEDUPE_CHUNK_SIZE, end - pos)
+                (status, deduped), = dedupe_range(
+                    scratch, pos - start, length, [(fd, pos)])
+                if status < 0:
+                    raise OSError(-status, os.strerror(-status))
+                if status == SAME:
+                    punched += deduped
+        return punched
+    finally:
+        os.close(scratch)
+
+
 PROC_PATH_RE = re.compile(r'^/proc/(\d+)/fd/(\d+)$')
+# Processes whose /proc entries are listed at the same time
+PROC_SCAN_WORKERS = 8
 
 
-def find_inodes_in_write_use(fds):
-    for (fd, use_info) in find_inodes_in_use(fds):
+def find_inodes_in_write_use(fds, users=None):
+    for (fd, use_info) in find_inodes_in_use(fds, users):
         if use_info.is_writable:
             yield (fd, use_info)
 
 
-def find_inodes_in_use(fds):
+def find_inodes_in_use(fds, users=None):
     """
     Find which of these inodes are in use, and give their open modes.
 
@@ -125,7 +325,8 @@ def find_inodes_in_use(fds):
     but if the current process has the same inodes open with different
     file descriptors these will be listed.
 
-    Looks at /proc/*/fd and /proc/*/map_files (Linux 3.3).
+    users is an index from scan_proc, taken after the inodes were made
+    immutable; /proc is scanned if it isn't given.
     Conceivably there are other uses we're missing, to be foolproof
     will require support in btrfs itself; a share-same-range ioctl
     would work well.
@@ -138,52 +339,113 @@ def find_inodes_in_use(fds):
         st = os.fstat(fd)
         id_fd_assoc[(st.st_dev, st.st_ino)].append(fd)
 
-    def st_id_candidates(it):
-        # map proc paths to stat identifiers (devno and ino)
-        for proc_path in it:
+    if users is None:
+        users = scan_proc()
+
+    for (st_id, original_fds) in id_fd_assoc.items():
+        for proc_path in users.get(st_id, ()):
+            match = PROC_PATH_RE.match(proc_path)
+            if match is not None:
+                other_pid, other_fd = map(int, match.groups())
+                if other_pid == self_pid and other_fd in original_fds:
+                    continue
+
+            # The mode is looked up now, the index only has paths
+            use_info = proc_use_info(proc_path)
+            if not use_info:
+                continue
+
+            for fd in original_fds:
+                yield (fd, use_info)
+
+
+def scan_proc(workers=PROC_SCAN_WORKERS):
+    """
+    Indexes what every process has open or mapped.
+
+    Looks at /proc/*/fd and /proc/*/map_files (Linux 3.3).
+    Returns a dict of stat identifiers (devno and ino)
+    to the /proc paths that point to them.
+    """
+
+    pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    users = collections.defaultdict(list)
+    with ThreadPoolExecutor(workers) as executor:
+        for proc_users in executor.map(scan_pid, pids):
+            for (st_id, proc_path) in proc_users:
+                users[st_id].append(proc_path)
+    return users
+
+
+def scan_pid(pid):
+    # (stat identifier, proc path) for the fds and mappings of a process
+    proc_users = []
+    for subdir in ('fd', 'map_files'):
+        dirname = '/proc/%s/%s' % (pid, subdir)
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            # Gone, not ours to look at, or older than map_files
+            continue
+        for name in names:
+            proc_path = os.path.join(dirname, name)
             try:
                 st = os.stat(proc_path)
             except OSError as e:
-                # glob opens directories during matching,
-                # and other processes might close their fds in the meantime.
+                # Other processes might close their fds in the meantime.
                 # This isn't a problem for the immutable-locked use case.
                 # ESTALE could happen with NFS or Docker
                 if e.errno in (errno.ENOENT, errno.ESTALE):
                     continue
                 raise
+            proc_users.append(((st.st_dev, st.st_ino), proc_path))
+    return proc_users
 
-            st_id = (st.st_dev, st.st_ino)
-            if st_id not in id_fd_assoc:
-                continue
-
-            yield proc_path, st_id
 
-    for proc_path, st_id in st_id_candidates(glob.glob('/proc/[1-9]*/fd/*')):
-        other_pid, other_fd = map(
-            int, PROC_PATH_RE.match(proc_path).groups())
-        original_fds = id_fd_assoc[st_id]
-        if other_pid == self_pid:
-            if other_fd in original_fds:
-                continue
+class InUseIndex(object):
+    """A /proc index shared by the sets that get frozen together.
 
-        use_info = proc_use_info(proc_path)
-        if not use_info:
-            continue
-
-        for fd in original_fds:
-            yield (fd, use_info)
-
-    # Requires Linux 3.3
-    for proc_path, st_id in st_id_candidates(
-        glob.glob('/proc/[1-9]*/map_files/*')
-    ):
-        use_info = proc_use_info(proc_path)
-        if not use_info:
-            continue
+    An index only tells about the writers of inodes that were made
+    immutable before its scan started: those can't get new writers,
+    while other inodes could have got some during the scan.
+    Sets take a ticket once their files are frozen, and get an index
+    whose scan started after that; a set that was frozen while a scan
+    ran waits for the next one, along with the others that were.
+    """
 
-        original_fds = id_fd_assoc[st_id]
-        for fd in original_fds:
-            yield (fd, use_info)
+    def __init__(self, workers=PROC_SCAN_WORKERS):
+        self.workers = workers
+        self._cond = threading.Condition()
+        # Scans started so far, and the latest to complete
+        self._started = 0
+        self._done = 0
+        self._scanning = False
+        self._users = None
+
+    def ticket(self):
+        # Take this after freezing
+        with self._cond:
+            return self._started
+
+    def users(self, ticket):
+        with self._cond:
+            while self._done <= ticket:
+                if self._scanning:
+                    self._cond.wait()
+                    continue
+                self._scanning = True
+                self._started += 1
+                seq = self._started
+                self._cond.release()
+                try:
+                    users = scan_proc(self.workers)
+                finally:
+                    self._cond.acquire()
+                    self._scanning = False
+                    self._cond.notify_all()
+                self._users = users
+                self._done = seq
+            return self._users
 
 
 RestoreInfo = collections.namedtuple(
@@ -207,11 +469,13 @@ class ImmutableFDs(object):
     # it is scoped to a mount namespace, which would complicate
     # attempts to enforce it with a remount.
 
-    def __init__(self, fds):
+    def __init__(self, fds, in_use_index=None):
         self.__fds = fds
         self.__revert_list = []
         self.__in_use = None
         self.__writable_fds = None
+        self.__in_use_index = in_use_index
+        self.__ticket = None
 
     def __enter__(self):
         for fd in self.__fds:
@@ -223,6 +487,9 @@ class ImmutableFDs(object):
             atime, mtime = fstat_ns(fd)
             self.__revert_list.append(
                 RestoreInfo(fd, was_immutable, atime, mtime))
+        if self.__in_use_index is not None:
+            # Only scans that start from now on will do
+            self.__ticket = self.__in_use_index.ticket()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -239,7 +506,12 @@ class ImmutableFDs(object):
         # We only track write use, other uses can appear after the /proc scan
         if self.__in_use is None:
             self.__in_use = collections.defaultdict(list)
-            for (fd, use_info) in find_inodes_in_write_use(self.__fds):
+            users = None
+            if self.__in_use_index is not None:
+                users = self.__in_use_index.users(self.__ticket)
+            for (fd, use_info) in find_inodes_in_write_use(
+                self.__fds, users
+            ):
                 self.__in_use[fd].append(use_info)
             self.__writable_fds = frozenset(self.__in_use.keys())
 
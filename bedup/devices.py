@@ -0,0 +1,209 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import multiprocessing
+
+from contextlib import contextmanager
+
+from .platform.btrfs import data_chunks, lib, MIRROR_PROFILES
+from .platform.fiemap import fiemap, lib as fiemap_lib
+from .platform.ioprio import gettid
+
+
+# The DeviceQueues of this process, when it is a hashing worker
+inherited = None
+
+
+class DeviceMap(object):
+    """Which devices serve reads at a given logical address.
+
+    A snapshot of the chunk tree; a balance that runs meanwhile
+    only makes the answers stale, which costs some parallelism.
+    """
+
+    def __init__(self, chunks):
+        # Chunks as data_chunks returns them, sorted by logical address
+        self.chunks = list(chunks)
+        self._starts = [chunk.logical for chunk in self.chunks]
+        self.devids = sorted(set(
+            devid for chunk in self.chunks for devid in chunk.devids))
+
+    @classmethod
+    def of_volume(cls, volume_fd):
+        return cls(data_chunks(volume_fd))
+
+    def devices_at(self, logical):
+        """Returns the devids a read at a logical address can go to.
+
+        Mirrored copies are all returned, the kernel picks one of them.
+        None if the address isn't in a data chunk.
+        """
+
+        chunk = self._chunk_at(logical)
+        if chunk is None:
+            return
+        if chunk.profile & MIRROR_PROFILES or not chunk.profile:
+            # Copies, or a single stripe; DUP has both on one device
+            return tuple(sorted(set(chunk.devids)))
+        return self._copies(
+            chunk, (logical - chunk.logical) // chunk.stripe_len)
+
+    def devices_in(self, logical, length, mirror=0):
+        """Returns the set of devids that serve reads of a logical range.
+
+        Striped ranges can span several devices.  Of mirrored copies,
+        the one at index mirror (modulo the number of copies) is taken.
+        Addresses that aren't in a data chunk are left out.
+        """
+
+        devids = set()
+        pos = logical
+        end = logical + length
+        while pos < end:
+            chunk = self._chunk_at(pos)
+            if chunk is None:
+                # Skip to the next chunk, if there is one
+                idx = bisect.bisect_right(self._starts, pos)
+                if idx == len(self.chunks):
+                    break
+                pos = self.chunks[idx].logical
+                continue
+            chunk_end = chunk.logical + chunk.length
+            if chunk.profile & MIRROR_PROFILES or not chunk.profile:
+                # The same copies all along the chunk
+                stripe_nr = 0
+                stripe_end = chunk_end
+            else:
+                stripe_nr = (pos - chunk.logical) // chunk.stripe_len
+                stripe_end = min(
+                    chunk_end,
+                    chunk.logical + (stripe_nr + 1) * chunk.stripe_len)
+            copies = self._copies(chunk, stripe_nr)
+            devids.add(copies[mirror % len(copies)])
+            pos = stripe_end
+        return devids
+
+    def _chunk_at(self, logical):
+        idx = bisect.bisect_right(self._starts, logical) - 1
+        if idx < 0:
+            return
+        chunk = self.chunks[idx]
+        if logical >= chunk.logical + chunk.length:
+            return
+        return chunk
+
+    def _copies(self, chunk, stripe_nr):
+        # The devids that hold a stripe of a chunk, in chunk order
+        devids = chunk.devids
+        if chunk.profile & MIRROR_PROFILES or not chunk.profile:
+            return devids
+        if chunk.profile & lib.BTRFS_BLOCK_GROUP_RAID0:
+            return devids[stripe_nr % len(devids)],
+        if chunk.profile & lib.BTRFS_BLOCK_GROUP_RAID10:
+            groups = len(devids) // chunk.sub_stripes
+            first = stripe_nr % groups * chunk.sub_stripes
+            return devids[first:first + chunk.sub_stripes]
+        # RAID5 and RAID6: parity rotates by one device every full stripe
+        if chunk.profile & lib.BTRFS_BLOCK_GROUP_RAID6:
+            data_stripes = len(devids) - 2
+        else:
+            data_stripes = len(devids) - 1
+        full_stripe_nr, index = divmod(stripe_nr, data_stripes)
+        return devids[(full_stripe_nr + index) % len(devids)],
+
+
+class DeviceQueues(object):
+    """Bounds the reads in flight on each device.
+
+    Reads of a file range go through reading(), which waits while
+    any of the devices that will serve them is at capacity; striped
+    ranges take a slot on every device they touch.  Of mirrored
+    copies, the kernel reads the one its default read policy picks
+    by thread id, so that is the one whose slot is taken.
+
+    The semaphores are shared with hashing workers, which get them
+    when they start.
+    """
+
+    def __init__(self, device_map, per_device):
+        self.device_map = device_map
+        self.per_device = per_device
+        self._semaphores = dict(
+            (devid, multiprocessing.Semaphore(per_device))
+            for devid in device_map.devids)
+
+    def extents(self, fd, charge=None):
+        # For callers that read a file several times
+        return list(fiemap(fd, charge=charge))
+
+    def devices(self, fd, offset, length, extents=None, charge=None):
+        """Returns the sorted devids that serve reads of a file range.
+
+        Without extents, they are looked up; charge is passed to fiemap.
+        """
+
+        if extents is None:
+            extents = fiemap(fd, offset, length, charge)
+        end = offset + length
+        mirror = gettid()
+        devids = set()
+        for extent in extents:
+            if extent.logical >= end:
+                break
+            extent_end = extent.logical + extent.length
+            if extent_end <= offset:
+                continue
+            if extent.flags & (
+                fiemap_lib.FIEMAP_EXTENT_UNKNOWN
+                | fiemap_lib.FIEMAP_EXTENT_DATA_INLINE
+            ) or not extent.physical:
+                # Not on disk yet, or in the metadata
+                continue
+            # Compressed extents are shorter on disk;
+            # this overestimates where they end.
+            start = max(offset, extent.logical)
+            devids.update(self.device_map.devices_in(
+                extent.physical + start - extent.logical,
+                min(end, extent_end) - start, mirror))
+        return sorted(devids)
+
+    @contextmanager
+    def reading(self, fd, offset, length, extents=None, charge=None):
+        # Slots are taken in devid order, so that readers who need
+        # several of them can't deadlock
+        taken = []
+        try:
+            for devid in self.devices(fd, offset, length, extents, charge):
+                sem = self._semaphores.get(devid)
+                if sem is None:
+                    # Added after we took the map
+                    continue
+                sem.acquire()
+                taken.append(sem)
+            yield
+        finally:
+            for sem in reversed(taken):
+                sem.release()
+
+
+def inherit(device_queues):
+    # Pool initializer, along with throttle.inherit
+    global inherited
+    inherited = device_queues
@@ -0,0 +1,104 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import errno
+import json
+import os
+import threading
+
+from collections import OrderedDict
+
+from .hashing import HASH_CHUNK_SIZE
+
+
+# About 100 bytes per entry, each entry stands for up to HASH_CHUNK_SIZE
+CACHE_ENTRIES = 2 ** 18
+
+# Bump when the key or digest format changes
+CACHE_FORMAT = 1
+
+
+class DigestCache(object):
+    """Chunk digests, by what the chunks are made of on disk.
+
+    Keys come from hashing.chunk_keys, prefixed with the filesystem uuid.
+    Snapshots and reflinked copies share extents, so their chunks
+    only need to be read once.
+
+    Least recently used entries are evicted past capacity.
+    Thread-safe.
+    """
+
+    def __init__(self, capacity=CACHE_ENTRIES):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                digest = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return
+            self._entries[key] = digest
+            self.hits += 1
+            return digest
+
+    def put(self, key, digest):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = digest
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def load(self, path):
+        try:
+            with open(path) as cfile:
+                state = json.load(cfile)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if state.get('format') != CACHE_FORMAT:
+            return
+        if state.get('chunk_size') != HASH_CHUNK_SIZE:
+            return
+        with self._lock:
+            for (fsid, pieces, digest) in state['entries']:
+                key = (fsid, tuple(tuple(piece) for piece in pieces))
+                self._entries[key] = binascii.unhexlify(digest)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def save(self, path):
+        with self._lock:
+            state = dict(
+                format=CACHE_FORMAT,
+                chunk_size=HASH_CHUNK_SIZE,
+                entries=[
+                    (fsid, pieces, binascii.hexlify(digest).decode('ascii'))
+                    for ((fsid, pieces), digest) in self._entries.items()])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as cfile:
+            json.dump(state, cfile)
+        os.rename(tmp_path, path)
@@ -16,21 +16,612 @@
 # You should have received a copy of the GNU General Public License
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import hashlib
+import multiprocessing
+import os
+import struct
+
+from collections import namedtuple
 from zlib import adler32
 
+from . import devices
+from .platform.btrfs import extent_csums, file_extents, lib as btrfs_lib
 from .platform.fiemap import fiemap
+from .profiles import apply_profile
+from .reader import Reader
+from .readstats import ReadStats
+from .throttle import inherit
+
+
+# The mini hash reads this much
+SAMPLE_SIZE = 4096
+# How far past its offset the mini hash looks for something
+# other than zeroes
+SAMPLE_SCAN = 64 * 1024
+# Where samples are taken, as a fraction of the size
+SAMPLE_FRACTIONS = (.3, .7, .1)
+# How much of the start of a file the head hash covers
+HEAD_SIZE = 64 * 1024
+# The head hash of files that start with zeroes or holes
+ZERO_HEAD_HASH = adler32(bytes(HEAD_SIZE)) & 0xffffffff
+# What the mini hash used to be for zeroed and sparse files
+ZERO_MINI_HASH = adler32(bytes(SAMPLE_SIZE)) & 0xffffffff
+
+# The full hash doesn't look at the contents of blocks of zeroes,
+# only at where they are, so that holes and written zeroes hash the same.
+HASH_BLOCK_SIZE = 4096
+ZERO_BLOCK = bytes(HASH_BLOCK_SIZE)
+# The full hash is a hash of the digests of chunks this size,
+# chunks that are made of extents we've already seen needn't be read.
+HASH_CHUNK_SIZE = 1024 ** 2
+# What chunk_keys uses for holes
+HOLE_IDENT = (0, 0, 0)
+# How much of a file full_hash_from_file reads between checkpoints
+CHECKPOINT_CHUNKS = 256
+# The blocks partial dedup compares files by;
+# no extent is split by them, save for uncompressed ones.
+PARTIAL_BLOCK_SIZE = 128 * 1024
+
+# What a hashing worker gets: a path to the volume that works from another
+# process (/proc/<pid>/fd/<volume fd>), a path relative to it, and the
+# inode number and size we expect to find there.
+# known holds the chunk digests that needn't be computed, by chunk index.
+# prefetched holds the ranges the parent prefetched and wants evicted.
+HashJob = namedtuple(
+    'HashJob', 'vol_path path ino size known prefetched')
+# digest is None if the file couldn't be hashed.
+# zeroes lists the (start, end) ranges of stored zeroes worth punching,
+# chunks the digests of the chunks that were read,
+# read the number of bytes and requests that took.
+HashResult = namedtuple(
+    'HashResult', 'digest size ino zeroes chunks read')
+
+
+def mini_hash_offset(size):
+    # Also used to prefetch samples
+    return int(size * .3) // SAMPLE_SIZE * SAMPLE_SIZE
+
+
+def sample_offsets(size, samples):
+    # The first one is mini_hash_offset
+    return [
+        int(size * frac) // SAMPLE_SIZE * SAMPLE_SIZE
+        for frac in SAMPLE_FRACTIONS[:samples]]
 
 
-def mini_hash_from_file(inode, rfile):
+def mini_hash_from_file(inode, rfile, reader=None, samples=1):
     # A very cheap, very partial hash for quick disambiguation
-    # Won't help with things like zeroed or sparse files.
-    # The mini_hash for those is 0x10000001
-    rfile.seek(int(inode.size * .3))
+    # A sample is the first block past an offset that isn't zeroes,
+    # holes are skipped without being read.  Identical files that only
+    # differ by which zeroes are holes get the same mini_hash.
+    # If there's nothing but zeroes near any offset,
+    # the mini_hash is 0x10000001
+    reader = reader or Reader()
+    mini_hash = 1
+    found_any = False
+    for offset in sample_offsets(inode.size, samples):
+        found = reader.first_data_block(
+            rfile, offset, SAMPLE_SCAN, SAMPLE_SIZE)
+        if found is None:
+            mini_hash = adler32(ZERO_BLOCK[:8], mini_hash)
+            continue
+        found_any = True
+        pos, buf = found
+        mini_hash = adler32(struct.pack('<Q', pos - offset) + buf, mini_hash)
+    if not found_any:
+        return ZERO_MINI_HASH
     # bitops to make unsigned, for better readability
-    return adler32(rfile.read(4096)) & 0xffffffff
+    return mini_hash & 0xffffffff
 
 
-def fiemap_hash_from_file(rfile):
-    extents = tuple(fiemap(rfile.fileno()))
+def head_hash_from_file(rfile, reader=None):
+    # A cheap hash of how a file starts, for files of any size
+    reader = reader or Reader()
+    return adler32(reader.read_range(rfile, 0, HEAD_SIZE)) & 0xffffffff
+
+
+def fiemap_hash_from_file(rfile, charge=None):
+    extents = tuple(fiemap(rfile.fileno(), charge=charge))
     return hash(extents)
 
+
+def csum_fingerprint(volume_fd, ino, size, csum_info, reader=None):
+    # A digest of the checksums btrfs keeps for the data of a file,
+    # read from the csum tree without touching the data.
+    # Tree searches are charged to reader, if given.
+    # Identical data in the same layout of sectors has the same
+    # checksums whichever way it is split into extents.
+    # Returns None where that doesn't hold or there are no checksums:
+    # compressed, inline and preallocated extents, holes, nodatasum.
+    hasher = hashlib.sha1()
+    pos = 0
+    if reader is not None:
+        reader.charge(0)
+    for ext in file_extents(volume_fd, ino):
+        if ext.offset != pos:
+            return
+        if ext.type != btrfs_lib.BTRFS_FILE_EXTENT_REG:
+            return
+        if ext.compression != btrfs_lib.BTRFS_COMPRESS_NONE:
+            return
+        if ext.disk_bytenr == 0:
+            return
+        if reader is not None:
+            reader.charge(0)
+        csums = extent_csums(
+            volume_fd, ext.disk_bytenr + ext.extent_offset, ext.num_bytes,
+            csum_info)
+        if csums is None:
+            return
+        hasher.update(csums)
+        pos += ext.num_bytes
+    if pos < size:
+        return
+    return hasher.digest()
+
+
+def zero_runs(offset, buf):
+    # Splits a chunk found at offset into (start, end, is_zero) runs,
+    # along aligned blocks.  A partial block (the end of the file)
+    # counts as zeroes too if it is, so that it hashes like a hole.
+    end = offset + len(buf)
+    tail = end % HASH_BLOCK_SIZE
+    if (
+        offset % HASH_BLOCK_SIZE == 0 and ZERO_BLOCK not in buf
+        and not (tail and ZERO_BLOCK.startswith(buf[-tail:]))
+    ):
+        yield offset, end, False
+        return
+    run_start = pos = offset
+    run_zero = None
+    while pos < end:
+        block_end = min(pos - pos % HASH_BLOCK_SIZE + HASH_BLOCK_SIZE, end)
+        if block_end - pos == HASH_BLOCK_SIZE:
+            is_zero = buf.startswith(ZERO_BLOCK, pos - offset)
+        else:
+            is_zero = ZERO_BLOCK.startswith(
+                buf[pos - offset:block_end - offset])
+        if is_zero != run_zero:
+            if run_zero is not None:
+                yield run_start, pos, run_zero
+            run_start = pos
+            run_zero = is_zero
+        pos = block_end
+    yield run_start, end, run_zero
+
+
+class CanonicalHasher(object):
+    """Hashes file contents, treating holes as blocks of zeroes.
+
+    Blocks of zeroes are recorded by position, the other bytes
+    are hashed in order.  Together with the size,
+    that determines the contents.
+
+    Feed it data in file order; gaps are holes.  Blocks that are split
+    across updates are put back together before they are looked at,
+    the digest doesn't depend on how the reads were cut.
+
+    With punch_min, runs of zeroes that were actually stored
+    (not holes) and are at least that long are kept in zeroes.
+    """
+
+    def __init__(self, punch_min=None):
+        self._data = hashlib.sha1()
+        self._layout = hashlib.sha1()
+        self._zero_start = self._zero_end = 0
+        self._pos = 0
+        # The start of the block at _pos, up to _pos
+        self._partial = b''
+        self._punch_min = punch_min
+        self._stored_start = self._stored_end = 0
+        self.zeroes = []
+
+    def _zero(self, start, end):
+        if start == self._zero_end:
+            self._zero_end = end
+        else:
+            self._flush_zero()
+            self._zero_start, self._zero_end = start, end
+
+    def _flush_zero(self):
+        if self._zero_end > self._zero_start:
+            self._layout.update(
+                struct.pack('<QQ', self._zero_start, self._zero_end))
+
+    def _stored_zero(self, start, end):
+        if start == self._stored_end:
+            self._stored_end = end
+        else:
+            self._flush_stored_zero()
+            self._stored_start, self._stored_end = start, end
+
+    def _flush_stored_zero(self):
+        if self._stored_end - self._stored_start >= self._punch_min:
+            self.zeroes.append((self._stored_start, self._stored_end))
+        self._stored_start = self._stored_end = 0
+
+    def _blocks(self, offset, buf):
+        # Hashes blocks from offset; only the last can be partial
+        view = memoryview(buf)
+        for (start, end, is_zero) in zero_runs(offset, buf):
+            if is_zero:
+                self._zero(start, end)
+                # Only whole blocks can be punched
+                start += -start % HASH_BLOCK_SIZE
+                end -= end % HASH_BLOCK_SIZE
+                if self._punch_min and start < end:
+                    self._stored_zero(start, end)
+            else:
+                self._data.update(view[start - offset:end - offset])
+
+    def _hole(self, offset):
+        # Zeroes from _pos to offset
+        pos = self._pos
+        if self._partial:
+            block_start = pos - len(self._partial)
+            fill = min(block_start + HASH_BLOCK_SIZE, offset) - pos
+            self._partial += bytes(fill)
+            pos += fill
+            if len(self._partial) == HASH_BLOCK_SIZE:
+                self._blocks(block_start, self._partial)
+                self._partial = b''
+        aligned = offset - offset % HASH_BLOCK_SIZE
+        if aligned > pos:
+            self._zero(pos, aligned)
+            pos = aligned
+        if offset > pos:
+            # Goes with the data that comes next
+            self._partial = bytes(offset - pos)
+        self._pos = offset
+
+    def update(self, offset, buf):
+        if offset > self._pos:
+            self._hole(offset)
+        if self._partial:
+            count = min(HASH_BLOCK_SIZE - len(self._partial), len(buf))
+            self._partial += buf[:count]
+            buf = buf[count:]
+            offset += count
+            if len(self._partial) < HASH_BLOCK_SIZE:
+                self._pos = offset
+                return
+            self._blocks(offset - HASH_BLOCK_SIZE, self._partial)
+            self._partial = b''
+        # offset is aligned now, keep the end if it isn't
+        tail = (offset + len(buf)) % HASH_BLOCK_SIZE
+        if tail:
+            self._partial = buf[len(buf) - tail:]
+            buf = buf[:len(buf) - tail]
+        if buf:
+            self._blocks(offset, buf)
+        self._pos = offset + len(buf) + tail
+
+    def digest(self, size):
+        if size > self._pos:
+            self._hole(size)
+        if self._partial:
+            # The end of the file
+            self._blocks(self._pos - len(self._partial), self._partial)
+            self._partial = b''
+        self._flush_zero()
+        if self._punch_min:
+            self._flush_stored_zero()
+        hasher = hashlib.sha1(struct.pack('<Q', size))
+        hasher.update(self._data.digest())
+        hasher.update(self._layout.digest())
+        return hasher.digest()
+
+
+def chunk_count(size):
+    return (size + HASH_CHUNK_SIZE - 1) // HASH_CHUNK_SIZE
+
+
+def chunk_range(idx, size):
+    start = idx * HASH_CHUNK_SIZE
+    return start, min(start + HASH_CHUNK_SIZE, size)
+
+
+class ChunkedHasher(object):
+    """Digests each chunk of a file separately.
+
+    Chunk digests don't depend on the extent layout or on holes,
+    same as the CanonicalHasher.  Feed it data in file order.
+    """
+
+    def __init__(self, size, punch_min=None):
+        self.size = size
+        self.digests = {}
+        # Indexes of the chunks in digests, in the order they were done
+        self.finished = []
+        self._punch_min = punch_min
+        self._idx = None
+        self._hasher = None
+        self._zeroes = []
+
+    def _switch(self, idx):
+        if idx == self._idx:
+            return
+        self._finish_chunk()
+        self._idx = idx
+        # Collect every run of stored zeroes, they are joined
+        # across chunks and filtered at the end
+        self._hasher = CanonicalHasher(
+            HASH_BLOCK_SIZE if self._punch_min else None)
+
+    def _finish_chunk(self):
+        if self._hasher is None:
+            return
+        start, end = chunk_range(self._idx, self.size)
+        self.digests[self._idx] = self._hasher.digest(end - start)
+        self.finished.append(self._idx)
+        for (zstart, zend) in self._hasher.zeroes:
+            zstart += start
+            zend += start
+            if self._zeroes and self._zeroes[-1][1] == zstart:
+                self._zeroes[-1] = (self._zeroes[-1][0], zend)
+            else:
+                self._zeroes.append((zstart, zend))
+        self._hasher = None
+
+    def update(self, offset, buf):
+        while buf:
+            idx = offset // HASH_CHUNK_SIZE
+            self._switch(idx)
+            start, end = chunk_range(idx, self.size)
+            if offset >= end:
+                # Past the size we were given
+                break
+            piece = buf[:end - offset]
+            self._hasher.update(offset - start, piece)
+            offset += len(piece)
+            buf = buf[len(piece):]
+
+    def finish(self, chunks):
+        """Returns the digests of chunks (indexes), including those
+        that were only holes and never fed."""
+
+        self._finish_chunk()
+        for idx in chunks:
+            if idx not in self.digests:
+                start, end = chunk_range(idx, self.size)
+                self.digests[idx] = CanonicalHasher().digest(end - start)
+        return dict((idx, self.digests[idx]) for idx in chunks)
+
+    @property
+    def zeroes(self):
+        if not self._punch_min:
+            return []
+        return [
+            (start, end) for (start, end) in self._zeroes
+            if end - start >= self._punch_min]
+
+
+def file_digest(size, chunk_digests):
+    hasher = hashlib.sha1(struct.pack('<Q', size))
+    for idx in range(chunk_count(size)):
+        hasher.update(chunk_digests[idx])
+    return hasher.digest()
+
+
+def chunk_keys(volume_fd, ino, size, reader=None):
+    # What each chunk of a file is physically made of:
+    # the pieces of disk extents at each position in the chunk,
+    # with the generation that wrote them, which tells apart
+    # extents that reuse the same space.
+    # Chunks with the same key have the same contents.
+    # The key is None for chunks where that doesn't hold:
+    # inline data and preallocated extents.
+    # Doesn't hold for NOCOW files at all, don't call it for those.
+    # The tree search is charged to reader, if given.
+    count = chunk_count(size)
+    pieces = [[] for idx in range(count)]
+    usable = [True] * count
+
+    def add(start, end, ident, ext_pos):
+        end = min(end, size)
+        while start < end:
+            idx = start // HASH_CHUNK_SIZE
+            cstart, cend = chunk_range(idx, size)
+            cend = min(cend, end)
+            pieces[idx].append(ident + (ext_pos, start - cstart, cend - start))
+            ext_pos += cend - start
+            start = cend
+
+    def unusable(start, end):
+        end = min(end, size)
+        if start < end:
+            for idx in range(
+                start // HASH_CHUNK_SIZE, chunk_count(end)
+            ):
+                usable[idx] = False
+
+    pos = 0
+    if reader is not None:
+        reader.charge(0)
+    for ext in file_extents(volume_fd, ino):
+        if ext.offset >= size:
+            break
+        if ext.offset > pos:
+            add(pos, ext.offset, HOLE_IDENT, 0)
+        end = ext.offset + ext.num_bytes
+        if ext.type != btrfs_lib.BTRFS_FILE_EXTENT_REG:
+            unusable(ext.offset, end)
+        elif ext.disk_bytenr == 0:
+            add(ext.offset, end, HOLE_IDENT, 0)
+        else:
+            add(
+                ext.offset, end,
+                (ext.disk_bytenr, ext.disk_num_bytes, ext.generation),
+                ext.extent_offset)
+        pos = max(pos, end)
+    if pos < size:
+        add(pos, size, HOLE_IDENT, 0)
+
+    return [
+        tuple(chunk_pieces) if chunk_usable else None
+        for (chunk_pieces, chunk_usable) in zip(pieces, usable)]
+
+
+def chunk_layout(key):
+    # A short stand-in for a chunk key, to store alongside a digest
+    return hashlib.sha1(repr(key).encode('ascii')).digest()
+
+
+def hash_chunks(rfile, chunks, reader=None):
+    # Returns the digests of some chunks of a file, by index.
+    # chunks is a sorted list of indexes.
+    reader = reader or Reader()
+    size = os.fstat(rfile.fileno()).st_size
+    hasher = ChunkedHasher(size)
+    ranges = [chunk_range(idx, size) for idx in chunks]
+    for (offset, buf) in reader.iter_data(rfile, ranges):
+        hasher.update(offset, buf)
+    return hasher.finish(chunks)
+
+
+def block_digests(rfile, reader=None, block_size=PARTIAL_BLOCK_SIZE):
+    # Returns the digest of each block of a file, in order.
+    # Holes hash the same as zeroes.
+    reader = reader or Reader()
+    size = os.fstat(rfile.fileno()).st_size
+    count = (size + block_size - 1) // block_size
+    digests = {}
+    hasher = idx = None
+    for (offset, buf) in reader.iter_data(rfile):
+        while buf:
+            idx1 = offset // block_size
+            start = idx1 * block_size
+            end = min(start + block_size, size)
+            if offset >= end:
+                # Grew under us
+                break
+            if idx1 != idx:
+                if hasher is not None:
+                    digests[idx] = hasher.digest(
+                        min(block_size, size - idx * block_size))
+                hasher = CanonicalHasher()
+                idx = idx1
+            piece = buf[:end - offset]
+            hasher.update(offset - start, piece)
+            offset += len(piece)
+            buf = buf[len(piece):]
+    if hasher is not None:
+        digests[idx] = hasher.digest(min(block_size, size - idx * block_size))
+    return [
+        digests.get(idx1) or CanonicalHasher().digest(
+            min(block_size, size - idx1 * block_size))
+        for idx1 in range(count)]
+
+
+def same_block_runs(digests1, digests2, block_size, size):
+    # The (start, end) ranges where two files have the same blocks,
+    # going by block_digests
+    runs = []
+    for (idx, (digest1, digest2)) in enumerate(zip(digests1, digests2)):
+        if digest1 != digest2:
+            continue
+        start = idx * block_size
+        end = min(start + block_size, size)
+        if runs and runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], end)
+        else:
+            runs.append((start, end))
+    return runs
+
+
+def full_hash_from_file(
+    rfile, reader=None, punch_min=None, known=None, checkpoint=None,
+):
+    # Returns the digest, the size that was hashed,
+    # the ranges of stored zeroes that are at least punch_min long,
+    # and the digests of the chunks that were read, by index.
+    # known holds the digests of chunks that needn't be read.
+    # checkpoint gets called with the digests of the chunks read so far,
+    # CHECKPOINT_CHUNKS new ones at a time.
+    reader = reader or Reader()
+    known = known or {}
+    size = os.fstat(rfile.fileno()).st_size
+    missing = [idx for idx in range(chunk_count(size)) if idx not in known]
+    hasher = ChunkedHasher(size, punch_min)
+    if len(missing) == chunk_count(size):
+        ranges = None
+    else:
+        ranges = [chunk_range(idx, size) for idx in missing]
+    if missing:
+        done = 0
+        for (offset, buf) in reader.iter_data(rfile, ranges):
+            hasher.update(offset, buf)
+            if (checkpoint is not None
+                    and len(hasher.finished) - done >= CHECKPOINT_CHUNKS):
+                checkpoint(dict(
+                    (idx, hasher.digests[idx])
+                    for idx in hasher.finished[done:]))
+                done = len(hasher.finished)
+    chunks = hasher.finish(missing)
+    digests = dict(known)
+    digests.update(chunks)
+    return file_digest(size, digests), size, hasher.zeroes, chunks
+
+
+def hash_job(job, reader, punch_min=None):
+    # Runs in a worker process.
+    # The parent holds the frozen fds, we only need read access.
+    reader.stats = stats = ReadStats()
+    try:
+        fd = os.open(os.path.join(job.vol_path, job.path), os.O_RDONLY)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.EISDIR):
+            # Moved by a racing process
+            return HashResult(None, None, None, None, None, stats.totals())
+        raise
+    with os.fdopen(fd, 'rb') as rfile:
+        st = os.fstat(fd)
+        ino = st.st_ino
+        if ino != job.ino:
+            return HashResult(None, None, ino, None, None, stats.totals())
+        if job.prefetched:
+            reader.prefetched[st.st_dev, ino] = job.prefetched
+        try:
+            digest, size, zeroes, chunks = full_hash_from_file(
+                rfile, reader, punch_min, job.known)
+        except OSError as e:
+            if e.errno == errno.EIO:
+                return HashResult(
+                    None, None, ino, None, None, stats.totals())
+            raise
+    return HashResult(digest, size, ino, zeroes, chunks, stats.totals())
+
+
+def init_worker(throttle, profile, device_queues):
+    inherit(throttle)
+    devices.inherit(device_queues)
+    if profile is not None:
+        apply_profile(profile)
+
+
+class HashPool(object):
+    """Computes full hashes in worker processes.
+
+    SHA-1 is CPU-bound once the data is cached or the storage is fast,
+    and a single process won't use more than one core.
+    Workers reopen files by path and send back digests;
+    all database access stays in the parent.
+    Jobs of any number of sets can be in flight at once.
+    """
+
+    def __init__(
+        self, processes, throttle=None, profile=None, device_queues=None,
+    ):
+        self.processes = processes
+        self._pool = multiprocessing.Pool(
+            processes, initializer=init_worker,
+            initargs=(throttle, profile, device_queues))
+
+    def submit(self, job, reader, punch_min=None):
+        # Returns an AsyncResult, whose get() gives the HashResult
+        return self._pool.apply_async(hash_job, (job, reader, punch_min))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -21,17 +21,65 @@
 from alembic.migration import MigrationContext
 from alembic.operations import Operations
 from sqlalchemy import MetaData
+from sqlalchemy.types import Integer, LargeBinary
+from sqlalchemy.schema import Column, ForeignKey, ForeignKeyConstraint
 
 from .model import META
 
 
-REV = 1
+REV = 5
+
+
+def upgrade_1_to_2(op):
+    op.create_table(
+        'ChunkDigest',
+        Column('vol_id', Integer, primary_key=True),
+        Column('ino', Integer, primary_key=True),
+        Column('idx', Integer, primary_key=True),
+        Column('layout', LargeBinary, nullable=False),
+        Column('digest', LargeBinary, nullable=False),
+        ForeignKeyConstraint(
+            ['vol_id', 'ino'], ['Inode.vol_id', 'Inode.ino']))
+
+
+def upgrade_2_to_3(op):
+    op.create_table(
+        'SizeBucketStats',
+        Column(
+            'fs_id', Integer, ForeignKey('Filesystem.id'), primary_key=True),
+        Column('bucket', Integer, primary_key=True),
+        Column('groups', Integer, nullable=False),
+        Column('verified', Integer, nullable=False),
+        Column('duplicates', Integer, nullable=False),
+        Column('freed', Integer, nullable=False),
+        Column('bytes_read', Integer, nullable=False),
+        Column('reads', Integer, nullable=False))
+
+
+def upgrade_3_to_4(op):
+    op.add_column('Inode', Column('head_hash', Integer, nullable=True))
+    op.create_index('ix_Inode_head_hash', 'Inode', ['head_hash'])
+
+
+def upgrade_4_to_5(op):
+    op.add_column(
+        'DedupEvent', Column('space_gain', Integer, nullable=True))
+
+
+# By the revision they upgrade from
+UPGRADES = {
+    1: upgrade_1_to_2,
+    2: upgrade_2_to_3,
+    3: upgrade_3_to_4,
+    4: upgrade_4_to_5,
+}
 
 
 def upgrade_with_range(context, from_rev, to_rev):
-    assert from_rev == to_rev
+    assert from_rev <= to_rev
     op = Operations(context)
-    #from IPython import embed; embed()
+    for rev in range(from_rev, to_rev):
+        UPGRADES[rev](op)
 
 
 def upgrade_schema(engine):
@@ -22,9 +22,10 @@ from sqlalchemy.sql import select, func
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.types import (
-    Boolean, Integer, Text, DateTime, TypeDecorator)
+    Boolean, Integer, Text, DateTime, LargeBinary, TypeDecorator)
 from sqlalchemy.schema import (
-    Column, ForeignKey, UniqueConstraint, CheckConstraint)
+    Column, ForeignKey, ForeignKeyConstraint, UniqueConstraint,
+    CheckConstraint)
 
 from .datetime import UTC
 from .hashing import mini_hash_from_file, fiemap_hash_from_file
@@ -161,6 +162,9 @@ class Inode(Base, InodeProps):
     mini_hash = Column(Integer, index=True, nullable=True)
     # A digest of that file's FIEMAP extent info.
     fiemap_hash = Column(Integer, index=True, nullable=True)
+    # A digest of the first bytes (hashing.HEAD_SIZE), for finding
+    # files that start the same at different sizes.
+    head_hash = Column(Integer, index=True, nullable=True)
 
     # has_updates gets set whenever this inode
     # appears in the volume scan, and reset whenever we do
@@ -171,6 +175,26 @@ class Inode(Base, InodeProps):
         return 'Inode(ino=%d, volume=%d)' % (self.ino, self.vol_id)
 
 
+class ChunkDigest(Base):
+    # The digest of one chunk of an inode (hashing.HASH_CHUNK_SIZE),
+    # kept from the prefix hashing of earlier runs.
+    # layout is hashing.chunk_layout of the chunk when it was read;
+    # the digest only holds while the layout is the same.
+    vol_id = Column(Integer, primary_key=True)
+    ino = Column(Integer, primary_key=True)
+    idx = Column(Integer, primary_key=True)
+    layout = Column(LargeBinary, nullable=False)
+    digest = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['vol_id', 'ino'], ['Inode.vol_id', 'Inode.ino']), )
+
+    inode = relationship(
+        Inode, backref=backref_(
+            'chunk_digests', cascade='all, delete-orphan'))
+
+
 Volume.inode_count = column_property(
     select([func.count(Inode.ino)])
         .where(Inode.vol_id == Volume.id)
@@ -191,6 +215,9 @@ class DedupEvent(Base):
 
     item_size = Column(Integer, index=True, nullable=False)
     created = Column(UTCDateTime, index=True, nullable=False)
+    # Bytes of the extents whose last reference went away;
+    # unknown for events that were logged before it was measured.
+    space_gain = Column(Integer, nullable=True)
 
     @hybrid_property
     def estimated_space_gain(self):
@@ -219,5 +246,22 @@ DedupEvent.inode_count = column_property(
     .label('inode_count'))
 
 
+class SizeBucketStats(Base):
+    # What dedup runs read and found, by readstats.size_bucket,
+    # summed over the runs; autotuning starts from these.
+    fs_id, fs = FK(
+        BtrfsFilesystem.id, primary_key=True,
+        backref='size_bucket_stats', cascade='all, delete-orphan')
+    bucket = Column(Integer, primary_key=True)
+    # readstats.BUCKET_COUNTS
+    groups = Column(Integer, nullable=False, default=0)
+    verified = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, nullable=False, default=0)
+    freed = Column(Integer, nullable=False, default=0)
+    # Over all stages
+    bytes_read = Column(Integer, nullable=False, default=0)
+    reads = Column(Integer, nullable=False, default=0)
+
+
 META = Base.metadata
 
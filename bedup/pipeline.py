@@ -0,0 +1,289 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import queue
+import threading
+
+from .platform.time import monotonic_time
+
+
+# Marks the end of a queue
+_END = object()
+
+
+class _Origin(object):
+    # What is left to do for an item that was fed, and what to post
+    # once that is done.  Guarded by the pipeline lock.
+    __slots__ = ('pending', 'done', 'failed')
+
+    def __init__(self, done):
+        self.pending = 1
+        self.done = done
+        self.failed = False
+
+# How long the feeding thread waits on a full queue before
+# handing back results
+POLL_INTERVAL = .1
+
+
+class Stage(object):
+    """A pipeline step.
+
+    func takes an item and returns an iterable of items for the next stage.
+    discard is called on items that were queued for this stage
+    when the pipeline is aborted, it should release whatever they hold.
+    depth bounds the input queue, it defaults to the concurrency.
+    setup is called by each worker thread before it starts.
+    """
+
+    def __init__(
+        self, name, func, concurrency=1, discard=None, depth=None,
+        setup=None,
+    ):
+        if concurrency < 1:
+            raise ValueError('Stage concurrency must be positive', name)
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.discard = discard
+        self.depth = depth or concurrency
+        self.setup = setup
+
+        self.busy = 0
+        self.busy_time = 0.
+        self.processed = 0
+
+
+class Pipeline(object):
+    """Runs items through a chain of stages.
+
+    Each stage has its own worker threads and a bounded input queue,
+    so that a slow stage holds back the ones before it without leaving
+    the ones after it idle.
+
+    Workers don't return anything to the feeding thread directly;
+    they use post() and the feeding thread gets the posted records
+    from feed() and drain().  That way all database access can stay in
+    the feeding thread.
+
+    When the pipeline is left with an exception, the records that
+    weren't handed out yet are passed to apply, if given, before the
+    exception goes on; they can stand for work that is already done.
+
+    Items can be fed with a done record, which is posted once they and
+    everything the stages made of them have gone through, after the
+    records that work posted.  It isn't posted for items that were
+    discarded or whose work failed.
+    """
+
+    def __init__(self, stages, apply=None):
+        self._stages = stages
+        self._apply = apply
+        self._queues = [queue.Queue(stage.depth) for stage in stages]
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._live_workers = [stage.concurrency for stage in stages]
+        self._threads = []
+        self._error = None
+        self._started = None
+        self._draining = None
+
+    def __enter__(self):
+        self._started = monotonic_time()
+        for (idx, stage) in enumerate(self._stages):
+            for worker_idx in range(stage.concurrency):
+                thread = threading.Thread(
+                    target=self._work, args=(idx, ),
+                    name='%s-%d' % (stage.name, worker_idx))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Workers will discard what's left in the queues
+            self._fail(exc_value)
+            apply = self._apply
+            try:
+                for record in self.drain():
+                    if apply is None:
+                        continue
+                    try:
+                        apply(record)
+                    except Exception:
+                        # Whatever broke is likely to break again
+                        apply = None
+            except BaseException:
+                # Let the original exception propagate
+                pass
+        else:
+            for record in self.drain():
+                pass
+        for thread in self._threads:
+            thread.join()
+
+    def _fail(self, exn):
+        with self._lock:
+            if self._error is None:
+                self._error = exn
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def post(self, record):
+        # Thread-safe, never blocks
+        self._results.put(record)
+
+    def _pending(self):
+        while True:
+            try:
+                record = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if record is _END:
+                # Only drain() should see this
+                self._results.put(record)
+                return
+            yield record
+
+    def feed(self, item, done=None):
+        """Queues item for the first stage.
+
+        Yields the records posted in the meantime.
+        done, if given, gets posted once the item has gone through.
+        """
+
+        entry = item, _Origin(done)
+        while True:
+            self._check()
+            try:
+                self._queues[0].put(entry, timeout=POLL_INTERVAL)
+            except queue.Full:
+                for record in self._pending():
+                    yield record
+            else:
+                break
+        for record in self._pending():
+            yield record
+
+    def drain(self):
+        """Waits for all queued items to go through.
+
+        Yields the remaining records, then re-raises
+        any error that happened in a worker.
+        Calling it again picks up where the first one stopped.
+        """
+
+        if self._draining is None:
+            self._draining = self._drain()
+        return self._draining
+
+    def _drain(self):
+        for worker_idx in range(self._stages[0].concurrency):
+            self._queues[0].put(_END)
+        while True:
+            record = self._results.get()
+            if record is _END:
+                break
+            yield record
+        self._check()
+
+    def _work(self, idx):
+        stage = self._stages[idx]
+        in_queue = self._queues[idx]
+        last = idx + 1 == len(self._stages)
+        if not last:
+            out_queue = self._queues[idx + 1]
+        if stage.setup is not None:
+            try:
+                stage.setup()
+            except BaseException as exn:
+                self._fail(exn)
+
+        while True:
+            entry = in_queue.get()
+            if entry is _END:
+                break
+            item, origin = entry
+            if self._error is not None:
+                with self._lock:
+                    origin.failed = True
+                if stage.discard is not None:
+                    stage.discard(item)
+                continue
+            start = monotonic_time()
+            with self._lock:
+                stage.busy += 1
+            try:
+                for out in stage.func(item):
+                    if last:
+                        self.post(out)
+                    else:
+                        with self._lock:
+                            origin.pending += 1
+                        out_queue.put((out, origin))
+            except BaseException as exn:
+                with self._lock:
+                    origin.failed = True
+                self._fail(exn)
+            finally:
+                with self._lock:
+                    stage.busy -= 1
+                    stage.processed += 1
+                    stage.busy_time += monotonic_time() - start
+                    origin.pending -= 1
+                    finished = not origin.pending and not origin.failed
+                if finished and origin.done is not None:
+                    self.post(origin.done)
+
+        with self._lock:
+            self._live_workers[idx] -= 1
+            finished = self._live_workers[idx] == 0
+        if finished:
+            # The last worker out lets the next stage know
+            if last:
+                self._results.put(_END)
+            else:
+                for worker_idx in range(self._stages[idx + 1].concurrency):
+                    out_queue.put(_END)
+
+    def occupancy(self):
+        """A short live summary: busy workers and queued items per stage."""
+
+        with self._lock:
+            return ' '.join(
+                '%s %d/%d+%d' % (
+                    stage.name, stage.busy, stage.concurrency,
+                    self._queues[idx].qsize())
+                for (idx, stage) in enumerate(self._stages))
+
+    def utilisation(self):
+        """Yields (stage name, fraction of worker time spent busy)."""
+
+        elapsed = monotonic_time() - self._started
+        with self._lock:
+            for stage in self._stages:
+                if elapsed > 0:
+                    yield (
+                        stage.name,
+                        stage.busy_time / (elapsed * stage.concurrency))
+                else:
+                    yield stage.name, 0.
@@ -21,6 +21,7 @@
 
 
 import cffi
+import errno
 import os
 import posixpath
 import sys
@@ -39,10 +40,14 @@ ffi.cdef("""
 /* ioctl.h */
 
 #define BTRFS_IOC_TREE_SEARCH ...
+#define BTRFS_IOC_TREE_SEARCH_V2 ...
 #define BTRFS_IOC_INO_PATHS ...
 #define BTRFS_IOC_INO_LOOKUP ...
+#define BTRFS_IOC_LOGICAL_INO_V2 ...
+#define BTRFS_LOGICAL_INO_ARGS_IGNORE_OFFSET ...
 #define BTRFS_IOC_FS_INFO ...
 #define BTRFS_IOC_CLONE ...
+#define BTRFS_IOC_CLONE_RANGE ...
 #define BTRFS_IOC_DEFRAG ...
 #define BTRFS_IOC_SUBVOL_GETFLAGS ...
 #define BTRFS_IOC_SUBVOL_SETFLAGS ...
@@ -95,6 +100,14 @@ struct btrfs_ioctl_search_args {
     char buf[];
 };
 
+struct btrfs_ioctl_search_args_v2 {
+    struct btrfs_ioctl_search_key key; /* in/out - search parameters */
+    uint64_t buf_size;                 /* in - size of buffer
+                                        * out - on EOVERFLOW: needed size
+                                        *       to store item */
+    uint64_t buf[];                    /* out - found items */
+};
+
 struct btrfs_data_container {
     uint32_t    bytes_left; /* out -- bytes not needed to deliver output */
     uint32_t    bytes_missing;  /* out -- additional bytes needed for result */
@@ -111,6 +124,21 @@ struct btrfs_ioctl_ino_path_args {
     ...; // reserved/padding
 };
 
+struct btrfs_ioctl_logical_ino_args {
+    uint64_t                logical;    /* in */
+    uint64_t                size;       /* in */
+    uint64_t                flags;      /* in, v2 only */
+    /* struct btrfs_data_container  *inodes;    out   */
+    uint64_t                inodes;
+    ...; // reserved
+};
+
+struct btrfs_ioctl_clone_range_args {
+    int64_t src_fd;
+    uint64_t src_offset, src_length;
+    uint64_t dest_offset;
+};
+
 struct btrfs_ioctl_fs_info_args {
     uint64_t max_id;                /* max device id; out */
     uint64_t num_devices;           /* out */
@@ -140,9 +168,31 @@ struct btrfs_ioctl_ino_lookup_args {
 #define BTRFS_ROOT_ITEM_KEY ...
 #define BTRFS_ROOT_BACKREF_KEY ...
 
+#define BTRFS_EXTENT_CSUM_KEY ...
+
 #define BTRFS_FIRST_FREE_OBJECTID ...
 #define BTRFS_ROOT_TREE_OBJECTID ...
 #define BTRFS_FS_TREE_OBJECTID ...
+#define BTRFS_CSUM_TREE_OBJECTID ...
+#define BTRFS_EXTENT_CSUM_OBJECTID ...
+#define BTRFS_CHUNK_TREE_OBJECTID ...
+#define BTRFS_FIRST_CHUNK_TREE_OBJECTID ...
+#define BTRFS_CHUNK_ITEM_KEY ...
+
+#define BTRFS_BLOCK_GROUP_DATA ...
+#define BTRFS_BLOCK_GROUP_RAID0 ...
+#define BTRFS_BLOCK_GROUP_RAID1 ...
+#define BTRFS_BLOCK_GROUP_DUP ...
+#define BTRFS_BLOCK_GROUP_RAID10 ...
+#define BTRFS_BLOCK_GROUP_RAID5 ...
+#define BTRFS_BLOCK_GROUP_RAID6 ...
+#define BTRFS_BLOCK_GROUP_RAID1C3 ...
+#define BTRFS_BLOCK_GROUP_RAID1C4 ...
+
+#define BTRFS_FILE_EXTENT_INLINE ...
+#define BTRFS_FILE_EXTENT_REG ...
+#define BTRFS_FILE_EXTENT_PREALLOC ...
+#define BTRFS_COMPRESS_NONE ...
 
 // A root_item flag
 // Not to be confused with a similar ioctl flag with a different value
@@ -302,6 +352,25 @@ struct btrfs_disk_key {
     ...;
 };
 
+struct btrfs_stripe {
+    uint64_t devid;
+    uint64_t offset;
+    ...;
+};
+
+struct btrfs_chunk {
+    /* size of this chunk in bytes */
+    uint64_t length;
+    uint64_t stripe_len;
+    uint64_t type;
+    uint16_t num_stripes;
+    /* sub stripes only matter for raid10 */
+    uint16_t sub_stripes;
+    /* the first of num_stripes stripes */
+    struct btrfs_stripe stripe;
+    ...;
+};
+
 struct btrfs_dir_item {
     struct btrfs_disk_key location;
     uint64_t transid;
@@ -312,6 +381,15 @@ struct btrfs_dir_item {
 };
 
 uint64_t btrfs_stack_file_extent_generation(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_ram_bytes(struct btrfs_file_extent_item *s);
+uint8_t btrfs_stack_file_extent_compression(struct btrfs_file_extent_item *s);
+uint8_t btrfs_stack_file_extent_type(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_disk_bytenr(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_disk_num_bytes(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_offset(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_num_bytes(struct btrfs_file_extent_item *s);
 uint64_t btrfs_stack_inode_generation(struct btrfs_inode_item *s);
 uint64_t btrfs_stack_inode_size(struct btrfs_inode_item *s);
 uint32_t btrfs_stack_inode_mode(struct btrfs_inode_item *s);
@@ -319,6 +397,13 @@ uint64_t btrfs_stack_inode_ref_name_len(struct btrfs_inode_ref *s);
 uint16_t btrfs_stack_root_ref_name_len(struct btrfs_root_ref *s);
 uint64_t btrfs_stack_root_ref_dirid(struct btrfs_root_ref *s);
 uint16_t btrfs_stack_dir_name_len(struct btrfs_dir_item *s);
+uint64_t btrfs_stack_chunk_length(struct btrfs_chunk *s);
+uint64_t btrfs_stack_chunk_stripe_len(struct btrfs_chunk *s);
+uint64_t btrfs_stack_chunk_type(struct btrfs_chunk *s);
+uint16_t btrfs_stack_chunk_num_stripes(struct btrfs_chunk *s);
+uint16_t btrfs_stack_chunk_sub_stripes(struct btrfs_chunk *s);
+uint64_t btrfs_stack_stripe_devid(struct btrfs_stripe *s);
+struct btrfs_stripe *btrfs_stripe_nr(struct btrfs_chunk *c, int nr);
 uint64_t btrfs_root_generation(struct btrfs_root_item *s);
 """)
 
@@ -327,6 +412,23 @@ uint64_t btrfs_root_generation(struct btrfs_root_item *s);
 lib = cffi_support.verify(ffi, '''
     #include <btrfs/ioctl.h>
     #include <btrfs/ctree.h>
+
+    // Older headers, the ioctl is in Linux 3.16
+    #ifndef BTRFS_IOC_TREE_SEARCH_V2
+    struct btrfs_ioctl_search_args_v2 {
+        struct btrfs_ioctl_search_key key;
+        __u64 buf_size;
+        __u64 buf[0];
+    };
+    #define BTRFS_IOC_TREE_SEARCH_V2 _IOWR(BTRFS_IOCTL_MAGIC, 17, \\
+        struct btrfs_ioctl_search_args_v2)
+    #endif
+
+    // Older headers, the profiles are in Linux 5.5
+    #ifndef BTRFS_BLOCK_GROUP_RAID1C3
+    #define BTRFS_BLOCK_GROUP_RAID1C3 (1ULL << 9)
+    #define BTRFS_BLOCK_GROUP_RAID1C4 (1ULL << 10)
+    #endif
     ''',
     include_dirs=[cffi_support.BTRFS_INCLUDE_DIR])
 
@@ -337,6 +439,39 @@ u64_max = ffi.cast('uint64_t', -1)
 
 RootInfo = namedtuple('RootInfo', 'path parent_root_id is_frozen')
 
+# A file extent item.  offset is where it starts in the file,
+# extent_offset where the file data starts in the disk extent.
+# The disk fields are 0 for inline extents and holes.
+FileExtent = namedtuple(
+    'FileExtent',
+    'offset type compression disk_bytenr disk_num_bytes '
+    'extent_offset num_bytes ram_bytes generation')
+
+CsumInfo = namedtuple('CsumInfo', 'csum_type csum_size sectorsize nodesize')
+
+# By name in /sys/fs/btrfs/<fsid>/checksum
+CSUM_SIZES = dict(crc32c=4, xxhash64=8, sha256=32, blake2b=32)
+
+# Large enough for any item with the largest node size
+SEARCH_V2_BUFSIZE = 128 * 1024
+
+# No file extent item covers more than this
+BTRFS_MAX_EXTENT_SIZE = 128 * 1024 ** 2
+
+# A data chunk: where a range of logical addresses is stored.
+# devids has one entry per stripe, in stripe order.
+Chunk = namedtuple(
+    'Chunk', 'logical length stripe_len profile sub_stripes devids')
+
+# Profiles where every stripe holds a full copy
+MIRROR_PROFILES = (
+    lib.BTRFS_BLOCK_GROUP_RAID1 | lib.BTRFS_BLOCK_GROUP_DUP
+    | lib.BTRFS_BLOCK_GROUP_RAID1C3 | lib.BTRFS_BLOCK_GROUP_RAID1C4)
+PROFILE_MASK = (
+    MIRROR_PROFILES | lib.BTRFS_BLOCK_GROUP_RAID0
+    | lib.BTRFS_BLOCK_GROUP_RAID10 | lib.BTRFS_BLOCK_GROUP_RAID5
+    | lib.BTRFS_BLOCK_GROUP_RAID6)
+
 
 def name_of_inode_ref(ref):
     namelen = lib.btrfs_stack_inode_ref_name_len(ref)
@@ -595,6 +730,213 @@ def get_root_generation(volume_fd):
     return max_found
 
 
+def tree_search(volume_fd, tree_id, min_key, max_key):
+    """
+    Yields (search header, item pointer) for the items of a tree
+    between two (objectid, type, offset) keys.
+
+    Item pointers are only valid until the next item is requested.
+    """
+
+    args_cbuf = ffi.new(
+        'char[]',
+        ffi.sizeof('struct btrfs_ioctl_search_args_v2') + SEARCH_V2_BUFSIZE)
+    args_buffer = ffi.buffer(args_cbuf)
+    args = ffi.cast('struct btrfs_ioctl_search_args_v2 *', args_cbuf)
+    sk = args.key
+
+    sk.tree_id = tree_id
+    sk.min_objectid, sk.min_type, sk.min_offset = min_key
+    sk.max_objectid, sk.max_type, sk.max_offset = max_key
+    sk.max_transid = u64_max
+
+    while True:
+        sk.nr_items = 4096
+        args.buf_size = SEARCH_V2_BUFSIZE
+
+        ioctl_pybug(
+            volume_fd, lib.BTRFS_IOC_TREE_SEARCH_V2, args_buffer)
+        if sk.nr_items == 0:
+            break
+
+        items = ffi.cast('char *', args.buf)
+        offset = 0
+        for item_id in range(sk.nr_items):
+            sh = ffi.cast(
+                'struct btrfs_ioctl_search_header *', items + offset)
+            offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+            yield sh, sh + 1
+
+        # The key right after the last one
+        if sh.offset < u64_max:
+            sk.min_objectid, sk.min_type, sk.min_offset = (
+                sh.objectid, sh.type, sh.offset + 1)
+        elif sh.type < 255:
+            sk.min_objectid, sk.min_type, sk.min_offset = (
+                sh.objectid, sh.type + 1, 0)
+        elif sh.objectid < u64_max:
+            sk.min_objectid, sk.min_type, sk.min_offset = (
+                sh.objectid + 1, 0, 0)
+        else:
+            break
+
+
+def file_extents(volume_fd, ino):
+    """Yields the FileExtents of an inode of the subvolume, in order."""
+
+    for sh, item in tree_search(
+        volume_fd, 0,
+        (ino, lib.BTRFS_EXTENT_DATA_KEY, 0),
+        (ino, lib.BTRFS_EXTENT_DATA_KEY, u64_max),
+    ):
+        item = ffi.cast('struct btrfs_file_extent_item *', item)
+        ext_type = lib.btrfs_stack_file_extent_type(item)
+        generation = lib.btrfs_stack_file_extent_generation(item)
+        ram_bytes = lib.btrfs_stack_file_extent_ram_bytes(item)
+        compression = lib.btrfs_stack_file_extent_compression(item)
+        if ext_type == lib.BTRFS_FILE_EXTENT_INLINE:
+            # The data follows the header, the disk fields aren't there
+            yield FileExtent(
+                sh.offset, ext_type, compression, 0, 0, 0,
+                ram_bytes, ram_bytes, generation)
+            continue
+        yield FileExtent(
+            sh.offset, ext_type, compression,
+            lib.btrfs_stack_file_extent_disk_bytenr(item),
+            lib.btrfs_stack_file_extent_disk_num_bytes(item),
+            lib.btrfs_stack_file_extent_offset(item),
+            lib.btrfs_stack_file_extent_num_bytes(item),
+            ram_bytes, generation)
+
+
+def disk_address(volume_fd, ino, offset):
+    """
+    Returns the logical address on disk of a position in a file.
+
+    None if it falls in a hole or in inline data.
+    On a single device this increases with the physical offset.
+    """
+
+    found = None
+    for sh, item in tree_search(
+        volume_fd, 0,
+        (ino, lib.BTRFS_EXTENT_DATA_KEY,
+         max(0, offset - BTRFS_MAX_EXTENT_SIZE)),
+        (ino, lib.BTRFS_EXTENT_DATA_KEY, offset),
+    ):
+        item = ffi.cast('struct btrfs_file_extent_item *', item)
+        if lib.btrfs_stack_file_extent_type(item) not in (
+            lib.BTRFS_FILE_EXTENT_REG, lib.BTRFS_FILE_EXTENT_PREALLOC
+        ):
+            found = None
+            continue
+        if offset >= sh.offset + lib.btrfs_stack_file_extent_num_bytes(item):
+            found = None
+            continue
+        bytenr = lib.btrfs_stack_file_extent_disk_bytenr(item)
+        if bytenr == 0:
+            found = None
+            continue
+        if lib.btrfs_stack_file_extent_compression(item) \
+                != lib.BTRFS_COMPRESS_NONE:
+            # Offsets are within the uncompressed data
+            found = bytenr
+        else:
+            found = (
+                bytenr + lib.btrfs_stack_file_extent_offset(item)
+                + offset - sh.offset)
+    return found
+
+
+def data_chunks(volume_fd):
+    """
+    Yields the Chunks that hold file data, by logical address.
+
+    Reads the chunk tree, which requires CAP_SYS_ADMIN.
+    """
+
+    for sh, item in tree_search(
+        volume_fd, lib.BTRFS_CHUNK_TREE_OBJECTID,
+        (lib.BTRFS_FIRST_CHUNK_TREE_OBJECTID, lib.BTRFS_CHUNK_ITEM_KEY, 0),
+        (lib.BTRFS_FIRST_CHUNK_TREE_OBJECTID, lib.BTRFS_CHUNK_ITEM_KEY,
+         u64_max),
+    ):
+        chunk = ffi.cast('struct btrfs_chunk *', item)
+        chunk_type = lib.btrfs_stack_chunk_type(chunk)
+        if not chunk_type & lib.BTRFS_BLOCK_GROUP_DATA:
+            continue
+        yield Chunk(
+            logical=sh.offset,
+            length=lib.btrfs_stack_chunk_length(chunk),
+            stripe_len=lib.btrfs_stack_chunk_stripe_len(chunk),
+            profile=chunk_type & PROFILE_MASK,
+            sub_stripes=lib.btrfs_stack_chunk_sub_stripes(chunk),
+            devids=tuple(
+                lib.btrfs_stack_stripe_devid(lib.btrfs_stripe_nr(chunk, idx))
+                for idx in range(lib.btrfs_stack_chunk_num_stripes(chunk))))
+
+
+def get_csum_info(volume_fd):
+    # Kernels before 5.5 don't have the checksum file,
+    # older ones may not have the others; they only did crc32c.
+    sysfs_dir = '/sys/fs/btrfs/%s' % get_fsid(volume_fd)
+
+    def read_attr(name, default):
+        try:
+            with open(os.path.join(sysfs_dir, name)) as attr:
+                return attr.read().split()[0]
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return default
+            raise
+
+    csum_type = read_attr('checksum', 'crc32c')
+    return CsumInfo(
+        csum_type=csum_type,
+        csum_size=CSUM_SIZES[csum_type],
+        sectorsize=int(read_attr('sectorsize', 4096)),
+        nodesize=int(read_attr('nodesize', 16384)))
+
+
+def extent_csums(volume_fd, bytenr, length, csum_info):
+    """
+    Returns the data checksums of a range of logical addresses,
+    concatenated, or None if part of the range has none.
+    """
+
+    sectorsize = csum_info.sectorsize
+    csum_size = csum_info.csum_size
+    end = bytenr + length
+    # Items that cover the start of the range can start this far before it
+    lookback = csum_info.nodesize // csum_size * sectorsize
+    pos = bytenr
+    pieces = []
+
+    for sh, item in tree_search(
+        volume_fd, lib.BTRFS_CSUM_TREE_OBJECTID,
+        (lib.BTRFS_EXTENT_CSUM_OBJECTID, lib.BTRFS_EXTENT_CSUM_KEY,
+         max(0, bytenr - lookback)),
+        (lib.BTRFS_EXTENT_CSUM_OBJECTID, lib.BTRFS_EXTENT_CSUM_KEY, end - 1),
+    ):
+        item_end = sh.offset + sh.len // csum_size * sectorsize
+        if item_end <= pos:
+            continue
+        if sh.offset > pos:
+            return
+        first = (pos - sh.offset) // sectorsize
+        last = (min(item_end, end) - sh.offset) // sectorsize
+        pieces.append(ffi.buffer(
+            ffi.cast('char *', item) + first * csum_size,
+            (last - first) * csum_size)[:])
+        pos = min(item_end, end)
+        if pos >= end:
+            break
+
+    if pos < end:
+        return
+    return b''.join(pieces)
+
+
 # clone_data and defragment also have _RANGE variants
 def clone_data(dest, src, check_first):
     if check_first and same_extents(dest, src):
@@ -603,6 +945,45 @@ def clone_data(dest, src, check_first):
     return True
 
 
+def clone_range(dest, src, src_offset, length, dest_offset):
+    # Offsets and length must be block-aligned,
+    # except for a length that reaches the end of src.
+    args = ffi.new('struct btrfs_ioctl_clone_range_args *')
+    args.src_fd = src
+    args.src_offset = src_offset
+    args.src_length = length
+    args.dest_offset = dest_offset
+    ioctl_pybug(dest, lib.BTRFS_IOC_CLONE_RANGE, ffi.buffer(args))
+
+
+def extent_referenced(volume_fd, disk_bytenr):
+    """Whether any file references some of a data extent.
+
+    Freed extents may linger until the transaction commits,
+    but they aren't referenced anymore.
+    Requires root and Linux 4.15.
+    """
+
+    container_size = 4096
+    container = ffi.new('char[]', container_size)
+    args = ffi.new('struct btrfs_ioctl_logical_ino_args *')
+    args.logical = disk_bytenr
+    args.size = container_size
+    # References to any part of the extent
+    args.flags = lib.BTRFS_LOGICAL_INO_ARGS_IGNORE_OFFSET
+    args.inodes = ffi.cast('uint64_t', container)
+    try:
+        ioctl_pybug(
+            volume_fd, lib.BTRFS_IOC_LOGICAL_INO_V2, ffi.buffer(args))
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            # No extent there anymore
+            return False
+        raise
+    inodes = ffi.cast('struct btrfs_data_container *', container)
+    return bool(inodes.elem_cnt or inodes.elem_missed)
+
+
 def defragment(fd):
     # XXX Can remove compression as a side-effect
     # Also, can unshare extents.
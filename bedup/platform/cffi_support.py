@@ -47,10 +47,12 @@ def verify(ffi, source, **kwargs):
 
 def get_mods():
     from . import (
-        btrfs, chattr, fiemap, futimens, ioprio, openat, syncfs, time, unshare)
+        btrfs, chattr, dedupe, fiemap, futimens, ioprio, openat, pagecache,
+        syncfs, time, unshare)
 
     return (
-        btrfs, chattr, fiemap, futimens, ioprio, openat, syncfs, time, unshare)
+        btrfs, chattr, dedupe, fiemap, futimens, ioprio, openat, pagecache,
+        syncfs, time, unshare)
 
 
 def get_ext_modules():
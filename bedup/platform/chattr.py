@@ -26,6 +26,7 @@ __all__ = (
     'getflags',
     'editflags',
     'FS_IMMUTABLE_FL',
+    'FS_NOCOW_FL',
 )
 
 ffi = FFI()
@@ -69,6 +70,7 @@ lib = cffi_support.verify(ffi, '''
     ''')
 
 FS_IMMUTABLE_FL = lib.FS_IMMUTABLE_FL
+FS_NOCOW_FL = lib.FS_NOCOW_FL
 
 
 def getflags(fd):
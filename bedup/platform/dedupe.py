@@ -0,0 +1,143 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+from cffi import FFI
+import fcntl
+
+from . import cffi_support
+
+
+ffi = FFI()
+ffi.cdef('''
+// Linux 4.5, formerly BTRFS_IOC_FILE_EXTENT_SAME
+#define FIDEDUPERANGE ...
+
+#define FILE_DEDUPE_RANGE_SAME ...
+#define FILE_DEDUPE_RANGE_DIFFERS ...
+
+struct file_dedupe_range_info {
+    int64_t dest_fd;        /* in - destination file */
+    uint64_t dest_offset;   /* in - start of extent in destination */
+    uint64_t bytes_deduped; /* out - total # of bytes we were able
+                             * to dedupe from this file. */
+    /* status of this dedupe operation:
+     * < 0 for error
+     * == FILE_DEDUPE_RANGE_SAME if dedupe succeeds
+     * == FILE_DEDUPE_RANGE_DIFFERS if data differs
+     */
+    int32_t status;         /* out - see above description */
+    ...;
+};
+
+struct file_dedupe_range {
+    uint64_t src_offset;
+    uint64_t src_length;
+    uint16_t dest_count;    /* in - total elements in info array */
+    struct file_dedupe_range_info info[0];
+    ...;
+};
+''')
+
+lib = cffi_support.verify(ffi, '''
+#include <inttypes.h>
+#include <linux/fs.h>
+''')
+
+
+# The kernel won't take more than a page of arguments
+MAX_DESTS = (
+    (4096 - ffi.sizeof('struct file_dedupe_range'))
+    // ffi.sizeof('struct file_dedupe_range_info'))
+# btrfs dedupes at most this much per destination and call
+CHUNK_SIZE = 16 * 1024 ** 2
+
+SAME = lib.FILE_DEDUPE_RANGE_SAME
+DIFFERS = lib.FILE_DEDUPE_RANGE_DIFFERS
+
+
+def dedupe_range(src, src_offset, length, dests):
+    """
+    Shares a range of src with ranges of the same length in dests,
+    where the kernel finds the data is the same.
+
+    dests is a list of (fd, offset), at most MAX_DESTS of them.
+    Returns a (status, bytes_deduped) pair per destination;
+    status is SAME, DIFFERS, or a negated errno.
+    """
+
+    assert 0 < len(dests) <= MAX_DESTS
+    args_cbuf = ffi.new(
+        'char[]',
+        ffi.sizeof('struct file_dedupe_range')
+        + len(dests) * ffi.sizeof('struct file_dedupe_range_info'))
+    args = ffi.cast('struct file_dedupe_range *', args_cbuf)
+    args.src_offset = src_offset
+    args.src_length = length
+    args.dest_count = len(dests)
+    for (i, (fd, offset)) in enumerate(dests):
+        args.info[i].dest_fd = fd
+        args.info[i].dest_offset = offset
+    fcntl.ioctl(src, lib.FIDEDUPERANGE, ffi.buffer(args_cbuf))
+    return [
+        (args.info[i].status, args.info[i].bytes_deduped)
+        for i in range(len(dests))]
+
+
+def dedupe_files(src, dests, size, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Shares the first size bytes of src with each of dests.
+
+    Goes a chunk at a time, with as many destinations per call as fit.
+    A destination that differs or fails is left alone from then on;
+    the chunks that went before remain shared.
+    progress, if given, is called with the bytes deduped after each call.
+    Returns (status, deduped) for each destination, by fd:
+    status is SAME if it was deduped all the way, DIFFERS, or a negated
+    errno, deduped the number of bytes that got shared either way.
+    """
+
+    status = dict.fromkeys(dests, SAME)
+    shared = dict.fromkeys(dests, 0)
+    offset = 0
+    while offset < size:
+        length = min(chunk_size, size - offset)
+        live = [fd for fd in dests if status[fd] == SAME]
+        if not live:
+            break
+        for start in range(0, len(live), MAX_DESTS):
+            batch = live[start:start + MAX_DESTS]
+            results = dedupe_range(
+                src, offset, length, [(fd, offset) for fd in batch])
+            for (fd, (status1, deduped)) in zip(batch, results):
+                # Callers that get less than they asked for
+                # are expected to ask again for the rest
+                while status1 == SAME and deduped < length:
+                    (status1, deduped1), = dedupe_range(
+                        src, offset + deduped, length - deduped,
+                        [(fd, offset + deduped)])
+                    if status1 == SAME and not deduped1:
+                        # No progress, don't spin
+                        status1 = DIFFERS
+                    deduped += deduped1
+                status[fd] = status1
+                shared[fd] += deduped
+                if progress is not None and deduped:
+                    progress(deduped)
+        offset += length
+    return dict((fd, (status[fd], shared[fd])) for fd in dests)
@@ -90,9 +90,13 @@ lib = cffi_support.verify(ffi, '''
 FiemapExtent = namedtuple('FiemapExtent', 'logical physical length flags')
 
 
-def fiemap(fd):
+def fiemap(fd, start=0, length=None, charge=None):
     """
     Gets a map of file extents.
+
+    With length, only the extents that overlap [start, start + length).
+    charge, if given, is called with 0 before each ioctl,
+    like for other metadata requests (see reader.Reader.charge).
     """
 
     count = 72
@@ -103,10 +107,18 @@ def fiemap(fd):
     fiemap_pybuf = ffi.buffer(fiemap_cbuf)
     fiemap_ptr = ffi.cast('struct fiemap*', fiemap_cbuf)
     assert ffi.sizeof(fiemap_cbuf) <= 4096
+    fiemap_ptr.fm_start = start
 
     while True:
-        fiemap_ptr.fm_length = lib.FIEMAP_MAX_OFFSET
+        if length is None:
+            fiemap_ptr.fm_length = lib.FIEMAP_MAX_OFFSET
+        elif fiemap_ptr.fm_start >= start + length:
+            break
+        else:
+            fiemap_ptr.fm_length = start + length - fiemap_ptr.fm_start
         fiemap_ptr.fm_extent_count = count
+        if charge is not None:
+            charge(0)
         fcntl.ioctl(fd, lib.FS_IOC_FIEMAP, fiemap_pybuf)
         if fiemap_ptr.fm_mapped_extents == 0:
             break
@@ -118,6 +130,81 @@ def fiemap(fd):
         fiemap_ptr.fm_start = extent.fe_logical + extent.fe_length
 
 
+def has_delalloc(fd, charge=None):
+    """
+    Whether a file has data that wasn't written back yet.
+    """
+
+    return any(
+        extent.flags & lib.FIEMAP_EXTENT_DELALLOC
+        for extent in fiemap(fd, charge=charge))
+
+
 def same_extents(fd1, fd2):
     return tuple(fiemap(fd1)) == tuple(fiemap(fd2))
 
+
+def shared_bytes(fd, charge=None):
+    """
+    How many bytes of a file are in extents shared with other files
+    (or with other places in the same file).
+    """
+
+    return sum(
+        extent.length for extent in fiemap(fd, charge=charge)
+        if extent.flags & lib.FIEMAP_EXTENT_SHARED)
+
+
+def unshared_bytes(extents, start, end):
+    """
+    How many bytes from start to end are in extents that aren't shared,
+    going by a list of extents.
+
+    Sharing that range with another file frees about this much;
+    extents that are shared stay referenced (by snapshots, say).
+    """
+
+    return sum(
+        length for (logical, physical, length) in extents_in_range(
+            [extent for extent in extents
+             if not extent.flags & lib.FIEMAP_EXTENT_SHARED],
+            start, end))
+
+
+def extents_in_range(extents, start, end):
+    """
+    Clips a list of extents to the range from start to end.
+
+    Returns a (logical, physical, length) triple per piece.
+    """
+
+    clipped = []
+    for extent in extents:
+        ext_end = extent.logical + extent.length
+        if ext_end <= start or extent.logical >= end:
+            continue
+        lstart = max(start, extent.logical)
+        clipped.append((
+            lstart, extent.physical + lstart - extent.logical,
+            min(end, ext_end) - lstart))
+    return clipped
+
+
+def shared_prefix(extents1, extents2):
+    """
+    How many bytes two files share from their start,
+    going by their lists of extents.
+    """
+
+    length = 0
+    for (ext1, ext2) in zip(extents1, extents2):
+        if ext1.logical != length or ext2.logical != length:
+            # A hole
+            break
+        if not ext1.physical or ext1.physical != ext2.physical:
+            break
+        length += min(ext1.length, ext2.length)
+        if ext1.length != ext2.length:
+            break
+    return length
+
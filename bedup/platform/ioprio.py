@@ -41,6 +41,8 @@ int ioprio_set(int which, int who, int ioprio);
 int IOPRIO_PRIO_VALUE(int class, int data);
 int IOPRIO_PRIO_CLASS(int mask);
 int IOPRIO_PRIO_DATA(int mask);
+
+int gettid_(void);
 ''')
 
 # Parts nabbed from schedutils/ionice.c
@@ -76,19 +78,63 @@ static inline int ioprio_set(int which, int who, int ioprio) {
 static inline int ioprio_get(int which, int who) {
     return syscall(SYS_ioprio_get, which, who);
 }
+
+// glibc only has a wrapper since 2.30
+static inline int gettid_(void) {
+    return syscall(SYS_gettid);
+}
 ''')
 
 
-def set_idle_priority(pid=None):
+IOPRIO_CLASS_BE = lib.IOPRIO_CLASS_BE
+IOPRIO_CLASS_IDLE = lib.IOPRIO_CLASS_IDLE
+
+
+def gettid():
+    """
+    Returns the kernel id of the calling thread,
+    which can be passed as a pid to act on that thread only.
     """
-    Puts a process in the idle io priority class.
+
+    return lib.gettid_()
+
+
+def set_io_priority(ioclass, level=0, pid=None):
+    """
+    Puts a process in an io priority class, at a level within that class
+    (0 to 7, lower goes first; the idle class has no levels).
 
     If pid is omitted, applies to the current process.
+    Threads only pick this up when they are created;
+    pass their ids to change running threads.
     """
 
     if pid is None:
         pid = os.getpid()
     lib.ioprio_set(
         lib.IOPRIO_WHO_PROCESS, pid,
-        lib.IOPRIO_PRIO_VALUE(lib.IOPRIO_CLASS_IDLE, 0))
+        lib.IOPRIO_PRIO_VALUE(ioclass, level))
+
+
+def get_io_priority(pid=None):
+    """
+    Returns the io priority class and level of a process.
+
+    If pid is omitted, applies to the current process.
+    """
+
+    if pid is None:
+        pid = os.getpid()
+    prio = lib.ioprio_get(lib.IOPRIO_WHO_PROCESS, pid)
+    return lib.IOPRIO_PRIO_CLASS(prio), lib.IOPRIO_PRIO_DATA(prio)
+
+
+def set_idle_priority(pid=None):
+    """
+    Puts a process in the idle io priority class.
+
+    If pid is omitted, applies to the current process.
+    """
+
+    set_io_priority(lib.IOPRIO_CLASS_IDLE, 0, pid)
 
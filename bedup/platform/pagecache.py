@@ -0,0 +1,131 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+from cffi import FFI
+import os
+
+from . import cffi_support
+
+
+__all__ = (
+    'fadvise',
+    'resident_ranges',
+    'POSIX_FADV_NORMAL',
+    'POSIX_FADV_RANDOM',
+    'POSIX_FADV_SEQUENTIAL',
+    'POSIX_FADV_WILLNEED',
+    'POSIX_FADV_DONTNEED',
+)
+
+ffi = FFI()
+ffi.cdef('''
+#define POSIX_FADV_NORMAL ...
+#define POSIX_FADV_RANDOM ...
+#define POSIX_FADV_SEQUENTIAL ...
+#define POSIX_FADV_WILLNEED ...
+#define POSIX_FADV_DONTNEED ...
+
+// off_t and off64_t are long with _FILE_OFFSET_BITS=64 on LP64
+int posix_fadvise(int fd, long offset, long len, int advice);
+
+int bedup_mincore(int fd, long offset, size_t length, unsigned char *vec);
+''')
+lib = cffi_support.verify(ffi, '''
+#include <errno.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+
+// mincore works on mappings; map the range just long enough to ask
+int bedup_mincore(int fd, long offset, size_t length, unsigned char *vec) {
+    void *addr = mmap(NULL, length, PROT_READ, MAP_SHARED, fd, offset);
+    int rv, saved_errno;
+    if (addr == MAP_FAILED)
+        return -1;
+    rv = mincore(addr, length, vec);
+    saved_errno = errno;
+    munmap(addr, length);
+    errno = saved_errno;
+    return rv;
+}
+''',
+    extra_compile_args=['-D_GNU_SOURCE', '-D_FILE_OFFSET_BITS=64'])
+
+POSIX_FADV_NORMAL = lib.POSIX_FADV_NORMAL
+POSIX_FADV_RANDOM = lib.POSIX_FADV_RANDOM
+POSIX_FADV_SEQUENTIAL = lib.POSIX_FADV_SEQUENTIAL
+POSIX_FADV_WILLNEED = lib.POSIX_FADV_WILLNEED
+POSIX_FADV_DONTNEED = lib.POSIX_FADV_DONTNEED
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+# Keeps the mincore vector small
+MINCORE_WINDOW = 64 * 1024 ** 2
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Gives the kernel a hint about how a range of a file will be accessed.
+
+    A length of 0 means until the end of the file.
+    """
+
+    # Returns the error number rather than setting errno
+    rv = lib.posix_fadvise(fd, offset, length, advice)
+    if rv != 0:
+        raise IOError(rv, os.strerror(rv), (fd, offset, length, advice))
+
+
+def resident_ranges(fd, offset, length):
+    """
+    Yields the (start, end) byte ranges of a file that are in the page cache.
+
+    Ranges are page-aligned, the first one may start before offset.
+    """
+
+    pos = offset - offset % PAGE_SIZE
+    end = offset + length
+    vec = ffi.new('unsigned char[]', MINCORE_WINDOW // PAGE_SIZE)
+    run_start = None
+
+    while pos < end:
+        window = min(MINCORE_WINDOW, end - pos)
+        if lib.bedup_mincore(fd, pos, window, vec) != 0:
+            raise IOError(
+                ffi.errno, os.strerror(ffi.errno), (fd, pos, window))
+        pages = (window + PAGE_SIZE - 1) // PAGE_SIZE
+        # Only the low bit is defined
+        flags = bytes(ffi.buffer(vec, pages)).translate(_LOW_BIT)
+        idx = 0
+        while idx < pages:
+            if run_start is None:
+                idx = flags.find(b'\x01', idx)
+                if idx < 0:
+                    break
+                run_start = pos + idx * PAGE_SIZE
+            else:
+                idx = flags.find(b'\x00', idx)
+                if idx < 0:
+                    break
+                yield run_start, pos + idx * PAGE_SIZE
+                run_start = None
+        pos += pages * PAGE_SIZE
+
+    if run_start is not None:
+        yield run_start, pos
+
+
+_LOW_BIT = bytes(val & 1 for val in range(256))
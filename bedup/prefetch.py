@@ -0,0 +1,146 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import threading
+
+from .platform.openat import openat
+
+from .hashing import mini_hash_offset, SAMPLE_SIZE
+
+
+# How much of the start of each candidate of a set that passed
+# sampling gets prefetched, that's where prefix and full hashes
+# start reading.
+HEAD_SIZE = 1024 ** 2
+
+
+class Prefetcher(object):
+    """Warms the page cache for size groups that are queued for sampling.
+
+    While earlier groups are still being verified, this hints the kernel
+    (POSIX_FADV_WILLNEED, which starts asynchronous readahead) about the
+    sample offsets of every candidate in upcoming groups, so that
+    rotational disks can seek while we are busy elsewhere.
+    Sets that pass sampling get the start of their files hinted too;
+    most candidates don't, and reading their heads would be wasted.
+
+    Hinted bytes count against a budget until they are released:
+    samples once their group has been sampled, heads once their set
+    is past the extents check.  That way prefetching doesn't
+    run far enough ahead to evict its own work.
+
+    Hints go through the reader, which keeps track of what they bring
+    in when it drops caches.
+    """
+
+    def __init__(self, budget, reader, head_size=HEAD_SIZE):
+        self._budget = budget
+        self._reader = reader
+        self._head_size = head_size
+        self._cond = threading.Condition()
+        # (group or set, whether to hint heads)
+        self._pending = collections.deque()
+        # Bytes hinted for each item that hasn't been released yet
+        self._hinted = {}
+        self._outstanding = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, group):
+        # Samples of a size group
+        with self._cond:
+            self._pending.append((group, False))
+            self._cond.notify_all()
+
+    def submit_heads(self, dupset):
+        # Heads of a set that passed sampling; it is further along
+        # than the groups that wait, it goes first
+        with self._cond:
+            self._pending.appendleft((dupset, True))
+            self._cond.notify_all()
+
+    def release(self, item):
+        # Called once a group has been sampled, or once a set
+        # is past the extents check or has been dropped
+        with self._cond:
+            for entry in self._pending:
+                if entry[0] is item:
+                    self._pending.remove(entry)
+                    break
+            self._outstanding -= self._hinted.pop(id(item), 0)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                item, heads = self._pending.popleft()
+                self._hinted[id(item)] = 0
+
+            for cand in item.candidates:
+                if heads:
+                    cost = min(cand.size, self._head_size)
+                else:
+                    cost = min(cand.size, SAMPLE_SIZE)
+                with self._cond:
+                    while (
+                        self._outstanding
+                        and self._outstanding + cost > self._budget
+                        and id(item) in self._hinted
+                        and not self._closed
+                    ):
+                        self._cond.wait()
+                    if id(item) not in self._hinted or self._closed:
+                        # Already done with, prefetching would be useless
+                        break
+                    self._outstanding += cost
+                    self._hinted[id(item)] += cost
+                self._hint(cand, heads)
+
+    def _hint(self, cand, heads):
+        # Best effort, errors will be dealt with by the pipeline stages
+        try:
+            path = cand.vol.lookup_one_path(cand)
+            fd = openat(cand.vol.fd, path, os.O_RDONLY)
+        except (IOError, OSError):
+            return
+        try:
+            if heads:
+                self._reader.willneed(
+                    fd, 0, min(cand.size, self._head_size))
+            else:
+                self._reader.willneed(
+                    fd, mini_hash_offset(cand.size), SAMPLE_SIZE)
+        except (IOError, OSError):
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,149 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import multiprocessing
+import os
+import threading
+
+from .platform.ioprio import (
+    get_io_priority, set_io_priority, IOPRIO_CLASS_IDLE)
+
+
+# Seconds between two readings
+POLL_INTERVAL = 1.
+# The delay per read request when pressure is right below the pause
+# threshold; it is scaled down to 0 at the slow-down threshold.
+MAX_DELAY = .1
+
+
+def read_pressure(path):
+    """Returns the share of time some tasks were stalled, in percent,
+    over the last ten seconds.
+
+    path is a PSI file, like /proc/pressure/io or a cgroup's io.pressure.
+    None if the kernel doesn't track pressure there.
+    """
+
+    try:
+        with open(path) as pfile:
+            for line in pfile:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        key, value = field.split('=', 1)
+                        if key == 'avg10':
+                            return float(value)
+    except (IOError, OSError) as e:
+        # ENOENT without CONFIG_PSI, EOPNOTSUPP when it's disabled
+        if e.errno in (errno.ENOENT, errno.EOPNOTSUPP):
+            return
+        raise
+
+
+def pressure_paths(cgroup=None):
+    if cgroup is None:
+        return ['/proc/pressure/io', '/proc/pressure/memory']
+    return [
+        os.path.join(cgroup, 'io.pressure'),
+        os.path.join(cgroup, 'memory.pressure')]
+
+
+class PressureMonitor(threading.Thread):
+    """Makes bedup back off while the system is under IO or memory
+    pressure.
+
+    Above slow_above percent of stalled time, reads and clones get
+    delayed and bedup drops to the idle IO class.  Above pause_above,
+    new work waits until pressure falls below slow_above again.
+    Below slow_above, work goes at full speed, and each thread gets
+    back the IO priority it had before (see profiles).
+
+    Check available() before starting it.
+    """
+
+    def __init__(self, throttle, slow_above, pause_above, cgroup=None):
+        super(PressureMonitor, self).__init__(name='pressure')
+        self.daemon = True
+        self.throttle = throttle
+        self.slow_above = slow_above
+        self.pause_above = max(pause_above, slow_above)
+        self.paths = pressure_paths(cgroup)
+        self.paused = False
+        # IO priorities from before backing off, by thread or process id
+        self.saved = None
+        self._quit = threading.Event()
+
+    def available(self):
+        # Without PSI, there is nothing to go by
+        return read_pressure(self.paths[0]) is not None
+
+    def stall(self):
+        readings = [read_pressure(path) for path in self.paths]
+        readings = [reading for reading in readings if reading is not None]
+        if not readings:
+            return 0.
+        return max(readings)
+
+    def run(self):
+        while not self._quit.is_set():
+            self.adjust(self.stall())
+            self._quit.wait(POLL_INTERVAL)
+
+    def adjust(self, stall):
+        if stall < self.slow_above:
+            self.paused = False
+            self.throttle.back_off()
+            self.restore_priority()
+            return
+        self.paused = self.paused or stall >= self.pause_above
+        span = self.pause_above - self.slow_above
+        if span > 0:
+            delay = MAX_DELAY * min(1., (stall - self.slow_above) / span)
+        else:
+            delay = MAX_DELAY
+        self.throttle.back_off(delay, self.paused)
+        self.lower_priority()
+
+    def lower_priority(self):
+        # Per thread, and the workers are already running.
+        # Threads that started since the last reading get lowered too.
+        if self.saved is None:
+            self.saved = {}
+        ids = [int(tid) for tid in os.listdir('/proc/self/task')]
+        ids.extend(child.pid for child in multiprocessing.active_children())
+        for tid in ids:
+            if tid in self.saved:
+                continue
+            self.saved[tid] = get_io_priority(tid)
+            set_io_priority(IOPRIO_CLASS_IDLE, 0, tid)
+
+    def restore_priority(self):
+        if self.saved is None:
+            return
+        for (tid, (ioclass, level)) in self.saved.items():
+            # Fails quietly for threads that are gone
+            set_io_priority(ioclass, level, tid)
+        self.saved = None
+
+    def close(self):
+        self._quit.set()
+        self.join()
+        self.throttle.back_off()
+        self.restore_priority()
@@ -0,0 +1,95 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .platform.ioprio import (
+    get_io_priority, gettid, set_io_priority,
+    IOPRIO_CLASS_BE, IOPRIO_CLASS_IDLE)
+
+
+# How a phase of the work gets scheduled.
+# level is the best-effort level (0-7), nice the CPU niceness,
+# cgroup a threaded cgroup v2 directory (for io.weight and friends).
+# None leaves a setting alone.
+Profile = namedtuple('Profile', 'ioclass level nice cgroup')
+
+IO_CLASSES = dict(be=IOPRIO_CLASS_BE, idle=IOPRIO_CLASS_IDLE)
+
+
+def parse_profile(spec):
+    """Parses CLASS[,level=N][,nice=N][,cgroup=DIR] into a Profile.
+
+    Raises ValueError.
+    """
+
+    fields = spec.split(',')
+    if fields[0] not in IO_CLASSES:
+        raise ValueError(
+            'IO class must be one of %s' % ', '.join(sorted(IO_CLASSES)))
+    settings = dict(level=None, nice=None, cgroup=None)
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if not sep or key not in settings:
+            raise ValueError('Unknown setting %r' % field)
+        if key == 'cgroup':
+            settings[key] = value
+            continue
+        settings[key] = int(value)
+    if settings['level'] is not None and not 0 <= settings['level'] <= 7:
+        raise ValueError('Level must be between 0 and 7')
+    return Profile(IO_CLASSES[fields[0]], **settings)
+
+
+def apply_profile(profile):
+    """Schedules the calling thread according to profile."""
+
+    # Niceness and io priorities are per thread
+    tid = gettid()
+    set_io_priority(profile.ioclass, profile.level or 0, tid)
+    if profile.nice is not None:
+        os.setpriority(os.PRIO_PROCESS, tid, profile.nice)
+    if profile.cgroup is not None:
+        with open(os.path.join(profile.cgroup, 'cgroup.threads'), 'w') as cg:
+            cg.write('%d\n' % tid)
+
+
+@contextmanager
+def phase_profile(profile):
+    """Schedules the calling thread according to profile,
+    for the duration of the block.  profile may be None.
+
+    Cgroup placement isn't undone.
+    """
+
+    if profile is None:
+        yield
+        return
+    tid = gettid()
+    ioclass, level = get_io_priority(tid)
+    nice = os.getpriority(os.PRIO_PROCESS, tid)
+    apply_profile(profile)
+    try:
+        yield
+    finally:
+        set_io_priority(ioclass, level, tid)
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
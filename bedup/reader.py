@@ -0,0 +1,466 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import mmap
+import os
+import threading
+
+from contextlib import ExitStack
+
+from .platform.pagecache import (
+    fadvise, resident_ranges, POSIX_FADV_DONTNEED, POSIX_FADV_RANDOM,
+    POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED)
+from . import devices as devices_
+from . import throttle as throttle_
+
+
+# Large enough that the per-chunk bookkeeping is negligible
+CHUNK_SIZE = 1024 ** 2
+# O_DIRECT requests go straight to the device, make them big
+DIRECT_IO_SIZE = 8 * 1024 ** 2
+
+
+class Reader(object):
+    """Reads file contents on behalf of the sampling, hashing
+    and comparison stages.
+
+    With drop_cache, pages that weren't cached before a read are
+    evicted after it, so that a pass over a large volume doesn't push
+    everyone else's working set out of the page cache.
+    Pages that were already cached are left alone, unless we are the
+    ones who prefetched them (see willneed).
+
+    With direct_io, full reads bypass the page cache entirely.
+    The kernel can refuse O_DIRECT for some files, and the tail of a
+    file isn't aligned; those parts are read the usual way.
+
+    Reads go through pread; seeking for holes moves the file offset
+    under the file objects we are given.
+
+    With a throttle, every read waits its turn under the rate limits.
+    With stats (a readstats.ReadStats), reads are accounted for.
+    With device_queues (a devices.DeviceQueues), every read waits
+    for a slot on each device it goes to.
+
+    Readers are pickled along with hashing jobs, keep them to
+    plain attributes.  The throttle and device queues are shared
+    memory and don't travel that way; hashing workers get theirs
+    when they start.
+    Workers keep their own stats, and are told what was prefetched
+    for the file they hash.
+    """
+
+    def __init__(
+        self, drop_cache=False, direct_io=False, throttle=None, stats=None,
+        device_queues=None,
+    ):
+        self.drop_cache = drop_cache
+        self.direct_io = direct_io
+        self.throttle = throttle
+        self.stats = stats
+        self.device_queues = device_queues
+        # Ranges that willneed brought into the cache and that haven't
+        # been read yet, by stat identifier; sorted, without overlaps
+        self.prefetched = {}
+        self._prefetched_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['throttle'] = None
+        state['stats'] = None
+        state['device_queues'] = None
+        state['prefetched'] = {}
+        del state['_prefetched_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.throttle = throttle_.inherited
+        self.device_queues = devices_.inherited
+        self._prefetched_lock = threading.Lock()
+
+    def charge(self, nbytes):
+        # Accounts for a request, nbytes is 0 for metadata
+        if self.throttle is not None:
+            self.throttle.charge(nbytes)
+        if self.stats is not None:
+            self.stats.add(nbytes)
+
+    def willneed(self, fd, offset, length):
+        """Starts reading a range of a file into the page cache.
+
+        With drop_cache, the pages this brings in are remembered,
+        and get evicted once read like those of any other read.
+        """
+
+        if self.drop_cache:
+            resident = list(resident_ranges(fd, offset, length))
+            missing = list(subtract_ranges(
+                [(offset, offset + length)], resident))
+            if missing:
+                st = os.fstat(fd)
+                key = st.st_dev, st.st_ino
+                with self._prefetched_lock:
+                    self.prefetched[key] = merge_ranges(
+                        sorted(self.prefetched.get(key, []) + missing))
+        fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+
+    def take_prefetched(self, fd, start, end):
+        """Returns the prefetched ranges of a file within [start, end).
+
+        They are forgotten, whoever takes them is expected to read
+        and evict them.
+        """
+
+        if not self.prefetched:
+            return []
+        st = os.fstat(fd)
+        key = st.st_dev, st.st_ino
+        with self._prefetched_lock:
+            ranges = self.prefetched.pop(key, None)
+            if ranges is None:
+                return []
+            taken = list(intersect_ranges(ranges, [(start, end)]))
+            rest = list(subtract_ranges(ranges, [(start, end)]))
+            if rest:
+                self.prefetched[key] = rest
+        return taken
+
+    def _cached(self, fd, start, end):
+        # The ranges that were cached before we had anything to do
+        # with them
+        return list(subtract_ranges(
+            list(resident_ranges(fd, start, end - start)),
+            self.take_prefetched(fd, start, end)))
+
+    def read_range(self, rfile, offset, length):
+        fd = rfile.fileno()
+        self.charge(length)
+        if self.drop_cache:
+            cached = self._cached(fd, offset, offset + length)
+            if not cached:
+                # Readahead would cache more than we are going to drop
+                fadvise(fd, offset, length, POSIX_FADV_RANDOM)
+        with self._device_slots(fd, offset, length):
+            buf = os.pread(fd, length, offset)
+        if self.drop_cache:
+            # Only what wasn't cached, a cached page doesn't
+            # make the whole range ours to keep
+            self._drop(fd, offset, offset + length, cached)
+        return buf
+
+    def first_data_block(self, rfile, start, limit, blocksize):
+        """Finds the first block at or after start that isn't all zeroes.
+
+        Holes are skipped without reading them.
+        Returns (offset, block), or None if there is no such block
+        before start + limit.
+        """
+
+        fd = rfile.fileno()
+        zeroes = bytes(blocksize)
+        pos = start
+        while pos < start + limit:
+            pos = seek_data(fd, pos)
+            if pos is None or pos >= start + limit:
+                return
+            buf = self.read_range(rfile, pos, blocksize)
+            if not buf:
+                return
+            if not zeroes.startswith(buf):
+                return pos, buf
+            pos += len(buf)
+
+    def iter_chunks(self, rfile):
+        """Yields the contents of a file from the start, in chunks.
+
+        Chunk sizes vary, don't count on them lining up across files.
+        """
+
+        size = os.fstat(rfile.fileno()).st_size
+        chunks = self._iter_ranges(rfile, [(0, size)])
+        try:
+            for (offset, buf) in chunks:
+                yield buf
+        finally:
+            chunks.close()
+
+    def iter_data(self, rfile, ranges=None):
+        """Yields (offset, chunk) for the data regions of a file.
+
+        Holes aren't read.  Data regions may still contain zeroes.
+        ranges, a sorted list of (start, end), restricts what is read.
+        """
+
+        data = list(data_ranges(rfile.fileno()))
+        if ranges is not None:
+            data = list(intersect_ranges(data, ranges))
+        return self._iter_ranges(rfile, data)
+
+    def _iter_ranges(self, rfile, ranges):
+        fd = rfile.fileno()
+        if self.drop_cache:
+            # Take a picture before reading anything; readahead
+            # will make the next chunk look cached when it isn't.
+            cached = self._cached(fd, 0, os.fstat(fd).st_size)
+        extents = None
+        if self.device_queues is not None:
+            # One FIEMAP for the whole file
+            extents = self.device_queues.extents(fd, self.charge)
+        dfd = None
+        if self.direct_io:
+            dfd = open_direct(fd)
+        if dfd is not None:
+            # Anonymous mappings are page-aligned
+            dbuf = mmap.mmap(-1, DIRECT_IO_SIZE)
+            view = memoryview(dbuf)
+
+        try:
+            for (start, end) in ranges:
+                pos = start
+                if dfd is not None and start % mmap.PAGESIZE == 0:
+                    aligned_end = end - end % mmap.PAGESIZE
+                    while pos < aligned_end:
+                        length = min(DIRECT_IO_SIZE, aligned_end - pos)
+                        self.charge(length)
+                        with self._device_slots(fd, pos, length, extents):
+                            buf = read_direct(dfd, view, pos, length)
+                        if not buf:
+                            break
+                        yield pos, buf
+                        pos += len(buf)
+                    if pos < aligned_end:
+                        # Not for this file after all
+                        view.release()
+                        dbuf.close()
+                        os.close(dfd)
+                        dfd = None
+                if pos < end:
+                    fadvise(fd, pos, end - pos, POSIX_FADV_SEQUENTIAL)
+                while pos < end:
+                    length = min(CHUNK_SIZE, end - pos)
+                    self.charge(length)
+                    with self._device_slots(fd, pos, length, extents):
+                        buf = os.pread(fd, length, pos)
+                    if not buf:
+                        # Truncated under us
+                        break
+                    yield pos, buf
+                    if self.drop_cache:
+                        self._drop(fd, pos, pos + len(buf), cached)
+                    pos += len(buf)
+        finally:
+            if dfd is not None:
+                view.release()
+                dbuf.close()
+                os.close(dfd)
+            if self.drop_cache:
+                # Whatever readahead brought in past what we read,
+                # also when the caller stops early
+                self._drop(fd, 0, 0, cached)
+
+    def _device_slots(self, fd, offset, length, extents=None):
+        if self.device_queues is None:
+            # Nothing to wait for
+            return ExitStack()
+        return self.device_queues.reading(
+            fd, offset, length, extents, self.charge)
+
+    def _drop(self, fd, start, end, cached):
+        # Evicts [start, end) minus the ranges that were cached.
+        # end is 0 for the end of the file, same as fadvise.
+        for (cstart, cend) in cached:
+            if end and cstart >= end:
+                break
+            if cend <= start:
+                continue
+            if cstart > start:
+                fadvise(fd, start, cstart - start, POSIX_FADV_DONTNEED)
+            start = cend
+        if not end:
+            fadvise(fd, start, 0, POSIX_FADV_DONTNEED)
+        elif start < end:
+            fadvise(fd, start, end - start, POSIX_FADV_DONTNEED)
+
+    def cmp_range(self, fi1, fi2, start, end):
+        # Whether two files have the same bytes from start to end
+        pos = start
+        while pos < end:
+            length = min(CHUNK_SIZE, end - pos)
+            b1 = self.read_range(fi1, pos, length)
+            b2 = self.read_range(fi2, pos, length)
+            if b1 != b2:
+                return False
+            if len(b1) < length:
+                # Both end early
+                return True
+            pos += length
+        return True
+
+    def common_prefix(self, fi1, fi2, limit):
+        # How many bytes two files have in common from the start,
+        # up to limit
+        pos = 0
+        while pos < limit:
+            length = min(CHUNK_SIZE, limit - pos)
+            b1 = self.read_range(fi1, pos, length)
+            b2 = self.read_range(fi2, pos, length)
+            if b1 != b2:
+                count = min(len(b1), len(b2))
+                view1 = memoryview(b1)[:count]
+                view2 = memoryview(b2)[:count]
+                # Bisect down to where they start to differ
+                lo, hi = 0, count
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    if view1[:mid] == view2[:mid]:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                return pos + lo
+            if len(b1) < length:
+                return pos + len(b1)
+            pos += length
+        return limit
+
+    def cmp_files(self, fi1, fi2):
+        chunks1 = self.iter_chunks(fi1)
+        chunks2 = self.iter_chunks(fi2)
+        b1 = b2 = b''
+        try:
+            while True:
+                if not b1:
+                    b1 = memoryview(next(chunks1, b''))
+                if not b2:
+                    b2 = memoryview(next(chunks2, b''))
+                if not b1 or not b2:
+                    return not b1 and not b2
+                count = min(len(b1), len(b2))
+                if b1[:count] != b2[:count]:
+                    return False
+                b1 = b1[count:]
+                b2 = b2[count:]
+        finally:
+            # Drops what was read of a file that differs
+            chunks1.close()
+            chunks2.close()
+
+
+def open_direct(fd):
+    # Returns a new O_DIRECT descriptor for the file behind fd,
+    # or None if the filesystem won't do direct IO.
+    try:
+        return os.open(
+            '/proc/self/fd/%d' % fd, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            return None
+        raise
+
+
+def read_direct(dfd, view, pos, length):
+    # Reads into the aligned buffer behind view.
+    # Returns b'' at the end of the file or if the kernel refuses.
+    os.lseek(dfd, pos, os.SEEK_SET)
+    with view[:length] as dest:
+        try:
+            count = os.readv(dfd, [dest])
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            return b''
+    return view[:count].tobytes()
+
+
+def seek_data(fd, pos):
+    # Returns the start of the first data region at or after pos,
+    # or None if there are only holes left.
+    try:
+        return os.lseek(fd, pos, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return
+        if e.errno == errno.EINVAL:
+            # No SEEK_DATA support, everything is data
+            return pos
+        raise
+
+
+def data_ranges(fd):
+    """Yields the (start, end) data regions of a file."""
+
+    size = os.fstat(fd).st_size
+    pos = 0
+    while pos < size:
+        start = seek_data(fd, pos)
+        if start is None or start >= size:
+            return
+        try:
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            end = size
+        yield start, end
+        pos = end
+
+
+def subtract_ranges(ranges1, ranges2):
+    # What ranges1 covers and ranges2 doesn't.
+    # Both sorted and without overlaps
+    idx2 = 0
+    for start, end in ranges1:
+        while idx2 < len(ranges2) and ranges2[idx2][1] <= start:
+            idx2 += 1
+        idx = idx2
+        while start < end and idx < len(ranges2) and ranges2[idx][0] < end:
+            cstart, cend = ranges2[idx]
+            if cstart > start:
+                yield start, cstart
+            start = max(start, cend)
+            idx += 1
+        if start < end:
+            yield start, end
+
+
+def merge_ranges(ranges):
+    # Sorted by start, overlapping or adjacent ranges are joined
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = merged[-1][0], max(merged[-1][1], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def intersect_ranges(ranges1, ranges2):
+    # Both sorted and without overlaps
+    idx1 = idx2 = 0
+    while idx1 < len(ranges1) and idx2 < len(ranges2):
+        start1, end1 = ranges1[idx1]
+        start2, end2 = ranges2[idx2]
+        start, end = max(start1, start2), min(end1, end2)
+        if start < end:
+            yield start, end
+        if end1 < end2:
+            idx1 += 1
+        else:
+            idx2 += 1
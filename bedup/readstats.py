@@ -0,0 +1,206 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# What is counted per size bucket, besides reads:
+# size groups sampled, sets that made it to the verify stage,
+# sets that turned out to have duplicates, bytes freed.
+BUCKET_COUNTS = ('groups', 'verified', 'duplicates', 'freed')
+
+# Tuning needs this much history for a bucket
+TUNE_MIN_GROUPS = 100
+# Size groups whose reads fill about this much make up a window
+WINDOW_READ_TARGET = 4 * 1024 ** 3
+WINDOW_BOUNDS = (20, 5000)
+# Extra samples go to buckets where sets that pass sampling
+# mostly turn out not to have duplicates
+FALSE_POSITIVES_FOR_SAMPLES = .5
+MAX_SAMPLES = 3
+# Buckets that never had duplicates still get this share of their sets
+# hashed, so that duplicates that show up later get noticed
+REPROBE_FRACTION = .1
+
+
+def size_bucket(size):
+    # Bucket n holds sizes from 2**(n-1) to 2**n - 1
+    return int(size).bit_length()
+
+
+def bucket_bounds(bucket):
+    if not bucket:
+        return 0, 1
+    return 1 << (bucket - 1), 1 << bucket
+
+
+def format_size(size):
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if size < 1024:
+            break
+        size /= 1024.
+    if unit:
+        return '%.1f%siB' % (size, unit)
+    return '%dB' % size
+
+
+class ReadStats(object):
+    """Bytes and requests read per stage and size bucket,
+    and what came of them.
+
+    Reads are attributed to the stage and size a thread
+    declared with context().  Thread-safe.
+    """
+
+    def __init__(self):
+        # (stage, bucket) -> [bytes, requests]
+        self.reads = defaultdict(lambda: [0, 0])
+        # bucket -> count name -> count
+        self.buckets = defaultdict(lambda: dict.fromkeys(BUCKET_COUNTS, 0))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def context(self, stage, size):
+        prev = getattr(self._local, 'key', None)
+        self._local.key = (stage, size_bucket(size))
+        try:
+            yield
+        finally:
+            self._local.key = prev
+
+    def add(self, nbytes, requests=1, stage=None, size=None):
+        if stage is None:
+            key = getattr(self._local, 'key', None)
+            if key is None:
+                key = ('other', None)
+        else:
+            key = (stage, size_bucket(size))
+        with self._lock:
+            counts = self.reads[key]
+            counts[0] += nbytes
+            counts[1] += requests
+
+    def count(self, size, **counts):
+        with self._lock:
+            bucket = self.buckets[size_bucket(size)]
+            for (name, value) in counts.items():
+                bucket[name] += value
+
+    def totals(self):
+        # Bytes and requests, over all stages and buckets
+        with self._lock:
+            return (
+                sum(counts[0] for counts in self.reads.values()),
+                sum(counts[1] for counts in self.reads.values()))
+
+    def by_bucket(self):
+        # bucket -> BUCKET_COUNTS, bytes_read and reads over all stages
+        with self._lock:
+            totals = dict(
+                (bucket, dict(counts, bytes_read=0, reads=0))
+                for (bucket, counts) in self.buckets.items())
+            for ((stage, bucket), (bytes_, requests)) in self.reads.items():
+                if bucket is None:
+                    continue
+                counts = totals.setdefault(
+                    bucket, dict.fromkeys(BUCKET_COUNTS, 0))
+                counts['bytes_read'] = counts.get('bytes_read', 0) + bytes_
+                counts['reads'] = counts.get('reads', 0) + requests
+        return totals
+
+    def summary(self):
+        """Yields a line per size bucket: reads per stage, bytes freed,
+        and bytes read per byte freed."""
+
+        with self._lock:
+            reads = dict(
+                (key, list(counts)) for (key, counts) in self.reads.items())
+            buckets = dict(
+                (bucket, dict(counts))
+                for (bucket, counts) in self.buckets.items())
+        for bucket in sorted(buckets):
+            counts = buckets[bucket]
+            stages = sorted(
+                (stage, bytes_, requests)
+                for ((stage, bucket1), (bytes_, requests)) in reads.items()
+                if bucket1 == bucket)
+            total = sum(bytes_ for (stage, bytes_, requests) in stages)
+            low, high = bucket_bounds(bucket)
+            if counts['freed']:
+                ratio = '%.1f' % (float(total) / counts['freed'])
+            else:
+                ratio = 'inf' if total else '-'
+            yield '%s-%s: %s; %d groups, %d with duplicates, ' \
+                'freed %s, read/freed %s' % (
+                    format_size(low), format_size(high),
+                    ', '.join(
+                        '%s %s in %d' % (stage, format_size(bytes_), requests)
+                        for (stage, bytes_, requests) in stages) or 'no reads',
+                    counts['groups'], counts['duplicates'],
+                    format_size(counts['freed']), ratio)
+
+
+class Tuning(object):
+    """Settings derived from the statistics of earlier runs.
+
+    history maps buckets to dicts that hold the BUCKET_COUNTS
+    and a bytes_read total.
+    rnd picks the sets that get re-probed, see hash_worthwhile.
+    """
+
+    def __init__(self, history, rnd=None):
+        self.history = history
+        self._random = rnd or random.Random()
+
+    def hash_worthwhile(self, size):
+        # Buckets that have never had duplicates aren't hashed,
+        # once enough of their sets have been; save for a few,
+        # which keep the history up to date
+        counts = self.history.get(size_bucket(size))
+        if counts is None or counts['verified'] < TUNE_MIN_GROUPS:
+            return True
+        if counts['duplicates'] > 0:
+            return True
+        return self._random.random() < REPROBE_FRACTION
+
+    def samples(self, size):
+        counts = self.history.get(size_bucket(size))
+        if counts is None or counts['groups'] < TUNE_MIN_GROUPS:
+            return 1
+        if not counts['verified']:
+            return 1
+        false_positives = 1. - float(
+            counts['duplicates']) / counts['verified']
+        if false_positives > FALSE_POSITIVES_FOR_SAMPLES:
+            return MAX_SAMPLES
+        return 1
+
+    def window_size(self, default):
+        groups = sum(counts['groups'] for counts in self.history.values())
+        read = sum(counts['bytes_read'] for counts in self.history.values())
+        if groups < TUNE_MIN_GROUPS or not read:
+            return default
+        per_group = float(read) / groups
+        low, high = WINDOW_BOUNDS
+        return max(low, min(high, int(WINDOW_READ_TARGET / per_group)))
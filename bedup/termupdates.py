@@ -19,6 +19,7 @@
 import collections
 import string
 import sys
+import threading
 
 from .platform.time import monotonic_time
 
@@ -78,18 +79,26 @@ class TermTemplate(object):
         # knowing this is stdout:
         self._newline_needs_flush = not self._isatty
         self._wraps = True
+        # Dedup pipeline workers report from their own threads
+        self._lock = threading.RLock()
 
     def update(self, **kwargs):
-        self._kws.update(kwargs)
-        for key in kwargs:
-            self._kws_counter[key] += 1
-        self._render(with_newline=False)
+        with self._lock:
+            self._kws.update(kwargs)
+            for key in kwargs:
+                self._kws_counter[key] += 1
+            self._render(with_newline=False)
 
     def set_total(self, **kwargs):
-        self._kws_totals.update(kwargs)
-        self._render(with_newline=False)
+        with self._lock:
+            self._kws_totals.update(kwargs)
+            self._render(with_newline=False)
 
     def format(self, template):
+        with self._lock:
+            self._format(template)
+
+    def _format(self, template):
         if self._template is not None:
             self._render(with_newline=True)
         else:
@@ -175,16 +184,18 @@ class TermTemplate(object):
             self._stream.flush()
 
     def notify(self, message):
-        self._write_tty(CLEAR_LINE)
-        self._dowrap()
-        self._stream.write(message + '\n')
-        self._render(
-            with_newline=False, flush_anyway=self._newline_needs_flush)
+        with self._lock:
+            self._write_tty(CLEAR_LINE)
+            self._dowrap()
+            self._stream.write(message + '\n')
+            self._render(
+                with_newline=False, flush_anyway=self._newline_needs_flush)
 
     def close(self):
         # Called close so it can be used with contextlib.closing
-        self._render(with_newline=True)
-        self._dowrap()
-        self._stream.flush()
-        self._stream = None
+        with self._lock:
+            self._render(with_newline=True)
+            self._dowrap()
+            self._stream.flush()
+            self._stream = None
 
@@ -4,12 +4,15 @@ import fcntl
 import multiprocessing
 import os
 import shutil
+import sqlite3
 import subprocess
 import tempfile
 
 
 from .platform.syncfs import syncfs
 from .platform.btrfs import lookup_ino_paths, BTRFS_FIRST_FREE_OBJECTID
+from .platform.fiemap import shared_bytes
+from .hashing import mini_hash_offset
 
 from .__main__ import main
 from . import compat  # monkey-patch check_output and O_CLOEXEC
@@ -115,6 +118,11 @@ def test_functional():
     boxed_call('reset --'.split() + [fs])
     boxed_call('scan --size-cutoff=65536 --'.split() + [fs, fs])
     boxed_call('dedup --'.split() + [fs])
+    # Rescanned so that the files count as updated again
+    for flags in ('--clone-chunk=65536 --partial=65536', '--min-gain=4096'):
+        boxed_call('reset --'.split() + [fs])
+        boxed_call('scan --size-cutoff=65536 --'.split() + [fs, fs])
+        boxed_call(['dedup'] + flags.split() + ['--', fs])
     boxed_call(
         'dedup-files --defrag --'.split() +
         [fs + '/one.sample', fs + '/two.sample'])
@@ -132,6 +140,54 @@ def test_functional():
     stat1 = stat(fs + '/one.sample')
     # Check that atime and mtime are restored
     assert stat0 == stat1
+    shutil.copy(sampledata2, os.path.join(fs, 'five.sample'))
+    # The same contents, with and without holes
+    with open(os.path.join(fs, 'sparse.sample'), 'wb') as sfile:
+        sfile.truncate(8 * 1024 ** 2)
+        sfile.seek(3 * 1024 ** 2)
+        sfile.write(b'x' * 65536)
+    with open(os.path.join(fs, 'zeroes.sample'), 'wb') as zfile:
+        zfile.write(bytes(3 * 1024 ** 2))
+        zfile.write(b'x' * 65536)
+        zfile.write(bytes(8 * 1024 ** 2 - zfile.tell()))
+    # Large enough for partial dedup, the same save for the block
+    # that sampling looks at first
+    with open(sampledata1, 'rb') as s1, open(sampledata2, 'rb') as s2:
+        data = s1.read() + s2.read()
+    differs = mini_hash_offset(len(data)) // 65536 * 65536
+    for (name, fill) in (('partial1.sample', b'a'), ('partial2.sample', b'b')):
+        with open(os.path.join(fs, name), 'wb') as pfile:
+            pfile.write(data[:differs])
+            pfile.write(fill * 65536)
+            pfile.write(data[differs + 65536:])
+    syncfs(vol_fd)
+    boxed_call(
+        'dedup --hash-workers=2 --concurrency=verify=2 '
+        '--prefetch=16777216 --drop-cache --direct-io '
+        '--punch-zeros --engine=dedupe --elevator --device-concurrency=2 '
+        '--checkpoint-above=4194304 --max-read-rate=1073741824 '
+        '--max-iops=100000 --pressure-slow=90 --pressure-pause=99 '
+        '--profile=scan=be,level=7 --profile=verify=idle,nice=10 '
+        '--profile=clone=be --autotune --clone-chunk=1048576 '
+        '--partial --common-prefix --digest-cache'.split() +
+        [tdir + '/digests', '--', fs])
+    syncfs(vol_fd)
+    # Stored zeroes were punched, or shared with the holes of a copy
+    with open(os.path.join(fs, 'zeroes.sample'), 'rb') as zfile:
+        assert os.lseek(zfile.fileno(), 0, os.SEEK_DATA) > 0
+    # Copies are shared
+    with open(os.path.join(fs, 'five.sample'), 'rb') as ffile:
+        assert shared_bytes(ffile.fileno()) == 8 * 1024 ** 2
+    # So are the runs of blocks that differing files have in common
+    with open(os.path.join(fs, 'partial2.sample'), 'rb') as pfile:
+        assert shared_bytes(pfile.fileno()) >= 8 * 1024 ** 2
+    conn = sqlite3.connect(db)
+    try:
+        freed, = conn.execute(
+            'SELECT SUM(space_gain) FROM DedupEvent').fetchone()
+    finally:
+        conn.close()
+    assert freed > 0
     boxed_call('find-new --'.split() + [fs])
     boxed_call('show'.split())
 
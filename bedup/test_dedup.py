@@ -0,0 +1,74 @@
+from .dedup import BLOCK_SIZE, clone_ranges
+from .platform.fiemap import FiemapExtent, shared_prefix
+
+
+KIB = 1024
+
+
+def extents(*bounds):
+    # Contiguous extents ending at each of bounds, in KiB
+    starts = (0, ) + bounds[:-1]
+    return [
+        FiemapExtent(start * KIB, 0, (end - start) * KIB, 0)
+        for (start, end) in zip(starts, bounds)]
+
+
+def ranges(*args):
+    return [
+        (start // KIB, end // KIB) for (start, end) in clone_ranges(*args)]
+
+
+def test_clone_ranges_large_extent():
+    # Split every chunk_size, the last range ends at end
+    assert ranges(extents(100), 0, 100 * KIB, 16 * KIB) == [
+        (0, 16), (16, 32), (32, 48), (48, 64), (64, 80), (80, 96),
+        (96, 100)]
+    assert ranges(extents(100), 0, 20 * KIB, 16 * KIB) == [
+        (0, 16), (16, 20)]
+
+
+def test_clone_ranges_extent_bounds():
+    # Small extents are grouped, ranges end where an extent ends
+    assert ranges(extents(8, 12, 40), 0, 40 * KIB, 16 * KIB) == [
+        (0, 12), (12, 28), (28, 40)]
+    assert ranges(extents(4, 8, 12, 16, 20), 0, 20 * KIB, 16 * KIB) == [
+        (0, 16), (16, 20)]
+
+
+def test_clone_ranges_start():
+    assert ranges(extents(8, 64), 20 * KIB, 64 * KIB, 16 * KIB) == [
+        (20, 36), (36, 52), (52, 64)]
+    assert ranges(extents(8, 64), 64 * KIB, 64 * KIB, 16 * KIB) == []
+
+
+def test_clone_ranges_chunk_size():
+    # Rounded down to whole blocks, at least one
+    assert ranges(extents(16), 0, 16 * KIB, 10000) == [(0, 8), (8, 16)]
+    assert list(clone_ranges(extents(8), 0, 8 * KIB, 1)) == [
+        (0, BLOCK_SIZE), (BLOCK_SIZE, 2 * BLOCK_SIZE)]
+
+
+def test_clone_ranges_holes():
+    # Holes have no extents, they go along with the data around them
+    sparse = [
+        FiemapExtent(0, 0, 4 * KIB, 0),
+        FiemapExtent(60 * KIB, 0, 4 * KIB, 0)]
+    assert ranges(sparse, 0, 64 * KIB, 16 * KIB) == [(0, 60), (60, 64)]
+    assert ranges([], 0, 64 * KIB, 16 * KIB) == [(0, 64)]
+
+
+def test_shared_prefix():
+    def at(physical, *bounds):
+        return [
+            extent._replace(physical=physical + extent.logical)
+            for extent in extents(*bounds)]
+
+    assert shared_prefix(at(KIB, 8, 16), at(KIB, 8, 16)) == 16 * KIB
+    # The shorter file ends within an extent of the longer one
+    assert shared_prefix(at(KIB, 8, 16), at(KIB, 8, 12)) == 12 * KIB
+    assert shared_prefix(at(KIB, 8, 16), at(2 * KIB, 8, 16)) == 0
+    assert shared_prefix(
+        at(KIB, 8, 16), at(KIB, 8) + at(5 * KIB, 8, 16)[1:]) == 8 * KIB
+    # Holes and extents without an address don't count
+    assert shared_prefix(at(0, 8), at(0, 8)) == 0
+    assert shared_prefix(at(KIB, 8, 16)[1:], at(KIB, 8, 16)[1:]) == 0
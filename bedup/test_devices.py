@@ -0,0 +1,82 @@
+from .devices import DeviceMap
+from .platform.btrfs import Chunk, lib
+
+
+STRIPE = 64 * 1024
+GIB = 1024 ** 3
+
+
+def chunk(logical, profile, devids, sub_stripes=1, length=GIB):
+    return Chunk(
+        logical=logical, length=length, stripe_len=STRIPE,
+        profile=profile,
+        sub_stripes=sub_stripes, devids=devids)
+
+
+def stripes(device_map, logical, count):
+    return [
+        device_map.devices_at(logical + idx * STRIPE)
+        for idx in range(count)]
+
+
+def test_single_and_mirrors():
+    device_map = DeviceMap([
+        chunk(GIB, 0, (3, )),
+        chunk(2 * GIB, lib.BTRFS_BLOCK_GROUP_RAID1, (2, 1)),
+        chunk(3 * GIB, lib.BTRFS_BLOCK_GROUP_DUP, (1, 1)),
+        chunk(4 * GIB, lib.BTRFS_BLOCK_GROUP_RAID1C3, (3, 1, 2)),
+    ])
+    assert device_map.devids == [1, 2, 3]
+    assert device_map.devices_at(GIB + 12345) == (3, )
+    assert device_map.devices_at(2 * GIB + 5 * STRIPE) == (1, 2)
+    assert device_map.devices_at(3 * GIB) == (1, )
+    assert device_map.devices_at(5 * GIB - 1) == (1, 2, 3)
+    # One copy is read, whichever the mirror picks
+    assert device_map.devices_in(2 * GIB, 10 * STRIPE, 0) == {2}
+    assert device_map.devices_in(2 * GIB, 10 * STRIPE, 1) == {1}
+    assert device_map.devices_in(4 * GIB, STRIPE, 5) == {2}
+    assert device_map.devices_in(3 * GIB - 1, 2, 0) == {1, 2}
+
+
+def test_raid0():
+    device_map = DeviceMap([
+        chunk(GIB, lib.BTRFS_BLOCK_GROUP_RAID0, (1, 2, 3))])
+    assert stripes(device_map, GIB, 4) == [(1, ), (2, ), (3, ), (1, )]
+    assert device_map.devices_at(GIB + STRIPE - 1) == (1, )
+    assert device_map.devices_in(GIB + STRIPE - 1, 2) == {1, 2}
+    assert device_map.devices_in(GIB, 10 * STRIPE) == {1, 2, 3}
+
+
+def test_raid10():
+    device_map = DeviceMap([chunk(
+        GIB, lib.BTRFS_BLOCK_GROUP_RAID10, (1, 2, 3, 4), sub_stripes=2)])
+    assert stripes(device_map, GIB, 3) == [(1, 2), (3, 4), (1, 2)]
+    assert device_map.devices_in(GIB, 2 * STRIPE, 0) == {1, 3}
+    assert device_map.devices_in(GIB, 2 * STRIPE, 1) == {2, 4}
+
+
+def test_raid56():
+    # Parity moves over by one device every full stripe
+    device_map = DeviceMap([
+        chunk(GIB, lib.BTRFS_BLOCK_GROUP_RAID5, (1, 2, 3)),
+        chunk(2 * GIB, lib.BTRFS_BLOCK_GROUP_RAID6, (1, 2, 3, 4)),
+    ])
+    assert stripes(device_map, GIB, 6) == [
+        (1, ), (2, ), (2, ), (3, ), (3, ), (1, )]
+    assert stripes(device_map, 2 * GIB, 6) == [
+        (1, ), (2, ), (2, ), (3, ), (3, ), (4, )]
+
+
+def test_outside_chunks():
+    device_map = DeviceMap([
+        chunk(GIB, 0, (1, ), length=STRIPE),
+        chunk(2 * GIB, 0, (2, ), length=STRIPE),
+    ])
+    assert device_map.devices_at(0) is None
+    assert device_map.devices_at(GIB + STRIPE) is None
+    assert device_map.devices_at(3 * GIB) is None
+    # Gaps are skipped over
+    assert device_map.devices_in(0, 3 * GIB) == {1, 2}
+    assert device_map.devices_in(GIB + STRIPE, GIB) == {2}
+    assert device_map.devices_in(3 * GIB, GIB) == set()
+    assert DeviceMap([]).devices_in(0, GIB) == set()
@@ -0,0 +1,63 @@
+import json
+import os
+
+from .digestcache import CACHE_FORMAT, DigestCache
+from .hashing import HASH_CHUNK_SIZE
+
+
+FSID = '4b0ba6e1-ea4d-4bf4-a4fa-d7b1c1fe4b5a'
+
+
+def key(idx):
+    return (FSID, ((idx, 0, HASH_CHUNK_SIZE), ))
+
+
+def test_lru():
+    cache = DigestCache(capacity=2)
+    cache.put(key(1), b'1')
+    cache.put(key(2), b'2')
+    assert cache.get(key(1)) == b'1'
+    # 2 was used least recently
+    cache.put(key(3), b'3')
+    assert cache.get(key(2)) is None
+    assert cache.get(key(1)) == b'1'
+    assert cache.get(key(3)) == b'3'
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_load_save(tdir):
+    path = os.path.join(tdir, 'digests')
+    cache = DigestCache()
+    # A missing file is an empty cache
+    cache.load(path)
+    for idx in range(10):
+        cache.put(key(idx), bytes([idx]) * 20)
+    cache.save(path)
+    assert not os.path.exists(path + '.tmp')
+
+    cache = DigestCache(capacity=4)
+    cache.load(path)
+    # The most recently used entries are kept
+    for idx in range(6):
+        assert cache.get(key(idx)) is None
+    for idx in range(6, 10):
+        assert cache.get(key(idx)) == bytes([idx]) * 20
+
+
+def test_format_mismatch(tdir):
+    path = os.path.join(tdir, 'digests')
+    cache = DigestCache()
+    cache.put(key(1), b'1')
+    cache.save(path)
+    with open(path) as cfile:
+        state = json.load(cfile)
+
+    for changes in (
+        dict(format=CACHE_FORMAT + 1), dict(chunk_size=HASH_CHUNK_SIZE * 2),
+        dict(format=None),
+    ):
+        with open(path, 'w') as cfile:
+            json.dump(dict(state, **changes), cfile)
+        cache = DigestCache()
+        cache.load(path)
+        assert cache.get(key(1)) is None
@@ -0,0 +1,124 @@
+import os
+import random
+
+from .hashing import (
+    CanonicalHasher, HASH_BLOCK_SIZE, HASH_CHUNK_SIZE, HashJob, HashPool,
+    same_block_runs)
+from .reader import Reader
+
+
+def canonical_digest(pieces, size, punch_min=None):
+    hasher = CanonicalHasher(punch_min)
+    for (offset, buf) in pieces:
+        hasher.update(offset, buf)
+    return hasher.digest(size), hasher.zeroes
+
+
+def sample_contents(rnd, size):
+    data = bytearray(rnd.getrandbits(8) for idx in range(size))
+    # Runs of zeroes, aligned or not
+    for idx in range(3):
+        start = rnd.randrange(size + 1)
+        end = min(size, start + rnd.randrange(3 * HASH_BLOCK_SIZE))
+        data[start:end] = bytes(end - start)
+    return bytes(data)
+
+
+def test_canonical_split_invariance():
+    rnd = random.Random(0)
+    for trial in range(100):
+        size = rnd.randrange(8 * HASH_BLOCK_SIZE)
+        data = sample_contents(rnd, size)
+        whole = canonical_digest([(0, data)], size, HASH_BLOCK_SIZE)
+        cuts = sorted(rnd.randrange(size + 1) for idx in range(5))
+        pieces = [
+            (start, data[start:end])
+            for (start, end) in zip([0] + cuts, cuts + [size])]
+        assert canonical_digest(pieces, size, HASH_BLOCK_SIZE) == whole
+        # Zeroes may as well be holes, which aren't punched
+        pieces = [
+            (start, buf) for (start, buf) in pieces
+            if buf.strip(b'\0') or rnd.random() < .5]
+        assert canonical_digest(pieces, size)[0] == whole[0]
+
+
+def test_canonical_holes():
+    size = 3 * HASH_BLOCK_SIZE + 100
+    data = b'x' * 100
+    stored = canonical_digest(
+        [(0, bytes(size - len(data))), (size - len(data), data)], size)
+    hole = canonical_digest([(size - len(data), data)], size)
+    assert stored[0] == hole[0]
+    assert canonical_digest([], size)[0] == canonical_digest(
+        [(0, bytes(size))], size)[0]
+    assert canonical_digest([], size)[0] != canonical_digest([], size + 1)[0]
+
+
+def test_canonical_stored_zeroes():
+    size = 4 * HASH_BLOCK_SIZE
+    data = b'x' * HASH_BLOCK_SIZE + bytes(2 * HASH_BLOCK_SIZE + 10)
+    data += b'y' * (size - len(data))
+    for split in (1, HASH_BLOCK_SIZE, HASH_BLOCK_SIZE + 7, len(data) - 1):
+        digest, zeroes = canonical_digest(
+            [(0, data[:split]), (split, data[split:])], size,
+            HASH_BLOCK_SIZE)
+        # The partial block of zeroes can't be punched
+        assert zeroes == [(HASH_BLOCK_SIZE, 3 * HASH_BLOCK_SIZE)]
+
+
+def test_same_block_runs():
+    digests1 = [b'a', b'b', b'c', b'd', b'e']
+    digests2 = [b'a', b'b', b'x', b'd', b'e']
+    # Adjacent blocks merge, the last one stops at the end of the file
+    assert same_block_runs(digests1, digests2, 10, 45) == [
+        (0, 20), (30, 45)]
+    assert same_block_runs(digests1, digests1[::-1], 10, 50) == [(20, 30)]
+    assert same_block_runs(digests1, [b'x'] * 5, 10, 50) == []
+    # Blocks past the end of the shorter file are left out
+    assert same_block_runs(digests1, digests1[:2], 10, 50) == [(0, 20)]
+
+
+def test_hash_pool(tdir):
+    rnd = random.Random(0)
+    data = bytes(rnd.getrandbits(8) for idx in range(HASH_CHUNK_SIZE))
+    contents = dict(
+        a=data * 2 + b'end', b=data * 2 + b'end', c=data * 2 + b'End')
+    for (name, content) in contents.items():
+        with open(os.path.join(tdir, name), 'wb') as tfile:
+            tfile.write(content)
+
+    def job(name, known=None):
+        st = os.stat(os.path.join(tdir, name))
+        return HashJob(tdir, name, st.st_ino, st.st_size, known or {}, [])
+
+    pool = HashPool(2)
+    try:
+        results = dict(
+            (name, pool.submit(job(name), Reader()))
+            for name in sorted(contents))
+        results = dict(
+            (name, result.get()) for (name, result) in results.items())
+        assert results['a'].digest == results['b'].digest
+        assert results['a'].digest != results['c'].digest
+        assert results['a'].size == len(contents['a'])
+        assert results['a'].read[0] >= len(contents['a'])
+
+        # Chunks whose digests are known aren't read again
+        known = dict(results['a'].chunks)
+        del known[2]
+        result = pool.submit(job('c', known), Reader()).get()
+        assert result.digest == results['c'].digest
+        assert result.read[0] < HASH_CHUNK_SIZE
+
+        # Files that aren't where they were expected are left out
+        os.rename(os.path.join(tdir, 'c'), os.path.join(tdir, 'd'))
+        moved = job('a')._replace(path='c')
+        assert pool.submit(moved, Reader()).get().digest is None
+        with open(os.path.join(tdir, 'c'), 'wb') as tfile:
+            tfile.write(contents['c'])
+        replaced = job('d')._replace(path='c')
+        result = pool.submit(replaced, Reader()).get()
+        assert result.digest is None
+        assert result.ino != replaced.ino
+    finally:
+        pool.close()
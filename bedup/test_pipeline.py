@@ -0,0 +1,159 @@
+import argparse
+import threading
+
+import pytest
+
+from .pipeline import Pipeline, Stage
+
+
+def run(pipeline, items):
+    records = []
+    with pipeline:
+        for item in items:
+            records.extend(pipeline.feed(item))
+        records.extend(pipeline.drain())
+    return records
+
+
+def test_stage_concurrency():
+    with pytest.raises(ValueError):
+        Stage('none', list, concurrency=0)
+
+
+def test_stage_concurrency_arg():
+    # The command line depends on the rest of bedup, unlike the pipeline
+    from .__main__ import stage_concurrency
+
+    assert stage_concurrency('verify=3') == ('verify', 3)
+    for arg in ('verify', 'verify=0', 'verify=x', 'nope=2', '=2'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            stage_concurrency(arg)
+
+
+def test_pipeline_order():
+    # With one worker per stage, items come out in the order they went in
+    pipeline = Pipeline([
+        Stage('double', lambda item: [item, item]),
+        Stage('inc', lambda item: [item + 1], depth=3),
+    ])
+    assert run(pipeline, range(20)) == [
+        item + 1 for item in range(20) for copy in range(2)]
+
+
+def test_pipeline_workers():
+    pipeline = Pipeline([
+        Stage('split', lambda item: [item] * item, concurrency=3),
+        Stage('neg', lambda item: [-item], concurrency=2),
+    ])
+    assert sorted(run(pipeline, range(10))) == sorted(
+        -item for item in range(10) for copy in range(item))
+    assert dict(pipeline.utilisation()).keys() == set(['split', 'neg'])
+
+
+def test_pipeline_done():
+    # Done records come after everything the item's work posted,
+    # including for items that didn't make it to the last stage
+    pipeline = Pipeline([
+        Stage(
+            'split', lambda item: [(item, idx) for idx in range(item)],
+            concurrency=3),
+        Stage('echo', lambda item: [item], concurrency=2),
+    ])
+    records = []
+    with pipeline:
+        for item in range(10):
+            records.extend(pipeline.feed(item, done=('done', item)))
+        records.extend(pipeline.drain())
+    assert len(records) == 10 + sum(range(10))
+    for item in range(10):
+        done = records.index(('done', item))
+        assert all(
+            pos < done for (pos, record) in enumerate(records)
+            if record[0] == item)
+
+
+def test_pipeline_done_failed():
+    # Not for items whose work failed
+    def fail(item):
+        if item == 3:
+            raise ZeroDivisionError
+        return [item]
+
+    pipeline = Pipeline([Stage('fail', fail)])
+    records = []
+    with pytest.raises(ZeroDivisionError):
+        with pipeline:
+            for item in range(5):
+                records.extend(pipeline.feed(item, done=('done', item)))
+            records.extend(pipeline.drain())
+    assert ('done', 3) not in records
+
+
+def test_pipeline_discard():
+    # Once a worker fails, items that are still queued get discarded
+    # and the error comes out of the feeding thread
+    discarded = []
+    discard_lock = threading.Lock()
+
+    def discard(item):
+        with discard_lock:
+            discarded.append(item)
+
+    def fail(item):
+        if item == 0:
+            raise ZeroDivisionError
+        return [item]
+
+    pipeline = Pipeline([
+        Stage('pass', lambda item: [item], discard=discard),
+        Stage('fail', fail, discard=discard, depth=10),
+    ])
+    fed = []
+    with pytest.raises(ZeroDivisionError):
+        with pipeline:
+            for item in range(100):
+                list(pipeline.feed(item))
+                fed.append(item)
+            list(pipeline.drain())
+    assert sorted(discarded) == fed[1:]
+
+
+def test_pipeline_abort():
+    # Records that were posted but not handed out yet are applied
+    # before the exception goes on
+    applied = []
+    done = threading.Event()
+
+    def echo(item):
+        if item == 9:
+            done.set()
+        return [item]
+
+    pipeline = Pipeline([Stage('echo', echo)], apply=applied.append)
+    seen = []
+    with pytest.raises(KeyboardInterrupt):
+        with pipeline:
+            for item in range(10):
+                seen.extend(pipeline.feed(item))
+            done.wait()
+            raise KeyboardInterrupt
+    assert sorted(seen + applied) == list(range(10))
+
+
+def test_pipeline_abort_apply_error():
+    # An apply that fails doesn't hide the original exception
+    def apply(record):
+        raise RuntimeError
+
+    done = threading.Event()
+
+    def echo(item):
+        done.set()
+        return [item]
+
+    pipeline = Pipeline([Stage('echo', echo)], apply=apply)
+    with pytest.raises(KeyError):
+        with pipeline:
+            list(pipeline.feed(0))
+            done.wait()
+            raise KeyError
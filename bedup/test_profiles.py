@@ -0,0 +1,22 @@
+import pytest
+
+from .platform.ioprio import IOPRIO_CLASS_BE, IOPRIO_CLASS_IDLE
+from .profiles import Profile, parse_profile
+
+
+def test_parse_profile():
+    assert parse_profile('idle') == Profile(
+        IOPRIO_CLASS_IDLE, None, None, None)
+    assert parse_profile('be,level=7,nice=19,cgroup=/sys/fs/cgroup/x') == (
+        Profile(IOPRIO_CLASS_BE, 7, 19, '/sys/fs/cgroup/x'))
+    assert parse_profile('be,nice=-5').nice == -5
+
+
+def test_parse_profile_errors():
+    for spec in (
+        '', 'rt', 'idle,level', 'idle,prio=3', 'be,level=8', 'be,level=-1',
+        'be,nice=low', 'be,level=',
+    ):
+        with pytest.raises(ValueError):
+            parse_profile(spec)
+
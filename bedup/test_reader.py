@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+from .reader import (
+    data_ranges, intersect_ranges, merge_ranges, subtract_ranges)
+
+
+MIB = 1024 ** 2
+
+
+def test_data_ranges():
+    with tempfile.TemporaryFile() as tfile:
+        fd = tfile.fileno()
+        assert list(data_ranges(fd)) == []
+        os.pwrite(fd, b'x' * 4096, 0)
+        os.pwrite(fd, b'y' * 4096, MIB)
+        os.pwrite(fd, b'z' * 10, 3 * MIB)
+        os.ftruncate(fd, 4 * MIB)
+        assert list(data_ranges(fd)) == [
+            (0, 4096), (MIB, MIB + 4096), (3 * MIB, 3 * MIB + 4096)]
+        # The last range stops at the end of the file
+        os.ftruncate(fd, 3 * MIB + 10)
+        assert list(data_ranges(fd))[-1] == (3 * MIB, 3 * MIB + 10)
+
+
+def test_intersect_ranges():
+    ranges = [(0, 10), (20, 30), (40, 50)]
+    assert list(intersect_ranges(ranges, [(5, 45)])) == [
+        (5, 10), (20, 30), (40, 45)]
+    assert list(intersect_ranges([(5, 45)], ranges)) == [
+        (5, 10), (20, 30), (40, 45)]
+    assert list(intersect_ranges(ranges, [(10, 20), (30, 40)])) == []
+    assert list(intersect_ranges(ranges, [(0, 25), (25, 100)])) == [
+        (0, 10), (20, 25), (25, 30), (40, 50)]
+    assert list(intersect_ranges(ranges, [])) == []
+
+
+def test_subtract_ranges():
+    ranges = [(0, 10), (20, 30), (40, 50)]
+    assert list(subtract_ranges(ranges, [(5, 25), (45, 50)])) == [
+        (0, 5), (25, 30), (40, 45)]
+    assert list(subtract_ranges([(0, 100)], ranges)) == [
+        (10, 20), (30, 40), (50, 100)]
+    assert list(subtract_ranges(ranges, [(0, 100)])) == []
+    assert list(subtract_ranges(ranges, [])) == ranges
+    assert list(subtract_ranges(ranges, [(10, 20), (32, 34)])) == [
+        (0, 10), (20, 30), (40, 50)]
+
+
+def test_merge_ranges():
+    assert merge_ranges([(0, 10), (10, 20), (15, 18), (30, 40)]) == [
+        (0, 20), (30, 40)]
+    assert merge_ranges([(0, 50), (10, 20), (30, 60)]) == [(0, 60)]
+    assert merge_ranges([]) == []
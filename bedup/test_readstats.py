@@ -0,0 +1,92 @@
+import random
+
+from .readstats import (
+    BUCKET_COUNTS, MAX_SAMPLES, REPROBE_FRACTION, TUNE_MIN_GROUPS,
+    WINDOW_BOUNDS, WINDOW_READ_TARGET, ReadStats, Tuning, bucket_bounds,
+    size_bucket)
+
+
+def history(**counts):
+    bucket = dict.fromkeys(BUCKET_COUNTS, 0)
+    bucket['bytes_read'] = 0
+    bucket.update(counts)
+    return bucket
+
+
+def test_size_bucket():
+    assert size_bucket(0) == 0
+    for bucket in range(1, 40):
+        low, high = bucket_bounds(bucket)
+        assert size_bucket(low) == bucket
+        assert size_bucket(high - 1) == bucket
+        assert size_bucket(high) == bucket + 1
+
+
+def test_read_stats():
+    stats = ReadStats()
+    with stats.context('verify', 4096):
+        stats.add(4096)
+        with stats.context('csums', 100):
+            stats.add(10, requests=2)
+        stats.add(4096)
+    stats.add(1)
+    stats.add(5, stage='sample', size=4096)
+    stats.count(4096, groups=1, freed=4096)
+    assert stats.totals() == (8208, 6)
+    by_bucket = stats.by_bucket()
+    assert by_bucket[size_bucket(4096)]['bytes_read'] == 8197
+    assert by_bucket[size_bucket(4096)]['freed'] == 4096
+    assert by_bucket[size_bucket(100)]['reads'] == 2
+    assert len(list(stats.summary())) == 1
+
+
+def test_tuning_new_buckets():
+    # Not enough history, the defaults go
+    tuning = Tuning({size_bucket(4096): history(
+        groups=TUNE_MIN_GROUPS - 1, verified=TUNE_MIN_GROUPS - 1)})
+    for size in (0, 4096, 1024 ** 3):
+        assert tuning.hash_worthwhile(size)
+        assert tuning.samples(size) == 1
+    assert tuning.window_size(42) == 42
+
+
+def test_tuning_hash_worthwhile():
+    tuning = Tuning({
+        size_bucket(4096): history(
+            groups=TUNE_MIN_GROUPS, verified=TUNE_MIN_GROUPS),
+        size_bucket(8192): history(
+            groups=TUNE_MIN_GROUPS, verified=TUNE_MIN_GROUPS,
+            duplicates=1),
+    }, random.Random(0))
+    tries = 1000
+    # Sets without duplicates so far still get re-probed once in a while
+    probed = sum(tuning.hash_worthwhile(4096) for idx in range(tries))
+    assert 0 < probed < 2 * REPROBE_FRACTION * tries
+    assert all(tuning.hash_worthwhile(8192) for idx in range(tries))
+
+
+def test_tuning_samples():
+    tuning = Tuning({
+        size_bucket(4096): history(
+            groups=TUNE_MIN_GROUPS, verified=10, duplicates=2),
+        size_bucket(8192): history(
+            groups=TUNE_MIN_GROUPS, verified=10, duplicates=8),
+    })
+    # Extra samples where most sets that pass sampling aren't duplicates
+    assert tuning.samples(4096) == MAX_SAMPLES
+    assert tuning.samples(8192) == 1
+
+
+def test_tuning_window_size():
+    low, high = WINDOW_BOUNDS
+    per_group = WINDOW_READ_TARGET // 100
+    tuning = Tuning({1: history(
+        groups=TUNE_MIN_GROUPS, bytes_read=TUNE_MIN_GROUPS * per_group)})
+    assert tuning.window_size(42) == 100
+    tuning = Tuning({1: history(
+        groups=TUNE_MIN_GROUPS, bytes_read=TUNE_MIN_GROUPS)})
+    assert tuning.window_size(42) == high
+    tuning = Tuning({1: history(
+        groups=TUNE_MIN_GROUPS,
+        bytes_read=TUNE_MIN_GROUPS * WINDOW_READ_TARGET)})
+    assert tuning.window_size(42) == low
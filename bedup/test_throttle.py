@@ -0,0 +1,129 @@
+import threading
+
+from . import throttle as throttle_
+from .throttle import PAUSE_POLL, Throttle, TokenBucket
+
+
+class FakeClock(object):
+    # Stands in for the time module and monotonic_time.
+    # Sleeps are recorded, time only moves when the test says so.
+    def __init__(self):
+        self.now = 0.
+        self.slept = []
+        self.on_sleep = None
+        self._lock = threading.Lock()
+
+    def monotonic_time(self):
+        return self.now
+
+    def sleep(self, secs):
+        with self._lock:
+            self.slept.append(secs)
+        if self.on_sleep is not None:
+            self.on_sleep()
+
+
+def fake_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle_, 'monotonic_time', clock.monotonic_time)
+    monkeypatch.setattr(throttle_, 'time', clock)
+    return clock
+
+
+def approx(values):
+    return [round(value, 6) for value in values]
+
+
+def test_token_bucket_burst(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(100, burst=10)
+    # The burst goes through at once, what's over it is slept off
+    bucket.consume(10)
+    assert clock.slept == []
+    bucket.consume(20)
+    assert approx(clock.slept) == [.2]
+
+
+def test_token_bucket_large_request(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    # Larger than the burst, goes through after sleeping off the debt
+    bucket = TokenBucket(1000)
+    bucket.consume(1000)
+    bucket.consume(500)
+    assert approx(clock.slept) == [.5]
+    # Refilled by then, but not past the burst
+    clock.now += 1
+    bucket.consume(1000)
+    assert approx(clock.slept) == [.5, .5]
+    clock.now += 10
+    bucket.consume(1000)
+    assert approx(clock.slept) == [.5, .5]
+
+
+def test_token_bucket_threads(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(200, burst=1)
+    threads = [
+        threading.Thread(target=bucket.consume, args=(20, ))
+        for idx in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The threads share the bucket, the debt adds up
+    assert approx(sorted(clock.slept)) == approx(
+        (20 * idx - 1) / 200. for idx in range(1, 6))
+
+
+def test_throttle_counts():
+    throttle = Throttle()
+    throttle.charge(4096)
+    throttle.charge(0)
+    assert throttle.bytes_read == 4096
+    assert throttle.reads == 2
+
+
+def test_throttle_iops(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    throttle = Throttle(max_iops=10)
+    for idx in range(10):
+        throttle.charge(0)
+    assert clock.slept == []
+    throttle.charge(0)
+    assert approx(clock.slept) == [.1]
+    assert throttle.reads == 11
+
+
+def test_throttle_read_rate(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    throttle = Throttle(max_read_rate=1024 ** 2)
+    throttle.charge(1024 ** 2)
+    # Metadata requests don't count against the byte rate
+    throttle.charge(0)
+    assert clock.slept == []
+    throttle.charge(256 * 1024)
+    assert approx(clock.slept) == [.25]
+
+
+def test_throttle_back_off(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    throttle = Throttle()
+    throttle.slow_down()
+    throttle.back_off(delay=.1)
+    throttle.charge(0)
+    throttle.back_off()
+    throttle.charge(0)
+    assert clock.slept == [.1]
+
+    # Held back until it is unpaused
+    throttle.back_off(paused=True)
+
+    def unpause():
+        if len(clock.slept) == 4:
+            throttle.back_off()
+
+    clock.on_sleep = unpause
+    throttle.wait()
+    assert clock.slept == [.1] + [PAUSE_POLL] * 3
+    throttle.wait()
+    assert len(clock.slept) == 4
@@ -0,0 +1,121 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# bedup - Btrfs deduplication
+# Copyright (C) 2015 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import time
+
+from .platform.time import monotonic_time
+
+
+# The Throttle of this process, when it is a hashing worker
+inherited = None
+
+# How often paused workers check whether they can go on
+PAUSE_POLL = .5
+
+
+class TokenBucket(object):
+    """Lets through rate units per second, with bursts of up to burst.
+
+    Callers that go over take the bucket into debt and sleep it off,
+    so that a request larger than the burst still goes through.
+    The state lives in shared memory; buckets work across threads,
+    and across processes that got them when they were started.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        # Available tokens, time of the last refill
+        self._state = multiprocessing.Array(
+            'd', [self.burst, monotonic_time()])
+
+    def consume(self, amount):
+        with self._state.get_lock():
+            tokens, last = self._state
+            now = monotonic_time()
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            tokens -= amount
+            self._state[0] = tokens
+            self._state[1] = now
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
+
+class Throttle(object):
+    """Limits the bytes and the requests bedup reads per second.
+
+    It can also be told to back off (see pressure.PressureMonitor):
+    to slow down every request by a delay, or to pause work that
+    hasn't started yet.
+
+    Also counts requests, for progress reports.
+    """
+
+    def __init__(self, max_read_rate=None, max_iops=None):
+        self.bytes_bucket = self.ops_bucket = None
+        if max_read_rate:
+            self.bytes_bucket = TokenBucket(max_read_rate)
+        if max_iops:
+            self.ops_bucket = TokenBucket(max_iops)
+        self._counters = multiprocessing.Array('Q', 2)
+        # Delay per request, whether new work should wait
+        self._backoff = multiprocessing.Array('d', 2)
+
+    def back_off(self, delay=0., paused=False):
+        with self._backoff.get_lock():
+            self._backoff[0] = delay
+            self._backoff[1] = paused
+
+    def slow_down(self):
+        delay = self._backoff[0]
+        if delay:
+            time.sleep(delay)
+
+    def wait(self):
+        # Call before starting on something that can wait, that is,
+        # before freezing files.  Paused work is only held back here;
+        # elsewhere it gets slowed down.
+        while self._backoff[1]:
+            time.sleep(PAUSE_POLL)
+
+    def charge(self, nbytes):
+        # Waits until one request of nbytes can go
+        self.slow_down()
+        if self.ops_bucket is not None:
+            self.ops_bucket.consume(1)
+        if nbytes and self.bytes_bucket is not None:
+            self.bytes_bucket.consume(nbytes)
+        with self._counters.get_lock():
+            self._counters[0] += nbytes
+            self._counters[1] += 1
+
+    @property
+    def bytes_read(self):
+        return self._counters[0]
+
+    @property
+    def reads(self):
+        return self._counters[1]
+
+
+def inherit(throttle):
+    # Pool initializer; shared memory can't travel with each job
+    global inherited
+    inherited = throttle
@@ -20,7 +20,6 @@
 import errno
 import fcntl
 import gc
-import hashlib
 import os
 import resource
 import stat
@@ -29,29 +28,57 @@ import threading
 
 from collections import defaultdict, namedtuple
 from contextlib import closing, contextmanager, ExitStack
+from functools import partial
 from itertools import groupby
-from sqlalchemy.sql import and_, select, func, literal_column
+from sqlalchemy.sql import and_, or_, select, func, literal_column
 from uuid import UUID
 
 from .platform.btrfs import (
-    get_root_generation, clone_data, defragment as btrfs_defragment, lib)
+    get_root_generation, get_csum_info, clone_data, clone_range,
+    disk_address, extent_referenced, file_extents,
+    defragment as btrfs_defragment, lib)
+from .platform.chattr import getflags, FS_NOCOW_FL
+from .platform.dedupe import dedupe_files, SAME, DIFFERS
+from .platform.fiemap import (
+    extents_in_range, fiemap, has_delalloc, shared_bytes, shared_prefix,
+    unshared_bytes)
 from .platform.openat import fopenat, fopenat_rw
 
 from .datetime import system_now
-from .dedup import ImmutableFDs, cmp_files
+from .dedup import (
+    ImmutableFDs, InUseIndex, clone_chunked, dedupe_same_range, punch_zeroes,
+    source_cost)
+from .devices import DeviceMap, DeviceQueues
 from .filesystem import NotPlugged
-from .hashing import mini_hash_from_file, fiemap_hash_from_file
+from .hashing import (
+    mini_hash_from_file, mini_hash_offset, fiemap_hash_from_file,
+    head_hash_from_file, ZERO_HEAD_HASH, HASH_BLOCK_SIZE,
+    full_hash_from_file, csum_fingerprint, chunk_keys, chunk_count,
+    chunk_layout, hash_chunks, block_digests, same_block_runs,
+    HashJob, HashPool)
 from .model import (
-    Inode, get_or_create, DedupEvent, DedupEventInode)
+    Inode, get_or_create, ChunkDigest, DedupEvent, DedupEventInode,
+    SizeBucketStats)
+from .pipeline import Pipeline, Stage
+from .prefetch import Prefetcher
+from .pressure import PressureMonitor
+from .profiles import apply_profile
+from .reader import Reader
+from .readstats import BUCKET_COUNTS, ReadStats, Tuning
+from .throttle import Throttle
 
 
-BUFSIZE = 8192
-
 WINDOW_SIZE = 200
 
+# How many size groups can wait for sampling when prefetching,
+# this is how far ahead the prefetcher can see.
+PREFETCH_DEPTH = 16
+
 
 def reset_vol(sess, vol):
     # Forgets Inodes, not logging. Make that configurable?
+    # Bulk deletes don't cascade
+    sess.query(ChunkDigest).filter_by(vol_id=vol.impl.id).delete()
     sess.query(Inode).filter_by(vol=vol.impl).delete()
     vol.last_tracked_generation = 0
     sess.commit()
@@ -260,8 +287,15 @@ class WindowedQuery(object):
         self.filt_crit = filt_crit
         self.tt = tt
         self.window_size = window_size
+        # Called with the size groups of each window, returns them
+        # in the order they should be yielded
+        self.reorder = None
 
         self.skipped = []
+        # Windows whose size groups haven't all been through yet,
+        # as [window_start, window_end, sizes left]
+        self.pending = []
+        self.checkpointer = None
 
         # select-only, can't be used for updates
         self.filtered_s = filtered = select(
@@ -306,8 +340,8 @@ class WindowedQuery(object):
         # just to check commit speed
         #sess.commit()
 
-        checkpointer = Checkpointer(self.sess.bind)
-        checkpointer.daemon = True
+        self.checkpointer = Checkpointer(self.sess.bind)
+        self.checkpointer.daemon = True
 
         # [window_start, window_end] is inclusive at both ends
         selectable = self.selectable.order_by(-self.filtered_s.c.size)
@@ -332,15 +366,42 @@ class WindowedQuery(object):
                 window_select, window_select.c.size == Inode.size
             ).order_by(-Inode.size, Inode.ino)
             inodes_by_size = groupby(inodes, lambda inode: inode.size)
+            comms = []
             for size, inodes in inodes_by_size:
                 inodes = list(inodes)
-                yield Commonality1(size, len(inodes), inodes)
-            self.clear_updates(window_start, window_end)
-            checkpointer.please_checkpoint()
+                comms.append(Commonality1(size, len(inodes), inodes))
+            if self.reorder is not None:
+                comms = self.reorder(comms)
+            # Cleared by group_done once every group has been through;
+            # size groups are worked on after they are yielded.
+            self.pending.append([
+                window_start, window_end,
+                set(comm1.size for comm1 in comms)])
+            for comm1 in comms:
+                yield comm1
             window_start = window_end - 1
 
+    def group_done(self, size):
+        # Called once the size group of that size has been through
+        for window in self.pending:
+            window_start, window_end, sizes = window
+            if window_end <= size <= window_start:
+                break
+        else:
+            assert False, size
+        sizes.discard(size)
+        if sizes:
+            return
+        self.pending.remove(window)
+        self.clear_updates(window_start, window_end)
+        self.checkpointer.please_checkpoint()
+
+    def finish(self):
+        # Once all size groups have been through.
+        # Windows left pending keep their updates for the next run.
+        self.flush_skipped()
         self.tt.format('{elapsed} Committing tracking state')
-        checkpointer.close()
+        self.checkpointer.close()
         # Restore fsync so that the final commit (in dedup_tracked)
         # will be durable.
         self.sess.execute('PRAGMA synchronous=FULL;')
@@ -356,11 +417,21 @@ class WindowedQuery(object):
             )).values(
                 has_updates=False))
 
+        self.flush_skipped()
+
+    def flush_skipped(self):
+        # Skips within pending windows wait until those are cleared
+        kept = []
         for inode in self.skipped:
+            if any(
+                window_end <= inode.size <= window_start
+                for (window_start, window_end, sizes) in self.pending
+            ):
+                kept.append(inode)
+                continue
             inode.has_updates = True
         self.sess.commit()
-        # clear the list
-        self.skipped[:] = []
+        self.skipped[:] = kept
 
     def clear_all_updates(self):
         return self.clear_updates(self.upper_bound, 0)
@@ -374,80 +445,587 @@ def hardcode_params_unsafe(query):
     return q2.process(query)
 
 
-def dedup_tracked(sess, volset, tt, defrag):
+# Pipeline stages, in order.
+# Database access happens in the thread that feeds the pipeline.
+PIPELINE_STAGES = (
+    'sample', 'extents', 'csums', 'prefix', 'freeze', 'verify', 'clone')
+# The stages that read file data
+DEVICE_STAGES = ('sample', 'prefix', 'verify')
+
+# What the pipeline workers know about an inode.
+# This is captured by the thread that owns the session;
+# workers mustn't touch ORM attributes, that could trigger a lazy load.
+# chunks holds the chunk digests we know of, as (layout, digest) by index.
+Candidate = namedtuple(
+    'Candidate', 'inode ino size vol size_cutoff has_updates chunks')
+SizeGroup = namedtuple('SizeGroup', 'size candidates')
+
+# Posted by pipeline workers, applied by the thread that owns the session
+SkipRecord = namedtuple('SkipRecord', 'inode')
+# Posted by the pipeline once a size group has been through
+GroupDoneRecord = namedtuple('GroupDoneRecord', 'size')
+DeleteRecord = namedtuple('DeleteRecord', 'inode')
+# freed is what the extents that nothing references anymore took up
+DedupRecord = namedtuple('DedupRecord', 'size candidates freed')
+# punched bytes of a file turned into holes
+PunchRecord = namedtuple('PunchRecord', 'size candidate punched freed')
+ChunkRecord = namedtuple('ChunkRecord', 'inode chunks')
+# length bytes shared between two files of the same size,
+# in one or more ranges
+RangeRecord = namedtuple('RangeRecord', 'size candidates length freed')
+# A file that wasn't shared because that would free less than min_gain
+LowGainRecord = namedtuple('LowGainRecord', 'size candidate estimate')
+
+# Shorter runs of zeroes aren't worth fragmenting files over
+PUNCH_MIN_SIZE = 128 * 1024
+
+# Files below this are hashed in one go
+PREFIX_MIN_SIZE = 16 * 1024 ** 2
+
+# Files below this are only deduplicated whole
+PARTIAL_MIN_SIZE = 16 * 1024 ** 2
+
+# Files below this aren't looked at for common prefixes
+COMMON_PREFIX_MIN_SIZE = 1024 ** 2
+# Of the files that start the same and changed since the last run,
+# only the longest this many are compared to the longest file
+COMMON_PREFIX_MAX_GROUP = 100
+
+
+def load_stats(sess, fs):
+    # The stats of earlier runs, in the form readstats.Tuning takes
+    return dict(
+        (row.bucket, dict(
+            (name, getattr(row, name))
+            for name in BUCKET_COUNTS + ('bytes_read', 'reads')))
+        for row in sess.query(SizeBucketStats).filter_by(fs=fs.impl))
+
+
+def save_stats(sess, fs, stats):
+    # Adds the stats of this run to those of earlier runs
+    for (bucket, counts) in stats.by_bucket().items():
+        row, created = get_or_create(
+            sess, SizeBucketStats, fs=fs.impl, bucket=bucket)
+        for (name, value) in counts.items():
+            setattr(row, name, (getattr(row, name) or 0) + value)
+
+
+class DedupOptions(object):
+    """What a dedup pass does, see the dedup command for the meaning
+    of each option.  Options that aren't given keep these defaults.
+    """
+
+    defrag = False
+    hash_workers = 0
+    # Workers by pipeline stage, on top of the defaults
+    concurrency = None
+    prefetch = 0
+    drop_cache = False
+    direct_io = False
+    punch_zeros = False
+    digest_cache = None
+    elevator = False
+    device_concurrency = 0
+    checkpoint_above = None
+    max_read_rate = None
+    max_iops = None
+    pressure_slow = None
+    pressure_pause = None
+    pressure_cgroup = None
+    # Scheduling profiles by phase
+    profiles = None
+    autotune = False
+    engine = 'clone'
+    clone_chunk = None
+    partial_block = None
+    common_prefix = False
+    min_gain = None
+
+    def __init__(self, **options):
+        for (name, value) in options.items():
+            if name.startswith('_') or not hasattr(DedupOptions, name):
+                raise TypeError('Unknown dedup option %r' % name)
+            setattr(self, name, value)
+
+
+def dedup_tracked(sess, volset, tt, options=None):
+    options = options or DedupOptions()
     fs = volset[0].fs
     vol_ids = [vol.impl.id for vol in volset]
     assert all(vol.fs == fs for vol in volset)
 
+    defaults = dict.fromkeys(PIPELINE_STAGES, 1)
+    device_map = None
+    if options.device_concurrency:
+        device_map = DeviceMap.of_volume(volset[0].fd)
+        # Enough readers to keep every device busy
+        for stage in DEVICE_STAGES:
+            defaults[stage] = options.device_concurrency * max(
+                1, len(device_map.devids))
+    concurrency = dict(defaults, **(options.concurrency or {}))
+
     # 3 for stdio, 3 for sqlite (wal mode), 1 that somehow doesn't
-    # get closed, 1 per volume.
-    ofile_reserved = 7 + len(volset)
+    # get closed, 1 per volume, 1 per sampling worker.
+    ofile_reserved = (
+        7 + len(volset) + concurrency['sample'] + concurrency['extents']
+        + concurrency['prefix'])
 
     inode = Inode.__table__
     inode_filt = inode.c.vol_id.in_(vol_ids)
     if len(volset) > 490:
         # SQLite 3 has a hardcoded limit on query parameters
         inode_filt = hardcode_params_unsafe(inode_filt)
-    query = WindowedQuery(sess, inode, inode_filt, tt)
+    tuning = Tuning(load_stats(sess, fs) if options.autotune else {})
+    query = WindowedQuery(
+        sess, inode, inode_filt, tt, tuning.window_size(WINDOW_SIZE))
     le = len(query)
-    ds = DedupSession(sess, tt, defrag, fs, query, ofile_reserved)
+    ds = DedupSession(
+        sess, tt, volset, query, ofile_reserved, options, tuning, device_map)
+    throttle = ds.throttle
+    if ds.elevator:
+        query.reorder = ds.elevator_order
+
+    if options.common_prefix:
+        # Before the size groups clear has_updates
+        dedup_common_prefixes(ds, inode_filt)
 
     if le:
         # Hopefully close any files we left around
         gc.collect()
 
-        tt.format(
-            '{elapsed} Size group {comm1:counter}/{comm1:total} ({size:size}) '
-            'sampled {mhash:counter} hashed {fhash:counter} '
-            'freed {space_gain:size}')
-        tt.set_total(comm1=le)
-        for comm1 in query:
-            dedup_tracked1(ds, comm1)
-        tt.format(None)
+        if options.hash_workers:
+            # Pool workers do the verify stage's hashing
+            ds.hash_pool = HashPool(
+                options.hash_workers, throttle, ds.profiles.get('verify'),
+                ds.device_queues)
+        if options.prefetch:
+            ds.prefetcher = Prefetcher(options.prefetch, ds.reader)
+        if options.pressure_slow is not None:
+            pressure = PressureMonitor(
+                throttle, options.pressure_slow,
+                options.pressure_pause
+                if options.pressure_pause is not None else 100.,
+                options.pressure_cgroup)
+            if pressure.available():
+                ds.pressure = pressure
+                ds.pressure.start()
+            else:
+                tt.notify(
+                    'No pressure information (needs Linux 4.20 with PSI), '
+                    'not watching pressure')
+        try:
+            tt.format(
+                '{elapsed} Size group {comm1:counter}/{comm1:total} '
+                '({size:size}) '
+                'sampled {mhash:counter} hashed {fhash:counter} '
+                'read {read_bytes:size} in {reads} '
+                'cloned {cloned:size} freed {space_gain:size} [{stages}]')
+            tt.set_total(comm1=le)
+            pipeline = ds.make_pipeline(concurrency)
+            with pipeline:
+                for comm1 in query:
+                    tt.update(comm1=comm1, size=comm1.size)
+                    group = ds.size_group(comm1)
+                    if ds.prefetcher is not None and not ds.partial(
+                        group.size
+                    ):
+                        # Those aren't sampled
+                        ds.prefetcher.submit(group)
+                    for record in pipeline.feed(
+                        group, done=GroupDoneRecord(comm1.size)
+                    ):
+                        ds.apply(record)
+                    tt.update(
+                        stages=pipeline.occupancy(),
+                        read_bytes=throttle.bytes_read, reads=throttle.reads)
+                for record in pipeline.drain():
+                    ds.apply(record)
+            query.finish()
+            tt.notify('Stage occupancy: %s' % ', '.join(
+                '%s %d%%' % (name, 100 * busy)
+                for (name, busy) in pipeline.utilisation()))
+            tt.notify(
+                'Read %d bytes in %d requests'
+                % (throttle.bytes_read, throttle.reads))
+            if ds.digest_cache is not None:
+                tt.notify(
+                    'Digest cache: %d chunks found, %d read'
+                    % (ds.digest_cache.hits, ds.digest_cache.misses))
+            if ds.min_gain is not None:
+                tt.notify(
+                    'Left %d files alone that would free less than %d bytes'
+                    % (ds.low_gain, ds.min_gain))
+            tt.notify('Reads by size:\n%s' % '\n'.join(ds.stats.summary()))
+            save_stats(sess, fs, ds.stats)
+            tt.format(None)
+        finally:
+            if ds.pressure is not None:
+                ds.pressure.close()
+            if ds.prefetcher is not None:
+                ds.prefetcher.close()
+            if ds.hash_pool is not None:
+                ds.hash_pool.close()
     else:
         query.clear_all_updates()
     sess.commit()
     tt.format(None)
 
 
-
 class DedupSession(object):
-    space_gain = 0
-
-    def __init__(self, sess, tt, defrag, fs, query, ofile_reserved):
+    def __init__(
+        self, sess, tt, volset, query, ofile_reserved, options, tuning,
+        device_map=None,
+    ):
         self.sess = sess
         self.tt = tt
-        self.defrag = defrag
-        self.fs = fs
+        self.fs = volset[0].fs
         self.query = query
         self.ofile_reserved = ofile_reserved
+        self.tuning = tuning
+
+        self.defrag = options.defrag
+        self.engine = options.engine
+        self.elevator = options.elevator
+        self.digest_cache = options.digest_cache
+        self.checkpoint_min = options.checkpoint_above
+        self.clone_chunk = options.clone_chunk
+        self.partial_block = options.partial_block
+        self.min_gain = options.min_gain
+        self.profiles = options.profiles or {}
+        self.punch_min = PUNCH_MIN_SIZE if options.punch_zeros else None
+        self.device_queues = None
+        if device_map is not None:
+            self.device_queues = DeviceQueues(
+                device_map, options.device_concurrency)
+        # Also counts reads when there are no limits
+        self.throttle = Throttle(options.max_read_rate, options.max_iops)
+        self.stats = ReadStats()
+        self.reader = Reader(
+            drop_cache=options.drop_cache, direct_io=options.direct_io,
+            throttle=self.throttle, stats=self.stats,
+            device_queues=self.device_queues)
+        self.csum_info = get_csum_info(volset[0].fd)
+        # Extent addresses only mean something within a filesystem
+        self.fs_key = str(self.fs.uuid)
+        # Started by dedup_tracked when asked for
+        self.hash_pool = None
+        # Bounds the sets that are frozen ahead of the verify stage,
+        # set along with the hash pool
+        self.hash_slots = None
+        self.prefetcher = None
+        self.pressure = None
+
+        self.space_gain = 0
+        # Files left alone because of min_gain
+        self.low_gain = 0
+        # Bytes cloned or deduped so far
+        self.cloned = 0
+        # Direction of the next elevator sweep
+        self.ascending = True
         self.ofile_soft, self.ofile_hard = resource.getrlimit(
             resource.RLIMIT_OFILE)
-
-    def skip(self, inode):
-        self.query.skipped.append(inode)
+        # Files held open by sets that are being verified or cloned
+        self.ofile_in_use = 0
+        self.ofile_cond = threading.Condition()
+        self.post = None
+        self.cloned_lock = threading.Lock()
+        # Files chunk_keys has synced, by stat identifier
+        self.synced = set()
+        self.synced_lock = threading.Lock()
+        # Sets that get frozen around the same time share /proc scans
+        self.in_use_index = InUseIndex()
+
+    def make_pipeline(self, concurrency):
+        if self.prefetcher is not None:
+            sample_depth = PREFETCH_DEPTH
+        else:
+            sample_depth = None
+        verify_depth = concurrency['verify']
+        if self.hash_pool is not None:
+            # Enough sets being hashed to keep every worker busy,
+            # and no more: they are frozen while they wait
+            verify_depth = max(verify_depth, self.hash_pool.processes)
+            self.hash_slots = threading.Semaphore(self.hash_pool.processes)
+        pipeline = Pipeline([
+            Stage(
+                'sample', partial(sample_group, self),
+                concurrency['sample'], depth=sample_depth,
+                setup=self.stage_setup('sample')),
+            Stage(
+                'extents', partial(check_extents, self),
+                concurrency['extents'], setup=self.stage_setup('extents')),
+            Stage(
+                'csums', partial(narrow_by_csums, self),
+                concurrency['csums'], setup=self.stage_setup('csums')),
+            Stage(
+                'prefix', partial(narrow_by_prefix, self),
+                concurrency['prefix'], setup=self.stage_setup('prefix')),
+            Stage(
+                'freeze', partial(freeze_dupset, self),
+                concurrency['freeze'], setup=self.stage_setup('freeze')),
+            Stage(
+                'verify', partial(verify_dupset, self),
+                concurrency['verify'], discard=self.close_dupset,
+                depth=verify_depth, setup=self.stage_setup('verify')),
+            Stage(
+                'clone', partial(clone_dupset, self),
+                concurrency['clone'], discard=self.close_dupset,
+                setup=self.stage_setup('clone')),
+        ], apply=self.apply)
+        self.post = pipeline.post
+        return pipeline
+
+    def stage_setup(self, name):
+        # Workers of a stage start with its scheduling profile
+        if name in self.profiles:
+            return partial(apply_profile, self.profiles[name])
+
+    def elevator_order(self, comms):
+        # Sorts the size groups of a window, and the inodes within
+        # each group, by where their samples are on disk.
+        # Windows are swept in alternating directions, so that the
+        # heads don't have to travel back before each window.
+        # Inodes with no address (holes, inline data) go last.
+        def inode_key(inode):
+            self.reader.charge(0)
+            addr = disk_address(
+                inode.vol.live.fd, inode.ino, mini_hash_offset(inode.size))
+            if addr is None:
+                return True, 0
+            return False, addr if self.ascending else -addr
+
+        ordered = []
+        for comm1 in comms:
+            keyed = sorted(
+                ((inode_key(inode), inode) for inode in comm1.inodes),
+                key=lambda pair: pair[0])
+            ordered.append((keyed[0][0], Commonality1(
+                comm1.size, comm1.inode_count,
+                [inode for (key, inode) in keyed])))
+        ordered.sort(key=lambda pair: pair[0])
+        self.ascending = not self.ascending
+        return [comm1 for (key, comm1) in ordered]
+
+    def file_address(self, afile, dupset):
+        # Where a frozen file starts on disk, for ordering full reads
+        cand = dupset.fd_candidates[afile.fileno()]
+        self.reader.charge(0)
+        addr = disk_address(cand.vol.fd, cand.ino, 0)
+        if addr is None:
+            return True, 0
+        return False, addr
+
+    def size_group(self, comm1):
+        return SizeGroup(comm1.size, [
+            self.candidate(inode) for inode in comm1.inodes])
+
+    def candidate(self, inode):
+        return Candidate(
+            inode=inode, ino=inode.ino, size=inode.size,
+            vol=inode.vol.live, size_cutoff=inode.vol.size_cutoff,
+            has_updates=inode.has_updates,
+            chunks=self.stored_chunks(inode))
+
+    def stored_chunks(self, inode):
+        if inode.size < PREFIX_MIN_SIZE and not self.checkpointed(inode):
+            return {}
+        return dict(
+            (cd.idx, (cd.layout, cd.digest)) for cd in inode.chunk_digests)
+
+    def apply(self, record):
+        # Only call this from the thread that owns the session
+        if isinstance(record, SkipRecord):
+            self.query.skipped.append(record.inode)
+        elif isinstance(record, GroupDoneRecord):
+            self.query.group_done(record.size)
+        elif isinstance(record, DeleteRecord):
+            self.sess.delete(record.inode)
+        elif isinstance(record, DedupRecord):
+            self.add_event(
+                record.size, record.size, record.candidates, record.freed)
+        elif isinstance(record, RangeRecord):
+            # One event per pair of files,
+            # whose item_size is the length they share
+            self.add_event(
+                record.size, record.length, record.candidates, record.freed)
+        elif isinstance(record, LowGainRecord):
+            self.low_gain += 1
+        elif isinstance(record, PunchRecord):
+            # One event per file, whose item_size is the length punched
+            self.add_event(
+                record.size, record.punched, [record.candidate],
+                record.freed)
+        elif isinstance(record, ChunkRecord):
+            inode = record.inode
+            if inode in self.sess.deleted or inode not in self.sess:
+                # Deleted in the meantime
+                return
+            stored = dict((cd.idx, cd) for cd in inode.chunk_digests)
+            for (idx, (layout, digest)) in record.chunks.items():
+                if idx in stored:
+                    stored[idx].layout = layout
+                    stored[idx].digest = digest
+                else:
+                    inode.chunk_digests.append(ChunkDigest(
+                        idx=idx, layout=layout, digest=digest))
+            # Checkpoints are for runs that get interrupted
+            self.sess.commit()
+        else:
+            assert False, record
+
+    def add_event(self, size, item_size, candidates, freed):
+        evt = DedupEvent(
+            fs=self.fs.impl, item_size=item_size, created=system_now(),
+            space_gain=freed)
+        self.sess.add(evt)
+        for cand in candidates:
+            self.sess.add(DedupEventInode(
+                event=evt, ino=cand.ino, vol=cand.inode.vol))
+        self.sess.commit()
+        self.stats.count(size, freed=freed)
+        self.space_gain += freed
+        self.tt.update(space_gain=self.space_gain)
+
+    def count_cloned(self, nbytes):
+        with self.cloned_lock:
+            self.cloned += nbytes
+            self.tt.update(cloned=self.cloned)
+
+    def clone_progress(self, nbytes):
+        # Called by the clone stage between ranges
+        self.count_cloned(nbytes)
+        self.throttle.slow_down()
+
+    def enough_gain(self, dupset, fd, extents, ranges):
+        # Whether sharing (start, end) ranges of a file would free
+        # at least min_gain, going by how much of them isn't already
+        # shared.  Files that are left alone are recorded.
+        if self.min_gain is None:
+            return True
+        estimate = sum(
+            unshared_bytes(extents, start, end) for (start, end) in ranges)
+        if estimate >= self.min_gain:
+            return True
+        cand = dupset.fd_candidates[fd]
+        self.tt.notify(
+            'Would free %d bytes, skipping %r'
+            % (estimate, cand.vol.describe_path(dupset.fd_names[fd])))
+        self.post(LowGainRecord(dupset.size, cand, estimate))
+        return False
+
+    def fiemap(self, fd):
+        # Metadata requests go through the limits like reads do
+        return list(fiemap(fd, charge=self.reader.charge))
+
+    def file_extents(self, cand):
+        self.reader.charge(0)
+        return list(file_extents(cand.vol.fd, cand.ino))
+
+    def extent_refs(self, cands):
+        # The data extents files reference, disk_bytenr -> disk_num_bytes
+        refs = {}
+        for cand in cands:
+            for extent in self.file_extents(cand):
+                if extent.disk_bytenr:
+                    refs[extent.disk_bytenr] = extent.disk_num_bytes
+        return refs
+
+    def released_extents(self, before, cands):
+        # The extents of before (from extent_refs) that nothing
+        # references anymore, now that cands share their data.
+        # An extent stays allocated as long as a file (or a snapshot)
+        # references some of it.
+        after = self.extent_refs(cands)
+        volume_fd = cands[0].vol.fd
+        released = {}
+        for (bytenr, num_bytes) in before.items():
+            if bytenr in after:
+                continue
+            self.reader.charge(0)
+            if not extent_referenced(volume_fd, bytenr):
+                released[bytenr] = num_bytes
+        return released
+
+    def by_source_cost(self, dupset, fds):
+        # Orders fds so that the one with the best layout to keep,
+        # as judged by dedup.source_cost, comes first
+        def cost(fd):
+            cand = dupset.fd_candidates[fd]
+            extents = self.file_extents(cand)
+            return source_cost(
+                extents, shared_bytes(fd, self.reader.charge))
+
+        return sorted(fds, key=cost)
+
+    def partial(self, size):
+        # Whether files of that size may get their common blocks shared
+        return self.partial_block is not None and size >= PARTIAL_MIN_SIZE
+
+    def skip(self, cand):
+        self.post(SkipRecord(cand.inode))
+
+    def delete(self, cand):
+        self.post(DeleteRecord(cand.inode))
+
+    def reserve_ofiles(self, inode_count):
+        # Returns False if that many files can't be opened,
+        # even once other sets have been closed.
+        # XXX I have no justification for doubling inode_count
+        req = 2 * inode_count
+        with self.ofile_cond:
+            while True:
+                ofile_req = self.ofile_in_use + req + self.ofile_reserved
+                if ofile_req <= self.ofile_soft:
+                    break
+                if ofile_req <= self.ofile_hard:
+                    resource.setrlimit(
+                        resource.RLIMIT_OFILE, (ofile_req, self.ofile_hard))
+                    self.ofile_soft = ofile_req
+                    break
+                if not self.ofile_in_use:
+                    return False
+                self.ofile_cond.wait()
+            self.ofile_in_use += req
+        return True
+
+    def close_dupset(self, dupset):
+        # Unfreezes and closes the files of a verified set
+        self.release_hash_slot(dupset)
+        if dupset.stack is not None:
+            dupset.stack.close()
+            dupset.stack = None
+        if dupset.ofiles:
+            with self.ofile_cond:
+                self.ofile_in_use -= 2 * dupset.ofiles
+                self.ofile_cond.notify_all()
+            dupset.ofiles = 0
+
+    def release_hash_slot(self, dupset):
+        if dupset.hash_slot:
+            dupset.hash_slot = False
+            self.hash_slots.release()
 
     @contextmanager
-    def open_by_inode(self, inode):
+    def open_by_inode(self, cand):
         try:
-            path = inode.vol.live.lookup_one_path(inode)
+            path = cand.vol.lookup_one_path(cand)
         except IOError as e:
             if e.errno != errno.ENOENT:
                 raise
             # Delete stale inodes;
             # some do survive because the number is reused.
-            self.sess.delete(inode)
+            self.delete(cand)
             yield None
             return
 
         try:
-            rfile = fopenat(inode.vol.live.fd, path)
+            rfile = fopenat(cand.vol.fd, path)
         except IOError as e:
             if e.errno not in (errno.ENOENT, errno.EISDIR):
                 raise
             # Don't delete an inode if it was moved by a racing process;
             # mark it for the next run.
-            self.skip(inode)
+            self.skip(cand)
             yield None
             return
 
@@ -456,12 +1034,205 @@ class DedupSession(object):
         finally:
             rfile.close()
 
-
-def dedup_tracked1(ds, comm1):
-    size = comm1.size
-    ds.tt.update(comm1=comm1, size=size)
+    def chunk_keys(self, afile, vol):
+        # The chunk keys of an open file, see hashing.chunk_keys.
+        # None if its extents don't identify its contents.
+        fd = afile.fileno()
+        if getflags(fd) & FS_NOCOW_FL:
+            # Overwritten in place
+            return
+        # Data that wasn't written back isn't in the extent items yet.
+        # Files get synced once; one that is dirty again is being
+        # written to, its keys wouldn't last.
+        if has_delalloc(fd, self.reader.charge):
+            st = os.fstat(fd)
+            with self.synced_lock:
+                if (st.st_dev, st.st_ino) in self.synced:
+                    return
+                self.synced.add((st.st_dev, st.st_ino))
+            os.fdatasync(fd)
+            if has_delalloc(fd, self.reader.charge):
+                return
+        st = os.fstat(fd)
+        return [
+            key and (self.fs_key, key)
+            for key in chunk_keys(
+                vol.fd, st.st_ino, st.st_size, self.reader)]
+
+    def known_chunks(self, cand, keys, indexes):
+        # The digests we already have for some chunks of cand,
+        # from earlier prefix hashing or from the digest cache
+        known = {}
+        for idx in indexes:
+            key = keys[idx]
+            if key is None:
+                continue
+            stored = cand.chunks.get(idx)
+            if stored is not None and stored[0] == chunk_layout(key):
+                known[idx] = stored[1]
+            elif self.digest_cache is not None:
+                digest = self.digest_cache.get(key)
+                if digest is not None:
+                    known[idx] = digest
+        return known
+
+    def checkpointed(self, cand):
+        # Whether reading cand leaves a trail of chunk digests
+        # for later runs to start from
+        return self.checkpoint_min is not None \
+            and cand.size >= self.checkpoint_min
+
+    def store_chunks(self, cand, keys, chunks):
+        # Keeps the digests of chunks read from cand, for this run
+        # and the next ones
+        stored = dict(
+            (idx, (chunk_layout(keys[idx]), digest))
+            for (idx, digest) in chunks.items()
+            if idx < len(keys) and keys[idx] is not None)
+        if stored:
+            cand.chunks.update(stored)
+            self.post(ChunkRecord(cand.inode, stored))
+
+    def cached_chunks(self, afile, dupset):
+        # Returns the chunk keys of a file and the chunk digests
+        # we already know, by chunk index.
+        cand = dupset.fd_candidates[afile.fileno()]
+        if self.digest_cache is None and not cand.chunks \
+                and not self.checkpointed(cand):
+            return (), {}
+        keys = self.chunk_keys(afile, cand.vol)
+        if keys is None:
+            return (), {}
+        return keys, self.known_chunks(cand, keys, range(len(keys)))
+
+    def remember_chunks(self, keys, chunks):
+        if self.digest_cache is None or not chunks:
+            return
+        for (idx, digest) in chunks.items():
+            if idx < len(keys) and keys[idx] is not None:
+                self.digest_cache.put(keys[idx], digest)
+
+    def submit_hashes(self, files, dupset):
+        # Hands files over to the pool, if there is one; the results
+        # are collected by hash_files.
+        # Files that get checkpoints are hashed by hash_files itself,
+        # the pool can't hand back digests before it is done.
+        if self.hash_pool is None:
+            return
+        for afile in files:
+            fd = afile.fileno()
+            cand = dupset.fd_candidates[fd]
+            if self.checkpointed(cand):
+                continue
+            keys, known = self.cached_chunks(afile, dupset)
+            job = HashJob(
+                vol_path='/proc/%d/fd/%d' % (os.getpid(), cand.vol.fd),
+                path=dupset.fd_names[fd], ino=cand.ino, size=cand.size,
+                known=known,
+                prefetched=self.reader.take_prefetched(fd, 0, cand.size))
+            dupset.pending[fd] = keys, self.hash_pool.submit(
+                job, self.reader, self.punch_min)
+
+    def hash_files(self, files, dupset):
+        # Yields (digest, size, zeroes) in the same order as files;
+        # the digest is None if a file couldn't be hashed.
+        for afile in files:
+            fd = afile.fileno()
+            if fd in dupset.pending:
+                keys, result = dupset.pending.pop(fd)
+                yield self.pool_result(afile, keys, result.get(), dupset)
+            else:
+                keys, known = self.cached_chunks(afile, dupset)
+                yield self.hash_file(afile, keys, known, dupset)
+
+    def hash_file(self, afile, keys, known, dupset):
+        cand = dupset.fd_candidates[afile.fileno()]
+        checkpoint = None
+        if keys and self.checkpointed(cand):
+            checkpoint = partial(self.store_chunks, cand, keys)
+        try:
+            digest, size, zeroes, chunks = full_hash_from_file(
+                afile, self.reader, self.punch_min, known, checkpoint)
+        except OSError as e:
+            if e.errno == errno.EIO:
+                return None, None, None
+            raise
+        self.remember_chunks(keys, chunks)
+        return digest, size, zeroes
+
+    def pool_result(self, afile, keys, result, dupset):
+        # Takes in a HashResult, returns (digest, size, zeroes)
+        cand = dupset.fd_candidates[afile.fileno()]
+        # Workers have their own stats
+        self.stats.add(*result.read, stage='verify', size=cand.size)
+        if result.digest is None and result.ino != cand.ino:
+            # The path doesn't lead to the file we froze anymore
+            self.skip(cand)
+        self.remember_chunks(keys, result.chunks)
+        return result.digest, result.size, result.zeroes
+
+
+class DupSet(object):
+    """Candidates of the same size that may turn out to be identical.
+
+    From the freeze stage on, it holds the frozen files until they
+    are cloned.
+    """
+
+    def __init__(self, size, candidates):
+        self.size = size
+        self.candidates = candidates
+        # Set by freeze_dupset
+        self.stack = None
+        self.ofiles = 0
+        # Set by start_hashing
+        self.hashing = False
+        self.immutability = None
+        self.hash_slot = False
+        # For description only
+        self.fd_names = {}
+        self.fd_candidates = {}
+        self.fd_files = {}
+        self.filesets = ()
+        # Files to hash, in order, and the keys and pool results
+        # of those that are being hashed in the pool, by fd
+        self.hashable = []
+        self.pending = {}
+        # Stored zeroes to punch, by fd
+        self.zeroes = {}
+        # Block digests of files that differ, by fd, for partial dedup
+        self.blocks = {}
+
+
+def sample_group(ds, group):
+    ds.throttle.wait()
+    ds.stats.count(group.size, groups=1)
+    try:
+        if ds.partial(group.size):
+            # Files that differ where they get sampled may still have
+            # most of their blocks in common; block digests will tell
+            by_mh = {None: group.candidates}
+        else:
+            with ds.stats.context('sample', group.size):
+                by_mh = sample_group1(ds, group)
+    finally:
+        if ds.prefetcher is not None:
+            ds.prefetcher.release(group)
+
+    for cands in by_mh.values():
+        if len(cands) >= 2:
+            dupset = DupSet(group.size, cands)
+            if ds.prefetcher is not None:
+                # Only sets that may have duplicates get their heads read
+                ds.prefetcher.submit_heads(dupset)
+            yield dupset
+
+
+def sample_group1(ds, group):
     by_mh = defaultdict(list)
-    for inode in comm1.inodes:
+    # More samples for sizes where they used to let non-duplicates through
+    samples = ds.tuning.samples(group.size)
+    for cand in group.candidates:
         # XXX Need to cope with deleted inodes.
         # We cannot find them in the search-new pass, not without doing
         # some tracking of directory modifications to poke updated
@@ -471,69 +1242,188 @@ def dedup_tracked1(ds, comm1):
         # I don't know enough about how inode transaction numbers are
         # updated (as opposed to extent updates) to be able to actually
         # cache the result
-        with ds.open_by_inode(inode) as rfile:
+        with ds.open_by_inode(cand) as rfile:
             if rfile is None:
                 continue
             try:
-                by_mh[mini_hash_from_file(inode, rfile)].append(inode)
+                mini_hash = mini_hash_from_file(
+                    cand, rfile, ds.reader, samples)
+                by_mh[mini_hash].append(cand)
             except IOError as e:
                 if e.errno == errno.EIO:
-                    ds.tt.notify('%r has IO errors, skipping' % inode)
+                    ds.tt.notify(
+                        'Inode %d of %s has IO errors, skipping'
+                        % (cand.ino, cand.vol))
                     continue
                 raise
             ds.tt.update(mhash=None)
+    return by_mh
 
-    for inodes in by_mh.values():
-        inode_count = len(inodes)
-        if inode_count < 2:
-            continue
-        fies = set()
-        for inode in inodes:
-            with ds.open_by_inode(inode) as rfile:
-                if rfile is None:
-                    continue
-                fies.add(fiemap_hash_from_file(rfile))
-
-        if len(fies) < 2:
-            continue
-
-        files = []
-        fds = []
-        # For description only
-        fd_names = {}
-        fd_inodes = {}
-        by_hash = defaultdict(list)
 
-        # XXX I have no justification for doubling inode_count
-        ofile_req = 2 * inode_count + ds.ofile_reserved
-        if ofile_req > ds.ofile_soft:
-            if ofile_req <= ds.ofile_hard:
-                resource.setrlimit(
-                    resource.RLIMIT_OFILE, (ofile_req, ds.ofile_hard))
-                ds.ofile_soft = ofile_req
+def check_extents(ds, dupset):
+    fies = set()
+    for cand in dupset.candidates:
+        with ds.open_by_inode(cand) as rfile:
+            if rfile is None:
+                continue
+            with ds.stats.context('extents', dupset.size):
+                fies.add(fiemap_hash_from_file(rfile, ds.reader.charge))
+
+    if len(fies) >= 2:
+        yield dupset
+    elif ds.prefetcher is not None:
+        ds.prefetcher.release(dupset)
+
+
+def narrow_by_csums(ds, dupset):
+    # Files whose data checksums differ can't be identical,
+    # and finding out doesn't take any data reads.
+    # If some files don't have usable checksums,
+    # we can't tell them apart from the others this way.
+    if ds.prefetcher is not None:
+        # Past the extents check, heads get read soon enough
+        ds.prefetcher.release(dupset)
+    if ds.partial(dupset.size):
+        # Files that differ may still have blocks in common
+        yield dupset
+        return
+    by_fp = defaultdict(list)
+    for cand in dupset.candidates:
+        fp = csum_fingerprint(
+            cand.vol.fd, cand.ino, cand.size, ds.csum_info, ds.reader)
+        if fp is None:
+            yield dupset
+            return
+        by_fp[fp].append(cand)
+
+    for cands in by_fp.values():
+        if len(cands) >= 2:
+            yield DupSet(dupset.size, cands)
+
+
+def narrow_by_prefix(ds, dupset):
+    # Large files are compared a growing prefix at a time:
+    # the first chunk, then the next two, the next four and so on,
+    # splitting the set whenever digests differ.  Files that are left
+    # without a match aren't read any further.
+    # The rest is left to the full hash, which reuses what was read here.
+    if not ds.tuning.hash_worthwhile(dupset.size):
+        # Sizes that never turned out to have duplicates go no further.
+        # Their files weren't looked at, they keep their updates.
+        for cand in dupset.candidates:
+            if cand.has_updates:
+                ds.skip(cand)
+        return
+    if dupset.size < PREFIX_MIN_SIZE or ds.partial(dupset.size):
+        yield dupset
+        return
+    ds.throttle.wait()
+    with ds.stats.context('prefix', dupset.size):
+        groups = prefix_groups(ds, dupset)
+    for cands in groups:
+        yield DupSet(dupset.size, cands)
+
+
+def prefix_groups(ds, dupset):
+    count = chunk_count(dupset.size)
+    groups = [dupset.candidates]
+    start = 0
+    tier = 1
+    while groups and start + tier < count:
+        indexes = list(range(start, start + tier))
+        next_groups = []
+        for cands in groups:
+            by_digests = defaultdict(list)
+            for cand in cands:
+                digests = prefix_digests(ds, cand, indexes)
+                if digests is not None:
+                    by_digests[digests].append(cand)
+            next_groups.extend(
+                cands1 for cands1 in by_digests.values() if len(cands1) >= 2)
+        groups = next_groups
+        start += tier
+        tier *= 2
+    return groups
+
+
+def prefix_digests(ds, cand, indexes):
+    # The digests of some chunks of cand, as a tuple.
+    # None if the file couldn't be read.
+    with ds.open_by_inode(cand) as rfile:
+        if rfile is None:
+            return
+        size = os.fstat(rfile.fileno()).st_size
+        if size != cand.size:
+            ds.skip(cand)
+            return
+        keys = ds.chunk_keys(rfile, cand.vol)
+        if keys is None:
+            known = {}
+        else:
+            known = ds.known_chunks(cand, keys, indexes)
+        missing = [idx for idx in indexes if idx not in known]
+        try:
+            if missing:
+                read = hash_chunks(rfile, missing, ds.reader)
             else:
+                read = {}
+        except IOError as e:
+            if e.errno == errno.EIO:
                 ds.tt.notify(
-                    'Too many duplicates (%d at size %d), '
-                    'would bring us over the open files limit (%d, %d).'
-                    % (inode_count, size, ds.ofile_soft, ds.ofile_hard))
-                for inode in inodes:
-                    if inode.has_updates:
-                        ds.skip(inode)
-                continue
+                    'Inode %d of %s has IO errors, skipping'
+                    % (cand.ino, cand.vol))
+                return
+            raise
+        # Only keep what was read if the file didn't change meanwhile
+        if keys is not None and read and ds.chunk_keys(
+            rfile, cand.vol
+        ) == keys:
+            ds.store_chunks(cand, keys, read)
+            ds.remember_chunks(keys, read)
+
+    digests = dict(known)
+    digests.update(read)
+    return tuple(digests[idx] for idx in indexes)
+
+
+def freeze_dupset(ds, dupset):
+    # Opens the files of a set.  With a hash pool, also freezes them
+    # and starts hashing them, so that the sets queued for the verify
+    # stage keep the pool busy; there are no more of those than the pool
+    # has workers.  Otherwise the verify stage does that, so that sets
+    # don't wait frozen while others are hashed.
+    ds.throttle.wait()
+    size = dupset.size
+    inode_count = len(dupset.candidates)
+    if not ds.reserve_ofiles(inode_count):
+        ds.tt.notify(
+            'Too many duplicates (%d at size %d), '
+            'would bring us over the open files limit (%d, %d).'
+            % (inode_count, size, ds.ofile_soft, ds.ofile_hard))
+        for cand in dupset.candidates:
+            if cand.has_updates:
+                ds.skip(cand)
+        return
+    dupset.ofiles = inode_count
+    dupset.stack = stack = ExitStack()
+    ds.stats.count(size, verified=1)
+
+    try:
+        files = []
 
-        for inode in inodes:
+        for cand in dupset.candidates:
             # Open everything rw, we can't pick one for the source side
             # yet because the crypto hash might eliminate it.
             # We may also want to defragment the source.
             try:
-                path = inode.vol.live.lookup_one_path(inode)
+                path = cand.vol.lookup_one_path(cand)
             except IOError as e:
                 if e.errno == errno.ENOENT:
-                    ds.sess.delete(inode)
+                    ds.delete(cand)
                     continue
                 raise
             try:
-                afile = fopenat_rw(inode.vol.live.fd, path)
+                afile = fopenat_rw(cand.vol.fd, path)
             except IOError as e:
                 if e.errno == errno.ETXTBSY:
                     # The file contains the image of a running process,
@@ -547,102 +1437,511 @@ def dedup_tracked1(ds, comm1):
                     ds.tt.notify('File %r may have moved, skipping' % path)
                 else:
                     raise
-                ds.skip(inode)
+                ds.skip(cand)
                 continue
+            stack.enter_context(closing(afile))
 
             # It's not completely guaranteed we have the right inode,
             # there may still be race conditions at this point.
             # Gets re-checked below (tell and fstat).
             fd = afile.fileno()
-            fd_inodes[fd] = inode
-            fd_names[fd] = path
+            dupset.fd_candidates[fd] = cand
+            dupset.fd_names[fd] = path
+            dupset.fd_files[fd] = afile
             files.append(afile)
-            fds.append(fd)
-
-        with ExitStack() as stack:
-            for afile in files:
-                stack.enter_context(closing(afile))
-            # Enter this context last
-            immutability = stack.enter_context(ImmutableFDs(fds))
 
-            # With a false positive, some kind of cmp pass that compares
-            # all files at once might be more efficient that hashing.
-            for afile in files:
+        # With a false positive, some kind of cmp pass that compares
+        # all files at once might be more efficient that hashing.
+        dupset.hashable = files
+        if ds.hash_slots is not None:
+            ds.hash_slots.acquire()
+            dupset.hash_slot = True
+            start_hashing(ds, dupset)
+    except BaseException:
+        ds.close_dupset(dupset)
+        raise
+
+    yield dupset
+
+
+def start_hashing(ds, dupset):
+    # Freezes the files of a set and hands them over to the pool.
+    # Files stay frozen from here until they are cloned,
+    # backing off any further only slows down.
+    dupset.hashing = True
+    hashable = list(dupset.hashable)
+    if ds.engine != 'dedupe':
+        # The kernel compares files as it shares them,
+        # with dedupe writers can only make it leave them alone.
+        # Enter this context last, it gets unwound before the files
+        # are closed.
+        # Writers are looked for in verify_dupset; sets that get
+        # there around the same time share a /proc scan.
+        dupset.immutability = dupset.stack.enter_context(
+            ImmutableFDs(
+                [afile.fileno() for afile in hashable], ds.in_use_index))
+    if ds.elevator:
+        hashable.sort(key=lambda afile: ds.file_address(afile, dupset))
+    dupset.hashable = hashable
+    ds.submit_hashes(hashable, dupset)
+
+
+def verify_dupset(ds, dupset):
+    size = dupset.size
+    try:
+        if not dupset.hashing:
+            start_hashing(ds, dupset)
+        by_hash = defaultdict(list)
+        hashable = dupset.hashable
+        if dupset.immutability is not None:
+            in_use = dupset.immutability.fds_in_write_use
+            for afile in hashable:
                 fd = afile.fileno()
-                inode = fd_inodes[fd]
-                if fd in immutability.fds_in_write_use:
-                    ds.tt.notify('File %r is in use, skipping' % fd_names[fd])
-                    ds.skip(inode)
-                    continue
-                hasher = hashlib.sha1()
-                try:
-                    for buf in iter(lambda: afile.read(BUFSIZE), b''):
-                        hasher.update(buf)
-                except OSError as e:
-                    if e.errno == errno.EIO:
-                        continue
-                    raise
-
-                # Gets rid of a race condition
-                st = os.fstat(fd)
-                if st.st_ino != inode.ino:
-                    ds.skip(inode)
-                    continue
-                if st.st_dev != inode.vol.live.st_dev:
-                    ds.skip(inode)
-                    continue
-
-                size1 = afile.tell()
-                if size1 != size:
-                    if size1 < inode.vol.size_cutoff:
-                        # if we didn't delete this inode, it would cause
-                        # spurious comm groups in all future invocations.
-                        ds.sess.delete(inode)
-                    else:
-                        ds.skip(inode)
-                    continue
-
-                by_hash[hasher.digest()].append(afile)
-                ds.tt.update(fhash=None)
+                if fd in in_use:
+                    ds.tt.notify(
+                        'File %r is in use, skipping' % dupset.fd_names[fd])
+                    ds.skip(dupset.fd_candidates[fd])
+                    # Whatever the pool makes of it gets dropped
+                    dupset.pending.pop(fd, None)
+            hashable = [
+                afile for afile in hashable if afile.fileno() not in in_use]
+        hashed = ds.hash_files(hashable, dupset)
+        with ds.stats.context('verify', size):
+            hashed = list(hashed)
+        # The next set can get frozen
+        ds.release_hash_slot(dupset)
+        for afile, (digest, size1, zeroes) in zip(hashable, hashed):
+            fd = afile.fileno()
+            cand = dupset.fd_candidates[fd]
+            if digest is None:
+                continue
 
-            for fileset in by_hash.values():
-                dedup_fileset(ds, fileset, fd_names, fd_inodes, size)
+            # Gets rid of a race condition
+            st = os.fstat(fd)
+            if st.st_ino != cand.ino:
+                ds.skip(cand)
+                continue
+            if st.st_dev != cand.vol.st_dev:
+                ds.skip(cand)
+                continue
 
+            if size1 != size:
+                if size1 < cand.size_cutoff:
+                    # if we didn't delete this inode, it would cause
+                    # spurious comm groups in all future invocations.
+                    ds.delete(cand)
+                else:
+                    ds.skip(cand)
+                continue
 
-def dedup_fileset(ds, fileset, fd_names, fd_inodes, size):
-    if len(fileset) < 2:
+            by_hash[digest].append(afile)
+            if zeroes:
+                dupset.zeroes[fd] = zeroes
+            ds.tt.update(fhash=None)
+
+        dupset.filesets = [
+            fileset for fileset in by_hash.values() if len(fileset) >= 2]
+        if dupset.filesets:
+            ds.stats.count(size, duplicates=1)
+        if ds.partial(size) and len(by_hash) >= 2:
+            # One file per digest, the others get cloned from it
+            with ds.stats.context('partial', size):
+                for fileset in by_hash.values():
+                    fd = fileset[0].fileno()
+                    dupset.blocks[fd] = block_digests(
+                        fileset[0], ds.reader, ds.partial_block)
+    except BaseException:
+        ds.close_dupset(dupset)
+        raise
+
+    if dupset.filesets or dupset.zeroes or dupset.blocks:
+        yield dupset
+    else:
+        ds.close_dupset(dupset)
+
+
+def clone_dupset(ds, dupset):
+    try:
+        in_filesets = frozenset(
+            afile.fileno()
+            for fileset in dupset.filesets for afile in fileset)
+        for fd in dupset.zeroes:
+            if fd not in in_filesets:
+                ds.throttle.slow_down()
+                punch_file(ds, dupset, fd)
+        if dupset.blocks:
+            # Before the filesets, so that whole copies get cloned
+            # from files that share what they can
+            partial_dedup(ds, dupset)
+        for fileset in dupset.filesets:
+            ds.throttle.slow_down()
+            # Reads here are the byte-by-byte comparison
+            with ds.stats.context('compare', dupset.size):
+                dedup_fileset(ds, dupset, fileset)
+    finally:
+        ds.close_dupset(dupset)
+    return ()
+
+
+def punch_file(ds, dupset, fd):
+    cand = dupset.fd_candidates[fd]
+    desc = cand.vol.describe_path(dupset.fd_names[fd])
+    # Measured like dedup gains: the extents nothing references anymore
+    before = ds.extent_refs([cand])
+    try:
+        punched = punch_zeroes(
+            fd, cand.vol.fd, dupset.zeroes[fd],
+            verify=ds.engine == 'dedupe')
+    except OSError as e:
+        # Scratch files need O_TMPFILE support, and NODATACOW files
+        # can't be cloned into from regular files.
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP, errno.EISDIR):
+            ds.tt.notify(
+                'Could not punch zeroes in %r: %s'
+                % (desc, os.strerror(e.errno)))
+            return
+        raise
+    if not punched:
         return
+    released = ds.released_extents(before, [cand])
+    ds.tt.notify('Punched %d bytes of zeroes:\n- %r' % (punched, desc))
+    ds.post(PunchRecord(dupset.size, cand, punched, sum(released.values())))
+
+
+def partial_dedup(ds, dupset):
+    # Shares the runs of identical blocks of files that differ
+    fds = ds.by_source_cost(dupset, list(dupset.blocks))
+    sfd = fds[0]
+    sfile = dupset.fd_files[sfd]
+    scand = dupset.fd_candidates[sfd]
+    sdesc = scand.vol.describe_path(dupset.fd_names[sfd])
+    for dfd in fds[1:]:
+        dfile = dupset.fd_files[dfd]
+        dcand = dupset.fd_candidates[dfd]
+        ddesc = dcand.vol.describe_path(dupset.fd_names[dfd])
+        runs = same_block_runs(
+            dupset.blocks[sfd], dupset.blocks[dfd],
+            ds.partial_block, dupset.size)
+        src_extents = ds.fiemap(sfd)
+        dest_extents = ds.fiemap(dfd)
+        if not ds.enough_gain(dupset, dfd, dest_extents, runs):
+            continue
+        before = ds.extent_refs([scand, dcand])
+        shared = 0
+        for (start, end) in runs:
+            ds.throttle.slow_down()
+            try:
+                if ds.engine == 'dedupe':
+                    if ds.clone_chunk:
+                        length = dedupe_same_range(
+                            dfd, sfd, start, end, ds.clone_chunk,
+                            ds.clone_progress)
+                    else:
+                        length = dedupe_same_range(
+                            dfd, sfd, start, end, progress=ds.count_cloned)
+                else:
+                    if extents_in_range(
+                        src_extents, start, end
+                    ) == extents_in_range(dest_extents, start, end):
+                        continue
+                    with ds.stats.context('compare', dupset.size):
+                        if not ds.reader.cmp_range(sfile, dfile, start, end):
+                            # Probably a bug since we just used a crypto
+                            # hash; leave the file for the next run
+                            ds.tt.notify(
+                                'Files differ: %r %r' % (sdesc, ddesc))
+                            ds.skip(dcand)
+                            break
+                    if ds.clone_chunk:
+                        length = clone_chunked(
+                            dest=dfd, src=sfd, size=end,
+                            chunk_size=ds.clone_chunk, check_first=True,
+                            progress=ds.clone_progress, start=start,
+                            extents=(src_extents, dest_extents))
+                    else:
+                        clone_range(
+                            dest=dfd, src=sfd, src_offset=start,
+                            length=end - start, dest_offset=start)
+                        length = end - start
+                        ds.count_cloned(length)
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINVAL:
+                    ds.tt.notify(
+                        'Error deduplicating, maybe a file is marked '
+                        'NODATACOW:\n- %r\n- %r' % (sdesc, ddesc))
+                    break
+                raise
+            shared += length
+        if shared:
+            ds.tt.notify(
+                'Deduplicated %d bytes in common:\n- %r\n- %r'
+                % (shared, sdesc, ddesc))
+            # Measured once all the runs are shared
+            released = ds.released_extents(before, [scand, dcand])
+            ds.post(RangeRecord(
+                dupset.size, [scand, dcand], shared,
+                sum(released.values())))
+
+
+def dedup_common_prefixes(ds, inode_filt):
+    # Files that start the same at different sizes, like logs and
+    # backups that got appended to, share the prefix they have in common.
+    # Runs in the thread that owns the session, before the pipeline.
+    ds.post = ds.apply
+    inodes = ds.sess.query(Inode).filter(
+        inode_filt, Inode.size >= COMMON_PREFIX_MIN_SIZE)
+    ds.tt.format('{elapsed} Head hashes {hhash:counter}')
+    heads = set()
+    for inode in inodes.filter(
+        or_(Inode.has_updates, Inode.head_hash == None)  # NOQA
+    ).all():
+        with ds.open_by_inode(ds.candidate(inode)) as rfile:
+            if rfile is None:
+                continue
+            with ds.stats.context('head', inode.size):
+                inode.head_hash = head_hash_from_file(rfile, ds.reader)
+        ds.tt.update(hhash=None)
+        # Files that start with zeroes have nothing else in common.
+        # Files that didn't change were compared on an earlier run.
+        if inode.has_updates and inode.head_hash != ZERO_HEAD_HASH:
+            heads.add(inode.head_hash)
+    ds.sess.commit()
+
+    ds.tt.format('{elapsed} Common prefixes {head:counter}/{head:total}')
+    ds.tt.set_total(head=len(heads))
+    for head_hash in heads:
+        ds.tt.update(head=None)
+        group = inodes.filter_by(head_hash=head_hash)
+        longest = group.order_by(Inode.size.desc()).first()
+        # Shorter files that changed are compared to the longest one;
+        # those of the same size are left to the size groups
+        dests = group.filter(
+            Inode.has_updates, Inode.size < longest.size
+        ).order_by(Inode.size.desc()).limit(COMMON_PREFIX_MAX_GROUP).all()
+        if not dests:
+            continue
+        source = ds.candidate(longest)
+        for inode in dests:
+            ds.throttle.wait()
+            dedup_common_prefix(ds, source, ds.candidate(inode))
+    ds.tt.format(None)
+
+
+def dedup_common_prefix(ds, scand, dcand):
+    dupset = DupSet(dcand.size, [scand, dcand])
+    files = []
+    with ExitStack() as stack:
+        for cand in dupset.candidates:
+            try:
+                path = cand.vol.lookup_one_path(cand)
+                afile = fopenat_rw(cand.vol.fd, path)
+            except IOError as e:
+                if e.errno in (errno.ENOENT, errno.ETXTBSY, errno.EACCES):
+                    ds.skip(cand)
+                    return
+                raise
+            stack.enter_context(closing(afile))
+            dupset.fd_candidates[afile.fileno()] = cand
+            dupset.fd_names[afile.fileno()] = path
+            files.append(afile)
+        sfile, dfile = files
+        sfd, dfd = sfile.fileno(), dfile.fileno()
+        sdesc, ddesc = [
+            dupset.fd_candidates[fd].vol.describe_path(dupset.fd_names[fd])
+            for fd in (sfd, dfd)]
+        for (fd, cand) in ((sfd, scand), (dfd, dcand)):
+            if os.fstat(fd).st_ino != cand.ino:
+                ds.skip(cand)
+                return
+        if shared_prefix(
+            ds.fiemap(sfd), ds.fiemap(dfd)
+        ) >= COMMON_PREFIX_MIN_SIZE:
+            # Shared on an earlier run,
+            # no need to freeze and read them again
+            return
+        if ds.engine != 'dedupe':
+            immutability = stack.enter_context(
+                ImmutableFDs([sfd, dfd], ds.in_use_index))
+            for fd in immutability.fds_in_write_use:
+                ds.tt.notify(
+                    'File %r is in use, skipping' % dupset.fd_names[fd])
+                ds.skip(dupset.fd_candidates[fd])
+            if immutability.fds_in_write_use:
+                return
+        with ds.stats.context('compare', dcand.size):
+            common = ds.reader.common_prefix(sfile, dfile, dcand.size)
+        # Only whole blocks can be shared
+        common -= common % HASH_BLOCK_SIZE
+        if common < COMMON_PREFIX_MIN_SIZE:
+            return
+        dest_extents = ds.fiemap(dfd)
+        if extents_in_range(
+            ds.fiemap(sfd), 0, common
+        ) == extents_in_range(dest_extents, 0, common):
+            # Shared already, past what was checked before reading
+            return
+        if not ds.enough_gain(dupset, dfd, dest_extents, [(0, common)]):
+            return
+        before = ds.extent_refs([scand, dcand])
+        try:
+            if ds.engine == 'dedupe':
+                shared = dedupe_same_range(dfd, sfd, 0, common)
+            else:
+                clone_range(
+                    dest=dfd, src=sfd, src_offset=0, length=common,
+                    dest_offset=0)
+                shared = common
+        except (IOError, OSError) as e:
+            if e.errno == errno.EINVAL:
+                ds.tt.notify(
+                    'Error deduplicating, maybe a file is marked '
+                    'NODATACOW:\n- %r\n- %r' % (sdesc, ddesc))
+                return
+            raise
+        if shared:
+            ds.tt.notify(
+                'Deduplicated a common prefix of %d bytes:\n- %r\n- %r'
+                % (shared, sdesc, ddesc))
+            ds.count_cloned(shared)
+            released = ds.released_extents(before, [scand, dcand])
+            ds.post(RangeRecord(
+                dcand.size, [scand, dcand], shared,
+                sum(released.values())))
+
+
+def dedup_fileset(ds, dupset, fileset):
+    size = dupset.size
+    fd_candidates = dupset.fd_candidates
+    # The copy that is kept is the one every file reads from now on
+    fileset = [
+        dupset.fd_files[fd] for fd in ds.by_source_cost(
+            dupset, [afile.fileno() for afile in fileset])]
     sfile = fileset[0]
     sfd = sfile.fileno()
-    sdesc = fd_inodes[sfd].vol.live.describe_path(fd_names[sfd])
+    fileset[1:] = [
+        dfile for dfile in fileset[1:] if ds.enough_gain(
+            dupset, dfile.fileno(), ds.fiemap(dfile.fileno()),
+            [(0, size)])]
     if ds.defrag:
         btrfs_defragment(sfd)
+    if sfd in dupset.zeroes:
+        # The destinations get the holes when they are cloned
+        punch_file(ds, dupset, sfd)
     dfiles = fileset[1:]
+    # Taken after punching and defragmenting, which aren't counted here
+    cands = [fd_candidates[afile.fileno()] for afile in fileset]
+    before = ds.extent_refs(cands)
+    if ds.engine == 'dedupe':
+        dfiles_successful, dfiles_partial = dedupe_fileset(
+            ds, dupset, sfile, dfiles)
+    else:
+        dfiles_successful = clone_fileset(ds, dupset, sfile, dfiles)
+        dfiles_partial = []
+    if dfiles_successful or dfiles_partial:
+        released = ds.released_extents(before, cands)
+        # What was freed goes with the first record
+        freed = sum(released.values())
+        if dfiles_successful:
+            ds.post(DedupRecord(size, [
+                fd_candidates[afile.fileno()]
+                for afile in [sfile] + dfiles_successful], freed))
+            freed = 0
+        for (dfile, shared) in dfiles_partial:
+            ds.post(RangeRecord(size, [
+                fd_candidates[sfile.fileno()],
+                fd_candidates[dfile.fileno()]], shared, freed))
+            freed = 0
+
+
+def dedupe_fileset(ds, dupset, sfile, dfiles):
+    # The kernel compares the files while they are locked,
+    # many destinations at a time.  Returns the files it deduplicated,
+    # and (file, bytes shared) for those that it stopped deduplicating
+    # after some chunks.
+    fd_names = dupset.fd_names
+    fd_candidates = dupset.fd_candidates
+    sfd = sfile.fileno()
+    sdesc = fd_candidates[sfd].vol.describe_path(fd_names[sfd])
+    by_fd = {}
+    for dfile in dfiles:
+        # Comparing would read both files for nothing
+        if ds.fiemap(dfile.fileno()) != ds.fiemap(sfd):
+            by_fd[dfile.fileno()] = dfile
+    if not by_fd:
+        return [], []
+    if ds.clone_chunk:
+        results = dedupe_files(
+            sfd, list(by_fd), dupset.size, ds.clone_chunk,
+            ds.clone_progress)
+    else:
+        results = dedupe_files(
+            sfd, list(by_fd), dupset.size, progress=ds.count_cloned)
+    dfiles_successful = []
+    dfiles_partial = []
+    for (dfd, dfile) in by_fd.items():
+        ddesc = fd_candidates[dfd].vol.describe_path(fd_names[dfd])
+        status, deduped = results[dfd]
+        if status != SAME and deduped:
+            # The chunks before it differed or failed stay shared
+            dfiles_partial.append((dfile, deduped))
+        if status == SAME:
+            ds.tt.notify(
+                'Deduplicated:\n- %r\n- %r' % (sdesc, ddesc))
+            dfiles_successful.append(dfile)
+        elif status == DIFFERS:
+            # Changed since it was hashed
+            ds.tt.notify('Files differ: %r %r' % (sdesc, ddesc))
+        elif status == -errno.EINVAL:
+            ds.tt.notify(
+                'Error deduplicating, maybe a file is marked NODATACOW:\n'
+                '- %r\n- %r' % (sdesc, ddesc))
+        else:
+            ds.tt.notify(
+                'Error deduplicating %r %r: %s'
+                % (sdesc, ddesc, os.strerror(-status)))
+    return dfiles_successful, dfiles_partial
+
+
+def clone_fileset(ds, dupset, sfile, dfiles):
+    # The files are frozen, each one gets compared before it is cloned.
+    # Returns the files that were cloned.
+    fd_names = dupset.fd_names
+    fd_candidates = dupset.fd_candidates
+    sfd = sfile.fileno()
+    sdesc = fd_candidates[sfd].vol.describe_path(fd_names[sfd])
     dfiles_successful = []
     for dfile in dfiles:
         dfd = dfile.fileno()
-        ddesc = fd_inodes[dfd].vol.live.describe_path(
-            fd_names[dfd])
-        if not cmp_files(sfile, dfile):
+        ddesc = fd_candidates[dfd].vol.describe_path(fd_names[dfd])
+        if not ds.reader.cmp_files(sfile, dfile):
             # Probably a bug since we just used a crypto hash
             ds.tt.notify('Files differ: %r %r' % (sdesc, ddesc))
             assert False, (sdesc, ddesc)
-            return
+            return []
         try:
-            deduped = clone_data(dest=dfd, src=sfd, check_first=True)
+            if ds.clone_chunk:
+                deduped = clone_chunked(
+                    dest=dfd, src=sfd, size=dupset.size,
+                    chunk_size=ds.clone_chunk, check_first=True,
+                    progress=ds.clone_progress,
+                    extents=(ds.fiemap(sfd), ds.fiemap(dfd))) > 0
+            elif ds.fiemap(dfd) == ds.fiemap(sfd):
+                # Shared already, what clone_data's check_first does
+                deduped = False
+            else:
+                deduped = clone_data(dest=dfd, src=sfd, check_first=False)
+                ds.count_cloned(dupset.size)
         except IOError as e:
             if e.errno == errno.EINVAL:
                 ds.tt.notify(
                     'Error deduplicating, maybe a file is marked NODATACOW:\n'
                     '- %r\n- %r' % (sdesc, ddesc))
-                return
+                return []
             raise
         if deduped:
             ds.tt.notify(
                 'Deduplicated:\n- %r\n- %r' % (sdesc, ddesc))
             dfiles_successful.append(dfile)
-            ds.space_gain += size
-            ds.tt.update(space_gain=ds.space_gain)
         elif False:
             # Often happens when there are multiple files with
             # the same extents, plus one with the same size and
@@ -652,14 +1951,4 @@ def dedup_fileset(ds, fileset, fd_names, fd_inodes, size):
             ds.tt.notify(
                 'Did not deduplicate (same extents): %r %r' % (
                     sdesc, ddesc))
-    if dfiles_successful:
-        evt = DedupEvent(
-            fs=ds.fs.impl, item_size=size, created=system_now())
-        ds.sess.add(evt)
-        for afile in [sfile] + dfiles_successful:
-            inode = fd_inodes[afile.fileno()]
-            evti = DedupEventInode(
-                event=evt, ino=inode.ino, vol=inode.vol)
-            ds.sess.add(evti)
-        ds.sess.commit()
-
+    return dfiles_successful